@@ -0,0 +1,72 @@
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+
+class AtomicFile:
+    """A file written under a temp name and atomically renamed over `path` on commit.
+
+    Readers either see the previous file or the complete new one, never a
+    partial write:
+
+        with AtomicFile(path, "w") as f:
+            f.write(...)
+    """
+
+    def __init__(self, path: str, mode: str = "w", buffering: int = 1024 * 1024):
+        self.path = path
+        self.mode = mode
+        self.buffering = buffering
+        self.file = None
+        self._tmp_path = None
+
+    def open(self):
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, self._tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(self.path)}.", suffix=".tmp")
+        encoding = None if "b" in self.mode else "utf-8"
+        self.file = os.fdopen(fd, self.mode, encoding=encoding, buffering=self.buffering)
+        return self.file
+
+    @property
+    def closed(self) -> bool:
+        return self.file is None
+
+    def commit(self):
+        """Flush the temp file and atomically replace the target path"""
+        if self.file is None:
+            return
+        try:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            os.chmod(self._tmp_path, 0o644)
+            os.replace(self._tmp_path, self.path)
+        except Exception:
+            self.abort()
+            raise
+        self.file = None
+
+    def abort(self):
+        """Discard the temp file, leaving any existing file untouched"""
+        if self.file is None:
+            return
+        try:
+            self.file.close()
+        finally:
+            self.file = None
+            try:
+                os.unlink(self._tmp_path)
+            except OSError as e:
+                logger.debug(f"Could not remove temp file {self._tmp_path}: {e}")
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
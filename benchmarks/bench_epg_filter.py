@@ -0,0 +1,118 @@
+"""Compare the in-memory ElementTree EPG filter with the streaming filter_epg.
+
+Generates a synthetic XMLTV guide of the requested size, then filters it
+with both implementations, each in its own process so peak RSS is measured
+independently. Run from the repository root:
+
+    python -m benchmarks.bench_epg_filter --size-mb 300
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+from epg_filter import display_name_filter, filter_epg
+
+KEEP_EVERY = 50  # keep one channel in this many
+
+
+def generate_xmltv(path: str, size_mb: int, channels: int = 2000) -> int:
+    """Write a guide of roughly size_mb megabytes, returning the number of programmes"""
+    target = size_mb * 1024 * 1024
+    programmes = 0
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<tv generator-info-name="bench">\n')
+        for c in range(channels):
+            f.write(f'  <channel id="ch{c}.example"><display-name>US - CHANNEL {c}</display-name>'
+                    f'<icon src="http://logos.example/{c}.png"/></channel>\n')
+        hour = 0
+        while f.tell() < target:
+            start = f"202501{1 + hour // 24 % 28:02d}{hour % 24:02d}0000 +0000"
+            stop = f"202501{1 + hour // 24 % 28:02d}{hour % 24:02d}5900 +0000"
+            for c in range(channels):
+                f.write(f'  <programme start="{start}" stop="{stop}" channel="ch{c}.example">'
+                        f'<title lang="en">Programme {hour} on {c}</title>'
+                        f'<desc lang="en">A synthetic description for hour {hour} that pads the guide.</desc>'
+                        f'<category lang="en">Synthetic</category></programme>\n')
+                programmes += 1
+            hour += 1
+        f.write('</tv>\n')
+    return programmes
+
+
+def filter_tree(epg_path: str, dst_path: str, channel_names: set) -> tuple:
+    """The pre-filter_epg implementation: read, parse and rebuild the whole tree"""
+    with open(epg_path, 'r', encoding='utf-8') as f:
+        epg_content = f.read()
+    root = ET.fromstring(epg_content)
+    new_root = ET.Element('tv')
+    new_root.attrib.update(root.attrib)
+    channels_kept = 0
+    programmes_kept = 0
+    kept_channel_ids = set()
+    for channel in root.findall('.//channel'):
+        display_name_elem = channel.find('display-name')
+        if display_name_elem is not None and display_name_elem.text in channel_names:
+            new_root.append(channel)
+            channels_kept += 1
+            kept_channel_ids.add(channel.get('id'))
+    for programme in root.findall('.//programme'):
+        if programme.get('channel') in kept_channel_ids:
+            new_root.append(programme)
+            programmes_kept += 1
+    with open(dst_path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(ET.tostring(new_root, encoding='unicode'))
+    return channels_kept, programmes_kept
+
+
+def run_one(method: str, epg_path: str, dst_path: str, channels: int):
+    channel_names = {f"US - CHANNEL {c}" for c in range(0, channels, KEEP_EVERY)}
+    start = time.perf_counter()
+    if method == "tree":
+        kept = filter_tree(epg_path, dst_path, channel_names)
+    else:
+        kept = filter_epg(epg_path, dst_path, display_name_filter(channel_names))
+    elapsed = time.perf_counter() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({"seconds": elapsed, "peak_rss_mb": peak_kb / 1024, "kept": kept}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=300)
+    parser.add_argument("--channels", type=int, default=2000)
+    parser.add_argument("--methods", nargs="+", default=["tree", "stream"], choices=["tree", "stream"])
+    parser.add_argument("--run", choices=["tree", "stream"], help=argparse.SUPPRESS)
+    parser.add_argument("--src", help=argparse.SUPPRESS)
+    parser.add_argument("--dst", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_one(args.run, args.src, args.dst, args.channels)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src = os.path.join(tmp, "epg.xml")
+        dst = os.path.join(tmp, "filtered_epg.xml")
+        start = time.perf_counter()
+        programmes = generate_xmltv(src, args.size_mb, args.channels)
+        print(f"generated {os.path.getsize(src) / 1048576:.0f} MB guide with {programmes} programmes "
+              f"in {time.perf_counter() - start:.1f}s")
+        for method in args.methods:
+            out = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_epg_filter", "--run", method,
+                 "--src", src, "--dst", dst, "--channels", str(args.channels)],
+                check=True, capture_output=True, text=True,
+            )
+            result = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f"{method:>7}: {result['seconds']:8.2f}s  peak RSS {result['peak_rss_mb']:8.1f} MB  kept {result['kept']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""Compare serial blocking catalog fetches with the concurrent XtreamClient.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_fetch --latency 1.0 --vod 50000
+"""
+import argparse
+import asyncio
+import time
+
+import requests
+
+from benchmarks.fake_xtream import FakeXtreamServer
+from xtream_client import CATALOG_ACTIONS, CATALOG_FIELDS, XtreamClient, iter_catalog_items
+
+
+def fetch_serial(server: FakeXtreamServer) -> int:
+    """The pre-XtreamClient behaviour: one blocking request per action"""
+    total = 0
+    for action in CATALOG_ACTIONS:
+        response = requests.get(
+            f"{server.url}/player_api.php",
+            params={"username": server.username, "password": server.password, "action": action},
+            timeout=120,
+        )
+        response.raise_for_status()
+        total += len(response.json())
+    return total
+
+
+async def fetch_concurrent(server: FakeXtreamServer) -> int:
+    client = XtreamClient(server.url, server.username, server.password)
+    try:
+        await client.authenticate()
+        # The pipeline's own path: concurrent downloads, streamed through the catalog parser
+        catalog_files = await client.download_catalogs()
+        total = 0
+        for action in CATALOG_ACTIONS:
+            with catalog_files[action] as f:
+                total += sum(1 for _ in iter_catalog_items(f, CATALOG_FIELDS[action]))
+        return total
+    finally:
+        await client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--live", type=int, default=5000)
+    parser.add_argument("--vod", type=int, default=20000)
+    parser.add_argument("--series", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds the fake panel waits per action")
+    args = parser.parse_args()
+
+    with FakeXtreamServer(live=args.live, vod=args.vod, series=args.series, latency=args.latency) as server:
+        start = time.perf_counter()
+        serial_count = fetch_serial(server)
+        serial = time.perf_counter() - start
+
+        start = time.perf_counter()
+        concurrent_count = asyncio.run(fetch_concurrent(server))
+        concurrent = time.perf_counter() - start
+
+    print(f"serial:     {serial:.3f}s ({serial_count} streams)")
+    print(f"concurrent: {concurrent:.3f}s ({concurrent_count} streams)")
+    print(f"speedup:    {serial / concurrent:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Merge large multi-provider lineups with lineup_merge and check the result.
+
+Builds --providers synthetic providers of --channels channels each. Every
+provider shares --overlap of its channels with the others, and a few
+channels carry explicit tvg-chno numbers, some of them clashing. Then it
+merges them repeatedly, carrying the guide numbers between merges the way
+LineupCache does (in memory here, so the real database is left alone),
+and checks that:
+
+    - guide numbers are unique and each merge result is independent of provider order
+    - a rebuild with nothing changed assigns no new numbers
+    - removing a provider and adding it back restores every channel's number
+    - shared channels come from the provider with the lowest priority number,
+      with every other provider's URL as a failover
+    - merge time grows linearly with the channel count
+
+Exits non-zero when a check fails. Run from the repository root:
+
+    python -m benchmarks.bench_lineup_merge --providers 10 --channels 100000
+"""
+import argparse
+import logging
+import random
+import sys
+import time
+
+from benchmarks.fake_xtream import channel_name
+from filter_engine import strict_normalize
+from lineup_cache import ParsedChannel
+from lineup_merge import Provider, merge_providers
+
+EXPLICIT_EVERY = 1000  # one channel in this many has a tvg-chno
+EXPLICIT_NUMBERS = 50  # distinct tvg-chno values, so larger lineups have clashes
+
+
+def make_providers(count: int, channels: int, overlap: float, seed: int = 1) -> list:
+    rng = random.Random(seed)
+    shared = int(channels * overlap)
+    providers = []
+    for p in range(count):
+        parsed = []
+        for i in range(channels):
+            # The first `shared` channels are the same across providers, the rest are unique to this one
+            index = i if i < shared else shared + p * channels + i
+            name = channel_name(random.Random(index), index)
+            display_name = f"{name} #{index}"
+            parsed.append(ParsedChannel(
+                display_name=display_name,
+                norm_name=strict_normalize(display_name),
+                tvg_id=f"ch{index}.example",
+                tvg_chno=str(index // EXPLICIT_EVERY % EXPLICIT_NUMBERS + 1) if index % EXPLICIT_EVERY == 0 and rng.random() < 0.9 else "",
+                group=name.split(" ")[0],
+                url=f"http://provider{p}.example/live/u/p/{index}.ts",
+            ))
+        providers.append(Provider(item_id=p + 1, name=f"provider {p}", priority=p % 3, channels=parsed))
+    return providers
+
+
+def timed_merge(providers: list, known: dict):
+    start = time.perf_counter()
+    result = merge_providers(providers, known)
+    return result, time.perf_counter() - start
+
+
+def numbers_by_name(result) -> dict:
+    return {ch["GuideName"]: ch["GuideNumber"] for ch in result.channels}
+
+
+def check(failures: list, ok: bool, message: str):
+    print(f"{'ok  ' if ok else 'FAIL'} {message}")
+    if not ok:
+        failures.append(message)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--providers", type=int, default=10)
+    parser.add_argument("--channels", type=int, default=100000, help="channels per provider")
+    parser.add_argument("--overlap", type=float, default=0.3, help="fraction of each provider's channels shared with the others")
+    args = parser.parse_args()
+    logging.getLogger("lineup_merge").setLevel(logging.ERROR)
+
+    start = time.perf_counter()
+    providers = make_providers(args.providers, args.channels, args.overlap)
+    total = args.providers * args.channels
+    print(f"built {args.providers} providers, {total} channels in {time.perf_counter() - start:.1f}s")
+
+    failures = []
+    known = {}
+    first, elapsed = timed_merge(providers, known)
+    known.update(first.assigned)
+    print(f"first merge:   {len(first.channels)} channels in {elapsed:.2f}s ({elapsed / total * 1e6:.2f}us per input channel)")
+
+    numbers = [ch["GuideNumber"] for ch in first.channels]
+    check(failures, len(numbers) == len(set(numbers)), "guide numbers are unique")
+    expected = int(args.channels * args.overlap) + args.providers * (args.channels - int(args.channels * args.overlap))
+    check(failures, len(first.channels) == expected, f"{expected} channels after de-duplication")
+
+    shuffled = providers[:]
+    random.Random(2).shuffle(shuffled)
+    again, elapsed = timed_merge(shuffled, known)
+    print(f"rebuild:       {elapsed:.2f}s")
+    check(failures, again.channels == first.channels, "provider order doesn't change the lineup")
+    check(failures, not again.assigned, "a rebuild with nothing changed assigns no numbers")
+
+    removed = providers[args.providers // 2]
+    without, _ = timed_merge([p for p in providers if p is not removed], known)
+    known.update(without.assigned)
+    before = numbers_by_name(first)
+    check(failures, all(before[name] == number for name, number in numbers_by_name(without).items()),
+          f"removing '{removed.name}' renumbers no other channel")
+    restored, _ = timed_merge(providers, known)
+    check(failures, numbers_by_name(restored) == before, f"adding '{removed.name}' back restores its numbers")
+
+    best = min(providers, key=lambda p: (p.priority, p.item_id))
+    shared = [ch for ch in first.channels if len(first.failover_urls[ch["GuideNumber"]]) > 1]
+    explicit_names = {c.norm_name for p in providers for c in p.channels if c.tvg_chno}
+    from_best = [ch for ch in shared if strict_normalize(ch["GuideName"]) not in explicit_names]
+    best_host = best.channels[0].url.split("/live/")[0]
+    check(failures, bool(shared) and all(ch["URL"].startswith(best_host) for ch in from_best)
+          and all(len(first.failover_urls[ch["GuideNumber"]]) == args.providers for ch in shared),
+          f"{len(shared)} shared channels come from '{best.name}' with {args.providers - 1} failover URLs each")
+
+    small = make_providers(args.providers, args.channels // 10, args.overlap)
+    _, small_elapsed = timed_merge(small, {})
+    _, large_elapsed = timed_merge(providers, {})
+    ratio = large_elapsed / small_elapsed
+    print(f"scaling:       {total // 10} channels {small_elapsed:.2f}s, {total} channels {large_elapsed:.2f}s ({ratio:.1f}x for 10x)")
+    check(failures, ratio < 20, "merge time grows linearly")
+
+    if failures:
+        sys.exit(f"{len(failures)} checks failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Compare string-concatenation playlist building with the streaming M3UWriter.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_m3u_writer --sizes 10000 100000 500000
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+from m3u_writer import M3UWriter
+
+
+def make_entries(count: int):
+    for i in range(count):
+        name = f"US - SYNTHETIC CHANNEL {i} HD"
+        yield (
+            f'#EXTINF:-1 tvg-id="{i}" tvg-name="{name}" tvg-logo="http://logos.example/{i}.png" group-title="Live", {name}',
+            f"http://provider.example/live/user/pass/{i}.ts",
+        )
+
+
+def build_concat(path: str, count: int):
+    """The pre-M3UWriter behaviour: accumulate the playlist in one string"""
+    content = "#EXTM3U\n"
+    for extinf, url in make_entries(count):
+        content += f"{extinf}\n{url}\n"
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+
+def build_writer(path: str, count: int):
+    with M3UWriter(path) as out:
+        for extinf, url in make_entries(count):
+            out.write_entry(extinf, url)
+
+
+def measure(fn, path: str, count: int):
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn(path, count)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 500000])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "playlist.m3u")
+        print(f"{'entries':>10} {'method':>8} {'seconds':>9} {'peak MiB':>9}")
+        for count in args.sizes:
+            for label, fn in (("concat", build_concat), ("writer", build_writer)):
+                elapsed, peak = measure(fn, path, count)
+                print(f"{count:>10} {label:>8} {elapsed:>9.3f} {peak / 1048576:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
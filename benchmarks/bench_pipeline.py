@@ -0,0 +1,243 @@
+"""Time every stage of an item refresh on synthetic provider data, with peak RSS.
+
+Generates (or reuses) a dataset with benchmarks.synthetic, serves it from
+a FakeXtreamServer in its own process, and runs each stage in a fresh
+process against a scratch M3U_DIR / DATA_DIR, so one stage's memory never
+hides in another's peak:
+
+    generate_m3u           fetch the catalogs into the playlist and channels table
+    generate_filtered_m3u  re-filter the stored channels and export the filtered playlist
+    generate_filtered_epg  download the guide and filter it (in the CPU worker pool)
+    load_channel_lineup    build the lineup from a cold cache
+    lineup.json            first request, then the mean of --repeat cached requests
+    lineup_status.json     mean of --repeat requests
+
+Peak RSS is the stage process's own, including any worker processes it
+started. Results are written as JSON; --baseline compares them with an
+earlier run and exits non-zero when a stage got slower or bigger than
+--tolerance allows. Run from the repository root:
+
+    python -m benchmarks.bench_pipeline --channels 100000 --epg-mb 200 --save-baseline baseline.json
+    python -m benchmarks.bench_pipeline --channels 100000 --epg-mb 200 --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import generate, sample_channels
+
+STAGES = ["generate_m3u", "generate_filtered_m3u", "generate_filtered_epg",
+          "load_channel_lineup", "lineup.json", "lineup_status.json"]
+LANGUAGES = "en,us,go,sling,prime"
+# Changes smaller than this are noise whatever the tolerance
+MIN_SECONDS = 0.05
+MIN_RSS_MB = 5
+
+
+def run_stage(stage: str, item_id: int, repeat: int) -> dict:
+    """Run one stage in this process; the app is imported here, after M3U_DIR and DATA_DIR are set"""
+    import asyncio
+
+    from models import SessionLocal
+
+    if stage == "lineup.json" or stage == "lineup_status.json":
+        from fastapi.testclient import TestClient
+
+        import main
+
+        client = TestClient(main.app)
+        start = time.perf_counter()
+        first = client.get(f"/{stage}")
+        first.raise_for_status()
+        cold = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(repeat):
+            client.get(f"/{stage}").raise_for_status()
+        warm = (time.perf_counter() - start) / repeat
+        return {"seconds": warm, "first_seconds": cold, "bytes": len(first.content)}
+
+    if stage == "load_channel_lineup":
+        from hdhomerun_routes import load_channel_lineup
+
+        db = SessionLocal()
+        try:
+            start = time.perf_counter()
+            channels = load_channel_lineup(db)
+            return {"seconds": time.perf_counter() - start, "channels": len(channels)}
+        finally:
+            db.close()
+
+    import pipeline
+    from xtream_client import close_clients
+
+    item = pipeline.load_item(item_id)
+    if stage == "generate_filtered_m3u":
+        start = time.perf_counter()
+        kept, total, _ = pipeline.filter_playlist(item)
+        return {"seconds": time.perf_counter() - start, "records": total, "kept": kept}
+
+    async def refresh_stage():
+        result = pipeline.RefreshResult()
+        try:
+            if stage == "generate_m3u":
+                await pipeline.fetch_playlist(item, result, {})
+            else:
+                await pipeline.refresh_epg(item, result, {})
+        finally:
+            await close_clients()
+        return result
+
+    start = time.perf_counter()
+    result = asyncio.run(refresh_stage())
+    elapsed = time.perf_counter() - start
+    if stage == "generate_m3u":
+        return {"seconds": elapsed, "records": result.records, "kept": result.filtered}
+    if result.epg_error:
+        raise SystemExit(result.epg_error)
+    return {"seconds": elapsed, "epg": result.epg}
+
+
+def setup_item(server_url: str, includes: list, epg_from_lineup: bool) -> int:
+    from models import SessionLocal, init_db
+    from services import create_item
+
+    init_db()
+    db = SessionLocal()
+    try:
+        # refresh_interval=0 keeps the scheduler away from the item
+        item = create_item(db, "bench", server_url, "user", "pass", LANGUAGES,
+                           ",".join(f"{i + 1}|{name}" for i, name in enumerate(includes)), "",
+                           "" if epg_from_lineup else ",".join(includes), refresh_interval=0)
+        return item.id
+    finally:
+        db.close()
+
+
+def child(args):
+    if args.stage == "setup":
+        result = {"item_id": setup_item(args.server_url, json.loads(sys.stdin.read()), args.epg_from_lineup)}
+    else:
+        result = run_stage(args.stage, args.item_id, args.repeat)
+    print(json.dumps(result), flush=True)
+
+
+def run_child(argv: list, env: dict, stdin: str = "") -> dict:
+    """Run this module as a child and return its JSON result plus its peak RSS in MB"""
+    proc = subprocess.Popen([sys.executable, "-m", "benchmarks.bench_pipeline", *argv], env=env,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    with proc.stdin:
+        proc.stdin.write(stdin)
+    with proc.stdout:
+        stdout = proc.stdout.read()
+    # Reap it ourselves: wait4's usage covers the child and the worker processes it reaped
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode:
+        raise SystemExit(f"{' '.join(argv)} failed with exit code {proc.returncode}")
+    result = json.loads(stdout.strip().splitlines()[-1])
+    result["peak_rss_mb"] = usage.ru_maxrss / 1024
+    return result
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Print each stage against the baseline and return the regressions"""
+    regressions = []
+    for stage, result in results["stages"].items():
+        base = baseline["stages"].get(stage)
+        if base is None:
+            continue
+        for key, floor, unit in (("seconds", MIN_SECONDS, "s"), ("peak_rss_mb", MIN_RSS_MB, "MB")):
+            if key not in result or key not in base:
+                continue
+            delta = result[key] - base[key]
+            ratio = delta / base[key] if base[key] else 0.0
+            regressed = delta > floor and ratio > tolerance
+            print(f"{stage:24} {key:12} {base[key]:10.3f}{unit} -> {result[key]:10.3f}{unit} "
+                  f"({ratio:+.0%}){'  REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append(f"{stage} {key}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, default=10000, help="live channels")
+    parser.add_argument("--vod", type=int, default=None, help="VOD streams (default: same as --channels)")
+    parser.add_argument("--series", type=int, default=None, help="series (default: a tenth of --channels)")
+    parser.add_argument("--epg-mb", type=float, default=50)
+    parser.add_argument("--includes", type=int, default=500, help="channels named in the item's includes and EPG channels")
+    parser.add_argument("--epg-from-lineup", action="store_true",
+                        help="leave the item's EPG channels empty, so the guide is filtered to the lineup's tvg-ids")
+    parser.add_argument("--repeat", type=int, default=50, help="cached lineup endpoint requests to average")
+    parser.add_argument("--data-dir", help="where the dataset is generated and reused (default: a temporary directory)")
+    parser.add_argument("--output", default="bench_pipeline.json")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--save-baseline", help="also write the results here")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown or growth, as a fraction")
+    # Child process mode
+    parser.add_argument("--stage", help=argparse.SUPPRESS)
+    parser.add_argument("--item-id", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--server-url", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.stage:
+        return child(args)
+
+    vod = args.channels if args.vod is None else args.vod
+    series = args.channels // 10 if args.series is None else args.series
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="bench-provider-")
+    start = time.perf_counter()
+    manifest = generate(data_dir, args.channels, vod, series, args.epg_mb)
+    print(f"dataset:  {data_dir} ({sum(manifest['sizes'].values()) / 1024 / 1024:.0f} MB, "
+          f"{manifest['programmes']} programmes) in {time.perf_counter() - start:.1f}s")
+
+    scratch = tempfile.mkdtemp(prefix="bench-pipeline-")
+    env = {**os.environ, "M3U_DIR": os.path.join(scratch, "m3u"), "DATA_DIR": os.path.join(scratch, "data"),
+           "PYTHONPATH": os.getcwd()}
+    server = subprocess.Popen([sys.executable, "-m", "benchmarks.fake_xtream", "--data-dir", data_dir],
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        server_url = server.stdout.readline().strip()
+        includes = sample_channels(args.channels, args.includes)
+        setup = ["--stage", "setup", "--server-url", server_url] + (["--epg-from-lineup"] if args.epg_from_lineup else [])
+        item_id = run_child(setup, env, json.dumps(includes))["item_id"]
+
+        results = {"params": manifest["params"], "includes": args.includes,
+                   "epg_from_lineup": args.epg_from_lineup, "stages": {}}
+        for stage in STAGES:
+            result = run_child(["--stage", stage, "--item-id", str(item_id), "--repeat", str(args.repeat)], env)
+            results["stages"][stage] = result
+            extra = ", ".join(f"{k}={v:.3f}" if isinstance(v, float) else f"{k}={v}"
+                              for k, v in result.items() if k not in ("seconds", "peak_rss_mb"))
+            print(f"{stage:24} {result['seconds']:9.3f}s  {result['peak_rss_mb']:7.0f} MB peak  {extra}")
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(scratch, ignore_errors=True)
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    results["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+    for path in filter(None, [args.output, args.save_baseline]):
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+    print(f"results:  {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["params"] != results["params"]:
+            print(f"warning: baseline was recorded with {baseline['params']}")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            raise SystemExit(f"{len(regressions)} regressions beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+        print(f"no regressions beyond {args.tolerance:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Refresh several providers one by one, then all at once through the scheduler.
+
+Starts --providers FakeXtreamServers with --latency seconds per action, one
+item per provider, plus --shared extra items on the first provider's host so
+the per-host limits are shared. Each item gets a full refresh (fetch, filter,
+EPG, lineup) serially, the way the per-item button works, then in parallel
+through refresh_scheduler.enqueue_all(), the way "Refresh All" does. The
+parallel run should take about as long as the slowest provider, and no
+provider should ever see more than PROVIDER_HOST_CONCURRENCY requests at once
+or requests starting faster than PROVIDER_REQUESTS_PER_SECOND. Exits
+non-zero when a check fails. Run from the repository root:
+
+    python -m benchmarks.bench_refresh_all --providers 8 --latency 2.0
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_xtream import FakeXtreamServer
+
+
+def check(failures: list, ok: bool, message: str):
+    print(f"{'ok  ' if ok else 'FAIL'} {message}")
+    if not ok:
+        failures.append(message)
+
+
+def reset_counters(servers: list):
+    for server in servers:
+        server.max_active = 0
+        server.request_starts.clear()
+
+
+def min_gap(starts: list, span: int = 4) -> float:
+    """Shortest average gap between request starts over any span consecutive requests.
+
+    The fake servers' threads share this busy process, so single arrivals
+    jitter; averaging a few keeps the check about the client's pacing.
+    """
+    starts = sorted(starts)
+    return min(((starts[i + span] - starts[i]) / span for i in range(len(starts) - span)), default=float("inf"))
+
+
+async def run(servers: list, shared: int) -> list:
+    """Both refresh modes, in this process; the app is imported here, after M3U_DIR and DATA_DIR are set"""
+    from lineup_cache import M3U_DIR
+    from models import SessionLocal, init_db
+    from pipeline import refresh_item
+    from scheduler import refresh_scheduler
+    from services import create_item
+    from workers import start_workers, stop_workers
+    from xtream_client import HOST_CONCURRENCY, HOST_REQUESTS_PER_SECOND, close_clients
+
+    start_workers()
+    init_db()
+    db = SessionLocal()
+    try:
+        targets = [(i, server) for i, server in enumerate(servers)] + [(len(servers) + i, servers[0]) for i in range(shared)]
+        # refresh_interval=0 keeps the scheduler's own timer away from the items
+        items = [create_item(db, f"provider {i}", server.url, server.username, server.password, "en,us",
+                             "", "", "", refresh_interval=0).id for i, server in targets]
+    finally:
+        db.close()
+
+    failures = []
+    try:
+        reset_counters(servers)
+        serial = {}
+        start = time.perf_counter()
+        for item_id in items:
+            item_start = time.perf_counter()
+            await refresh_item(item_id, {}, manual=True)
+            serial[item_id] = time.perf_counter() - item_start
+        serial_total = time.perf_counter() - start
+        print(f"serial:   {serial_total:7.2f}s (slowest item {max(serial.values()):.2f}s)")
+
+        # Start the parallel run from scratch: no saved guide validators, no cached lineup
+        shutil.rmtree(M3U_DIR)
+        os.makedirs(M3U_DIR)
+        await close_clients()
+        reset_counters(servers)
+        refresh_scheduler.start()
+        start = time.perf_counter()
+        queued, busy = await refresh_scheduler.enqueue_all(manual=True)
+        while any(job.state != "idle" for job in refresh_scheduler.jobs.values()):
+            await asyncio.sleep(0.05)
+        parallel_total = time.perf_counter() - start
+        await refresh_scheduler.stop()
+        print(f"parallel: {parallel_total:7.2f}s ({len(queued)} items queued)")
+        for job in refresh_scheduler.status():
+            print(f"  item {job['item_id']:3} {'ok  ' if job['last_ok'] else 'FAIL'} "
+                  f"{job['last_finished'] - job['last_started']:6.2f}s  {job['last_message']}")
+
+        check(failures, len(queued) == len(items) and not busy, f"all {len(items)} items queued")
+        check(failures, all(job["last_ok"] for job in refresh_scheduler.status()), "every item refreshed")
+        # The shared host runs its items' requests through one limiter, so it sets the floor
+        slowest = max(serial.values()) * (1 + shared)
+        check(failures, parallel_total < slowest * 1.5 + 1,
+              f"parallel run within 1.5x of the slowest host ({slowest:.2f}s)")
+        worst = max(server.max_active for server in servers)
+        check(failures, worst <= HOST_CONCURRENCY, f"at most {HOST_CONCURRENCY} requests in flight per host (saw {worst})")
+        if HOST_REQUESTS_PER_SECOND > 0:
+            gap = min(min_gap(server.request_starts) for server in servers)
+            check(failures, gap >= 1 / HOST_REQUESTS_PER_SECOND * 0.8,
+                  f"request starts per host at least {1 / HOST_REQUESTS_PER_SECOND:.2f}s apart on average (saw {gap:.2f}s)")
+    finally:
+        await close_clients()
+        stop_workers()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--providers", type=int, default=8)
+    parser.add_argument("--shared", type=int, default=1, help="extra items on the first provider's host")
+    parser.add_argument("--latency", type=float, default=2.0, help="seconds each fake panel waits per action")
+    parser.add_argument("--channels", type=int, default=2000, help="live channels per provider")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix="bench-refresh-all-")
+    os.environ["M3U_DIR"] = os.path.join(scratch, "m3u")
+    os.environ["DATA_DIR"] = os.path.join(scratch, "data")
+    os.environ.setdefault("REFRESH_CONCURRENCY", str(args.providers + args.shared))
+    os.makedirs(os.environ["M3U_DIR"])
+    servers = [FakeXtreamServer(live=args.channels, vod=args.channels, series=args.channels // 10, latency=args.latency)
+               for _ in range(args.providers)]
+    try:
+        for server in servers:
+            server.start()
+        failures = asyncio.run(run(servers, args.shared))
+    finally:
+        for server in servers:
+            server.stop()
+        shutil.rmtree(scratch, ignore_errors=True)
+    if failures:
+        sys.exit(f"{len(failures)} checks failed")
+
+
+if __name__ == "__main__":
+    main()
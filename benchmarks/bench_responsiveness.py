@@ -0,0 +1,139 @@
+"""Check that discover.json stays responsive while a large refresh runs.
+
+Starts the app with uvicorn against a fake Xtream panel, adds a temporary
+item, and polls /discover.json while that item's refresh (catalog fetch,
+channel sync, filtering, EPG download and filter, lineup rebuild) runs and
+other clients keep downloading the lineup and the filtered playlist.
+Prints idle and under-load latency percentiles and exits non-zero when
+the under-load p99 exceeds --max-p99-ms. The item and its files are
+removed afterwards. Run from the repository root:
+
+    python -m benchmarks.bench_responsiveness --live 20000 --vod 200000
+"""
+import argparse
+import glob
+import os
+import socket
+import statistics
+import sys
+import threading
+import time
+
+import httpx
+import uvicorn
+
+from benchmarks.fake_xtream import FakeXtreamServer
+from lineup_cache import M3U_DIR
+from models import Item, SessionLocal, init_db
+from services import delete_item
+
+POLL_INTERVAL = 0.01
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def poll(client: httpx.Client, until) -> list:
+    """discover.json latencies in seconds, polled until until() is true"""
+    latencies = []
+    while not until():
+        start = time.perf_counter()
+        client.get("/discover.json").raise_for_status()
+        latencies.append(time.perf_counter() - start)
+        time.sleep(POLL_INTERVAL)
+    return latencies
+
+
+def heavy_client(base_url: str, item_id: int, stop: threading.Event):
+    """A client like Plex or an IPTV player, fetching the big responses in a loop"""
+    with httpx.Client(base_url=base_url, timeout=60) as client:
+        while not stop.is_set():
+            client.get("/lineup.json")
+            client.get(f"/stream_filtered_m3u/{item_id}")
+
+
+def report(label: str, latencies: list):
+    print(f"{label:10} {len(latencies)} requests, p50 {statistics.median(latencies) * 1000:.1f}ms, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f}ms, max {max(latencies) * 1000:.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--live", type=int, default=20000)
+    parser.add_argument("--vod", type=int, default=200000)
+    parser.add_argument("--series", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=4, help="clients downloading lineup.json and the playlist meanwhile")
+    parser.add_argument("--max-p99-ms", type=float, default=100.0)
+    args = parser.parse_args()
+
+    import main as app_main
+
+    init_db()
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app_main.app, host="127.0.0.1", port=port, log_level="warning"))
+    server_thread = threading.Thread(target=server.run, daemon=True)
+
+    with FakeXtreamServer(live=args.live, vod=args.vod, series=args.series) as panel:
+        db = SessionLocal()
+        item = Item(name="bench responsiveness", server_url=panel.url, username=panel.username, user_pass=panel.password,
+                    languages="us,uk", includes="", excludes="", epg_channels="US - CHANNEL 1", refresh_interval=0)
+        db.add(item)
+        db.commit()
+        item_id = item.id
+        db.close()
+
+        server_thread.start()
+        try:
+            while not server.started:
+                time.sleep(0.05)
+            base_url = f"http://127.0.0.1:{port}"
+            with httpx.Client(base_url=base_url, timeout=30) as client:
+                deadline = time.monotonic() + 2
+                idle = poll(client, lambda: time.monotonic() > deadline)
+
+                def refreshed() -> bool:
+                    jobs = {job["item_id"]: job for job in client.get("/refresh_status.json").json()}
+                    job = jobs.get(item_id)
+                    return job is not None and job["state"] == "idle" and job["last_finished"] is not None
+
+                stop = threading.Event()
+                clients = [threading.Thread(target=heavy_client, args=(base_url, item_id, stop)) for _ in range(args.clients)]
+                start = time.perf_counter()
+                client.post("/generate_m3u", data={"item_id": item_id})
+                for thread in clients:
+                    thread.start()
+                loaded = poll(client, refreshed)
+                refresh_time = time.perf_counter() - start
+                stop.set()
+                for thread in clients:
+                    thread.join()
+                job = next(job for job in client.get("/refresh_status.json").json() if job["item_id"] == item_id)
+        finally:
+            server.should_exit = True
+            server_thread.join()
+            db = SessionLocal()
+            delete_item(db, item_id)
+            db.close()
+            for path in glob.glob(os.path.join(M3U_DIR, f"*_{item_id}.*")):
+                os.remove(path)
+
+    print(f"refresh:   {refresh_time:.1f}s ({job['last_message']})")
+    report("idle", idle)
+    report("refreshing", loaded)
+    p99 = percentile(loaded, 0.99) * 1000
+    if p99 > args.max_p99_ms:
+        print(f"FAIL: discover.json p99 {p99:.1f}ms during refresh exceeds {args.max_p99_ms:.0f}ms")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
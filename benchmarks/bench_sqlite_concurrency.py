@@ -0,0 +1,146 @@
+"""Measure lineup reads while a refresh bulk-writes the channels table.
+
+Runs the same workload against a scratch database twice: once in SQLite's
+default rollback-journal mode and once with the connect-time pragmas from
+models.SQLITE_PRAGMAS (WAL). A writer thread replaces one item's channel
+rows in a single transaction, like channel_store.sync_channels, while
+reader threads repeatedly run the lineup query for another item. Run from
+the repository root:
+
+    python -m benchmarks.bench_sqlite_concurrency --rows 200000 --readers 4
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, delete, event, insert, select
+from sqlalchemy.exc import OperationalError
+
+from models import Base, Channel, Item, set_sqlite_pragmas
+
+LINEUP_ITEM = 1
+REFRESH_ITEM = 2
+BATCH_SIZE = 5000
+
+
+def make_engine(path: str, wal: bool):
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False, "timeout": 5})
+    if wal:
+        event.listen(engine, "connect", set_sqlite_pragmas)
+    return engine
+
+
+def channel_rows(item_id: int, count: int, filtered_every: int = 1):
+    for i in range(count):
+        extinf = f'#EXTINF:-1 tvg-id="ch{i}.example" tvg-name="US - CHANNEL {i}" group-title="US",US - CHANNEL {i}'
+        yield {
+            "item_id": item_id,
+            "position": i,
+            "stream_id": str(i),
+            "tvg_id": f"ch{i}.example",
+            "tvg_name": f"us - channel {i}",
+            "name": f"US - CHANNEL {i}",
+            "norm_name": f"channel {i}",
+            "language": "us",
+            "group_title": "US",
+            "url": f"http://provider.example/live/u/p/{item_id}{i:07d}.ts",
+            "extinf": extinf,
+            "digest": f"{i:016x}",
+            "filtered_extinf": extinf if i % filtered_every == 0 else None,
+            "chno": None,
+        }
+
+
+def write_rows(conn, item_id: int, count: int):
+    batch = []
+    for row in channel_rows(item_id, count, filtered_every=3):
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            conn.execute(insert(Channel), batch)
+            batch = []
+    if batch:
+        conn.execute(insert(Channel), batch)
+
+
+def setup(engine, lineup_rows: int, rows: int):
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        for item_id in (LINEUP_ITEM, REFRESH_ITEM):
+            conn.execute(insert(Item).values(id=item_id, name=f"item {item_id}", server_url="http://provider.example",
+                                             username="u", user_pass="p"))
+        write_rows(conn, LINEUP_ITEM, lineup_rows)
+        write_rows(conn, REFRESH_ITEM, rows)
+
+
+def run(wal: bool, rows: int, lineup_rows: int, readers: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = make_engine(os.path.join(tmp, "bench.db"), wal)
+        setup(engine, lineup_rows, rows)
+
+        lineup_query = (
+            select(Channel.name, Channel.norm_name, Channel.tvg_id, Channel.chno, Channel.group_title, Channel.url)
+            .where(Channel.item_id == LINEUP_ITEM, Channel.filtered_extinf.isnot(None))
+            .order_by(Channel.position)
+        )
+        latencies = []
+        errors = [0]
+        writing = threading.Event()
+        writing.set()
+        lock = threading.Lock()
+
+        def reader():
+            while writing.is_set():
+                start = time.perf_counter()
+                try:
+                    with engine.connect() as conn:
+                        conn.execute(lineup_query).all()
+                except OperationalError:
+                    with lock:
+                        errors[0] += 1
+                    continue
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=reader) for _ in range(readers)]
+        for thread in threads:
+            thread.start()
+        start = time.perf_counter()
+        with engine.begin() as conn:
+            conn.execute(delete(Channel).where(Channel.item_id == REFRESH_ITEM))
+            write_rows(conn, REFRESH_ITEM, rows)
+        write_time = time.perf_counter() - start
+        writing.clear()
+        for thread in threads:
+            thread.join()
+        engine.dispose()
+
+    latencies.sort()
+    return {
+        "write": write_time,
+        "reads": len(latencies),
+        "errors": errors[0],
+        "p50": statistics.median(latencies) if latencies else float("nan"),
+        "p99": latencies[int(len(latencies) * 0.99)] if latencies else float("nan"),
+        "max": latencies[-1] if latencies else float("nan"),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200000, help="channel rows written by the refresh")
+    parser.add_argument("--lineup-rows", type=int, default=6000, help="rows of the item whose lineup is read")
+    parser.add_argument("--readers", type=int, default=4)
+    args = parser.parse_args()
+
+    for label, wal in (("rollback journal", False), ("WAL + pragmas", True)):
+        r = run(wal, args.rows, args.lineup_rows, args.readers)
+        print(f"{label:17} write {r['write']:.2f}s, {r['reads']} lineup reads "
+              f"(p50 {r['p50'] * 1000:.1f}ms, p99 {r['p99'] * 1000:.1f}ms, max {r['max'] * 1000:.1f}ms), "
+              f"{r['errors']} locked")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Fire M-SEARCH packets at the asyncio SSDP responder and count the replies.
+
+Starts an HDHomeRunEmulator responder on a spare UDP port of 127.0.0.1
+(no multicast needed), then sends --packets unicast M-SEARCHes from
+--clients sockets as fast as it can. ST values rotate between ssdp:all and
+the device's own search targets. Reports send rate, replies received,
+the responder's CPU time and any replies dropped by the pending-reply
+cap. Run from the repository root:
+
+    python -m benchmarks.bench_ssdp --packets 5000 --mx 1
+"""
+import argparse
+import asyncio
+import itertools
+import socket
+import time
+
+from hdhomerun_emulator import HDHomeRunEmulator
+
+BURST = 1
+
+
+def free_udp_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def m_search(port: int, target: str, mx: int) -> bytes:
+    return (
+        "M-SEARCH * HTTP/1.1\r\n"
+        f"HOST: 127.0.0.1:{port}\r\n"
+        'MAN: "ssdp:discover"\r\n'
+        f"MX: {mx}\r\n"
+        f"ST: {target}\r\n\r\n"
+    ).encode()
+
+
+class Collector(asyncio.DatagramProtocol):
+    def __init__(self):
+        self.replies = 0
+        self.valid = 0
+
+    def datagram_received(self, data, addr):
+        self.replies += 1
+        if data.startswith(b"HTTP/1.1 200 OK") and b"/discover.json" in data:
+            self.valid += 1
+
+
+async def run(packets: int, clients: int, mx: int) -> dict:
+    loop = asyncio.get_running_loop()
+    port = free_udp_port()
+    emulator = HDHomeRunEmulator(ssdp_port=port)
+    if not await emulator.start(force=True):
+        raise SystemExit("Could not start the SSDP responder")
+
+    targets = ["ssdp:all", *emulator.search_targets()]
+    expected = sum(len(targets) - 1 if target == "ssdp:all" else 1 for target in itertools.islice(itertools.cycle(targets), packets))
+    messages = [m_search(port, target, mx) for target in targets]
+    endpoints = [await loop.create_datagram_endpoint(Collector, local_addr=("127.0.0.1", 0)) for _ in range(clients)]
+
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    for i in range(packets):
+        transport, _ = endpoints[i % clients]
+        transport.sendto(messages[i % len(messages)], ("127.0.0.1", port))
+        if i % BURST == BURST - 1:
+            # Let the responder drain its socket buffer; unpaced loopback floods just overflow it
+            await asyncio.sleep(0)
+    send_time = time.perf_counter() - start
+
+    # Replies arrive up to MX seconds later
+    deadline = time.perf_counter() + mx + 2
+    while time.perf_counter() < deadline and sum(p.replies for _, p in endpoints) < expected:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    replies = sum(p.replies for _, p in endpoints)
+    valid = sum(p.valid for _, p in endpoints)
+    for transport, _ in endpoints:
+        transport.close()
+    dropped = emulator.replies_dropped
+    await emulator.stop()
+    return {"send_time": send_time, "elapsed": elapsed, "cpu": cpu, "expected": expected,
+            "replies": replies, "valid": valid, "dropped": dropped}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--packets", type=int, default=5000)
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--mx", type=int, default=1, help="MX header; replies are spread over this many seconds")
+    args = parser.parse_args()
+
+    r = asyncio.run(run(args.packets, args.clients, args.mx))
+    print(f"sent:     {args.packets} M-SEARCH in {r['send_time']:.2f}s ({args.packets / r['send_time']:.0f}/s)")
+    print(f"replies:  {r['replies']} of {r['expected']} expected ({r['valid']} well-formed) within {r['elapsed']:.2f}s")
+    print(f"dropped:  {r['dropped']} searches over the pending-reply cap")
+    print(f"cpu:      {r['cpu']:.2f}s for client and responder ({r['cpu'] / args.packets * 1e6:.0f}us per search)")
+
+
+if __name__ == "__main__":
+    main()
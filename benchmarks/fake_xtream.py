@@ -0,0 +1,320 @@
+"""Minimal offline Xtream Codes server for benchmarks.
+
+Serves player_api.php (auth + catalog actions), get.php and xmltv.php from
+synthetic data, with an optional per-action latency to mimic slow panels.
+
+    with FakeXtreamServer(live=5000, vod=50000, series=10000, latency=1.0) as server:
+        client = XtreamClient(server.url, "user", "pass")
+
+Large datasets are served from files written by benchmarks.synthetic
+(data_dir=...), streamed from disk instead of held in memory. Run as a
+module to serve a data directory from its own process:
+
+    python -m benchmarks.fake_xtream --data-dir /tmp/provider --port 8765
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIXES = ["US", "UK", "EN", "CA", "GO", "PRIME", "SLING", "FR", "DE", "ES"]
+NETWORKS = ["CBS", "ABC", "NBC", "FOX", "ESPN", "CNN", "TNT", "TBS", "HBO", "SYFY",
+            "DISCOVERY", "TLC", "HALLMARK", "NFL NETWORK", "MLB NETWORK", "TRAVEL CHANNEL"]
+CITIES = ["PITTSBURGH", "NEW YORK", "CHICAGO", "BOSTON", "DENVER", "SEATTLE", "MIAMI"]
+SUFFIXES = ["", " HD", " FHD", " 4K"]
+
+
+def channel_name(rng: random.Random, index: int) -> str:
+    prefix = rng.choice(PREFIXES)
+    network = rng.choice(NETWORKS)
+    if rng.random() < 0.4:
+        return f"{prefix}: {network} {index % 100} {rng.choice(CITIES)}{rng.choice(SUFFIXES)}"
+    return f"{prefix} - {network} {index}{rng.choice(SUFFIXES)}"
+
+
+def iter_live_streams(rng: random.Random, count: int):
+    for i in range(count):
+        yield {
+            "num": i + 1,
+            "name": channel_name(rng, i),
+            "stream_type": "live",
+            "stream_id": 100000 + i,
+            "stream_icon": f"http://logos.example/{i}.png",
+            "epg_channel_id": f"ch{i}.example",
+            "added": "1700000000",
+            "category_id": str(1 + i % 40),
+            "custom_sid": "",
+            "tv_archive": 0,
+            "direct_source": "",
+            "tv_archive_duration": 0,
+        }
+
+
+def iter_vod_streams(rng: random.Random, count: int):
+    for i in range(count):
+        yield {
+            "num": i + 1,
+            "name": f"{rng.choice(PREFIXES)} - Movie Title {i} ({1970 + i % 55})",
+            "stream_type": "movie",
+            "stream_id": 500000 + i,
+            "stream_icon": f"http://posters.example/{i}.jpg",
+            "rating": "6.5",
+            "rating_5based": 3.3,
+            "added": "1700000000",
+            "category_id": str(100 + i % 60),
+            "container_extension": "mp4",
+            "custom_sid": "",
+            "direct_source": "",
+        }
+
+
+def iter_series(rng: random.Random, count: int):
+    for i in range(count):
+        yield {
+            "num": i + 1,
+            "name": f"{rng.choice(PREFIXES)} - Series {i}",
+            "series_id": 900000 + i,
+            "cover": f"http://posters.example/s{i}.jpg",
+            "plot": "A synthetic plot description that pads out the catalog like real providers do.",
+            "cast": "Someone, Someone Else",
+            "director": "A Director",
+            "genre": "Drama",
+            "releaseDate": "2020-01-01",
+            "last_modified": "1700000000",
+            "rating": "7",
+            "category_id": str(200 + i % 30),
+        }
+
+
+def make_catalogs(live: int, vod: int, series: int, seed: int = 1) -> dict:
+    rng = random.Random(seed)
+    return {
+        "get_live_streams": list(iter_live_streams(rng, live)),
+        "get_vod_streams": list(iter_vod_streams(rng, vod)),
+        "get_series": list(iter_series(rng, series)),
+    }
+
+
+def make_categories() -> dict:
+    """Category lists matching the category_ids used by make_catalogs"""
+    def categories(first, count, label):
+        return [{"category_id": str(cid), "category_name": f"{PREFIXES[cid % len(PREFIXES)]} - {label} {cid}", "parent_id": 0}
+                for cid in range(first, first + count)]
+    return {
+        "get_live_categories": categories(1, 40, "Live"),
+        "get_vod_categories": categories(100, 60, "Movies"),
+        "get_series_categories": categories(200, 30, "Series"),
+    }
+
+
+def make_xmltv(channel_ids: list, programmes_per_channel: int = 4) -> str:
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<tv generator-info-name="fake-xtream">\n']
+    for cid in channel_ids:
+        parts.append(f'  <channel id="{cid}"><display-name>{cid}</display-name></channel>\n')
+    for cid in channel_ids:
+        for p in range(programmes_per_channel):
+            parts.append(
+                f'  <programme start="2025010{1 + p % 9}000000 +0000" stop="2025010{1 + p % 9}010000 +0000" channel="{cid}">'
+                f'<title>Show {p}</title></programme>\n'
+            )
+    parts.append('</tv>\n')
+    return "".join(parts)
+
+
+class FakeXtreamServer:
+    """Threaded HTTP server speaking enough of the Xtream API for the fetch paths"""
+
+    def __init__(self, live: int = 1000, vod: int = 5000, series: int = 1000, latency: float = 0.0,
+                 username: str = "user", password: str = "pass", host: str = "127.0.0.1", port: int = 0,
+                 stream_bytes: int = 4 * 1024 * 1024, stream_interval: float = 0.0, data_dir: str = None):
+        self.username = username
+        self.password = password
+        self.latency = latency
+        # /live/... serves stream_bytes of null TS packets, one 188*64 byte chunk per stream_interval
+        self.stream_bytes = stream_bytes
+        self.stream_interval = stream_interval
+        self.open_streams = 0
+        self.requests = []
+        # API requests in flight, the most seen at once, and when each one started
+        self.active = 0
+        self.max_active = 0
+        self.request_starts = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+        # Response key (action, "m3u" or "epg") -> file served as the body
+        self.files = {}
+        if data_dir is not None:
+            self.bodies = {"auth": self._auth_body(username, host, port)}
+            for name in os.listdir(data_dir):
+                self.files[name.split(".", 1)[0]] = os.path.join(data_dir, name)
+            return
+        catalogs = make_catalogs(live, vod, series)
+        self.bodies = {action: json.dumps(data).encode() for action, data in catalogs.items()}
+        self.bodies.update({action: json.dumps(data).encode() for action, data in make_categories().items()})
+        self.bodies["auth"] = self._auth_body(username, host, port)
+        self.bodies["m3u"] = self._make_m3u(catalogs["get_live_streams"]).encode()
+        self.bodies["epg"] = make_xmltv([s["epg_channel_id"] for s in catalogs["get_live_streams"]]).encode()
+
+    @staticmethod
+    def _auth_body(username: str, host: str, port: int) -> bytes:
+        return json.dumps({
+            "user_info": {"username": username, "auth": 1, "status": "Active", "max_connections": "2"},
+            "server_info": {"url": host, "port": str(port)},
+        }).encode()
+
+    def _make_m3u(self, live_streams: list) -> str:
+        lines = ["#EXTM3U"]
+        for s in live_streams:
+            lines.append(f'#EXTINF:-1 tvg-id="{s["epg_channel_id"]}" tvg-name="{s["name"]}" group-title="Live",{s["name"]}')
+            lines.append(f"http://fake/live/{self.username}/{self.password}/{s['stream_id']}.ts")
+        return "\n".join(lines) + "\n"
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                parsed = urllib.parse.urlparse(self.path)
+                if parsed.path.startswith("/live/"):
+                    return self._stream_ts()
+                with server._lock:
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                    server.request_starts.append(time.monotonic())
+                try:
+                    self._api(parsed)
+                finally:
+                    with server._lock:
+                        server.active -= 1
+
+            def _api(self, parsed):
+                query = dict(urllib.parse.parse_qsl(parsed.query))
+                if query.get("username") != server.username or query.get("password") != server.password:
+                    return self._send(401, b"Unauthorized", "text/plain")
+                if parsed.path == "/player_api.php":
+                    key = query.get("action", "auth")
+                    content_type = "application/json"
+                elif parsed.path == "/get.php":
+                    key, content_type = "m3u", "audio/x-mpegurl"
+                elif parsed.path == "/xmltv.php":
+                    key, content_type = "epg", "application/xml"
+                else:
+                    key, content_type = None, "text/plain"
+                if key in server.files:
+                    server.requests.append(key)
+                    return self._send_file(server.files[key], content_type)
+                body = server.bodies.get(key)
+                if body is None:
+                    return self._send(404, b"Not found", "text/plain")
+                server.requests.append(key)
+                if server.latency and key != "auth":
+                    threading.Event().wait(server.latency)
+                headers = {}
+                if key == "epg":
+                    # Guides are served with validators and gzip, like most panels
+                    etag = f'"{hashlib.md5(body).hexdigest()}"'
+                    headers["ETag"] = etag
+                    if self.headers.get("If-None-Match") == etag:
+                        return self._send(304, b"", content_type, headers)
+                    if "gzip" in (self.headers.get("Accept-Encoding") or ""):
+                        body = gzip.compress(body)
+                        headers["Content-Encoding"] = "gzip"
+                self._send(200, body, content_type, headers)
+
+            def _stream_ts(self):
+                chunk = (b"\x47\x1f\xff\x10" + b"\xff" * 184) * 64
+                server.requests.append("live")
+                server.open_streams += 1
+                try:
+                    self.send_response(200)
+                    self.send_header("Content-Type", "video/mp2t")
+                    self.send_header("Connection", "close")
+                    self.end_headers()
+                    sent = 0
+                    while sent < server.stream_bytes:
+                        self.wfile.write(chunk)
+                        sent += len(chunk)
+                        if server.stream_interval:
+                            threading.Event().wait(server.stream_interval)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    server.open_streams -= 1
+                    self.close_connection = True
+
+            def _send_file(self, path, content_type):
+                stat = os.stat(path)
+                etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+                if self.headers.get("If-None-Match") == etag:
+                    return self._send(304, b"", content_type, {"ETag": etag})
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(stat.st_size))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, self.wfile, 1024 * 1024)
+
+            def _send(self, status, body, content_type, headers=None):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", required=True)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    args = parser.parse_args()
+    server = FakeXtreamServer(data_dir=args.data_dir, host=args.host, port=args.port).start()
+    # The parent reads the URL from the first line of output
+    print(server.url, flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
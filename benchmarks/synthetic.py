@@ -0,0 +1,150 @@
+"""Write a synthetic provider dataset to a directory, streamed so any size fits in memory.
+
+The files are named after the request they answer, so
+FakeXtreamServer(data_dir=...) can serve them as-is:
+
+    get_live_streams.json, get_vod_streams.json, get_series.json   player_api catalogs
+    get_*_categories.json                                          category lists
+    m3u.m3u                                                        get.php playlist
+    epg.xml                                                        xmltv.php guide
+
+Names follow real panels ("EN - ...", "US: ... HD", see sampledata.md) and
+the guide's display names match the live channel names. Like a real guide,
+listings run from two days before the day the dataset is generated to two
+weeks after, with programme lengths set by the guide size; a dataset from
+an earlier day is therefore regenerated. manifest.json
+records the parameters, so an existing dataset is reused when they match.
+Run from the repository root:
+
+    python -m benchmarks.synthetic /tmp/provider --channels 100000 --epg-mb 500
+"""
+import argparse
+import calendar
+import json
+import os
+import random
+import time
+
+from benchmarks.fake_xtream import iter_live_streams, iter_series, iter_vod_streams, make_categories
+
+MANIFEST = "manifest.json"
+# Rough size of one <programme> element below, used to size the guide
+PROGRAMME_BYTES = 330
+PAST_DAYS = 2
+GUIDE_DAYS = 16
+MIN_SLOT_SECONDS = 300
+
+
+def _write_json_array(path: str, entries) -> int:
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[")
+        for entry in entries:
+            if count:
+                f.write(",")
+            f.write(json.dumps(entry))
+            count += 1
+        f.write("]")
+    return count
+
+
+def _live_names(channels: int, seed: int):
+    """(epg id, name) of every live channel, in catalog order"""
+    for stream in iter_live_streams(random.Random(seed), channels):
+        yield stream["epg_channel_id"], stream["name"]
+
+
+def _write_m3u(path: str, channels: int, seed: int):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("#EXTM3U\n")
+        for stream in iter_live_streams(random.Random(seed), channels):
+            f.write(f'#EXTINF:-1 tvg-id="{stream["epg_channel_id"]}" tvg-name="{stream["name"]}" '
+                    f'tvg-logo="{stream["stream_icon"]}" group-title="Live {stream["category_id"]}",{stream["name"]}\n')
+            f.write(f"http://fake/live/user/pass/{stream['stream_id']}.ts\n")
+
+
+def _write_xmltv(path: str, channels: int, seed: int, epg_mb: float, first_slot: int) -> int:
+    """A guide of about epg_mb megabytes starting at first_slot, returning the programme count"""
+    slots = max(1, int(epg_mb * 1024 * 1024 / PROGRAMME_BYTES / max(channels, 1)))
+    slot_seconds = max(MIN_SLOT_SECONDS, GUIDE_DAYS * 86400 // slots)
+    programmes = 0
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<tv generator-info-name="synthetic">\n')
+        for epg_id, name in _live_names(channels, seed):
+            f.write(f'  <channel id="{epg_id}"><display-name>{name}</display-name>'
+                    f'<icon src="http://logos.example/{epg_id}.png"/></channel>\n')
+        for slot in range(slots):
+            start = time.strftime("%Y%m%d%H%M%S +0000", time.gmtime(first_slot + slot * slot_seconds))
+            stop = time.strftime("%Y%m%d%H%M%S +0000", time.gmtime(first_slot + (slot + 1) * slot_seconds))
+            for c in range(channels):
+                f.write(f'  <programme start="{start}" stop="{stop}" channel="ch{c}.example">'
+                        f'<title lang="en">Programme {slot} on channel {c}</title>'
+                        f'<desc lang="en">A synthetic description that pads the guide out like real listings do.</desc>'
+                        f'<category lang="en">Synthetic</category><episode-num system="onscreen">S1E{slot}</episode-num>'
+                        f'</programme>\n')
+            programmes += channels
+        f.write('</tv>\n')
+    return programmes
+
+
+def sample_channels(channels: int, count: int, seed: int = 1) -> list:
+    """Names of count live channels spread evenly over the catalog, for includes and EPG filters"""
+    step = max(1, channels // max(count, 1))
+    return [name for i, (_, name) in enumerate(_live_names(channels, seed)) if i % step == 0][:count]
+
+
+def generate(data_dir: str, channels: int, vod: int, series: int, epg_mb: float, seed: int = 1) -> dict:
+    """Write the dataset to data_dir unless a matching one is already there; returns its manifest"""
+    first_day = time.strftime("%Y-%m-%d", time.gmtime(time.time() - PAST_DAYS * 86400))
+    params = {"channels": channels, "vod": vod, "series": series, "epg_mb": epg_mb, "seed": seed, "epg_from": first_day}
+    manifest_path = os.path.join(data_dir, MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["params"] == params:
+            return manifest
+    except (OSError, ValueError, KeyError):
+        pass
+
+    os.makedirs(data_dir, exist_ok=True)
+    # The catalogs share one generator, like make_catalogs
+    rng = random.Random(seed)
+    _write_json_array(os.path.join(data_dir, "get_live_streams.json"), iter_live_streams(rng, channels))
+    _write_json_array(os.path.join(data_dir, "get_vod_streams.json"), iter_vod_streams(rng, vod))
+    _write_json_array(os.path.join(data_dir, "get_series.json"), iter_series(rng, series))
+    for action, categories in make_categories().items():
+        _write_json_array(os.path.join(data_dir, f"{action}.json"), categories)
+    _write_m3u(os.path.join(data_dir, "m3u.m3u"), channels, seed)
+    first_slot = calendar.timegm(time.strptime(first_day, "%Y-%m-%d"))
+    programmes = _write_xmltv(os.path.join(data_dir, "epg.xml"), channels, seed, epg_mb, first_slot)
+
+    manifest = {
+        "params": params,
+        "programmes": programmes,
+        "sizes": {name: os.path.getsize(os.path.join(data_dir, name))
+                  for name in sorted(os.listdir(data_dir)) if name != MANIFEST},
+    }
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("data_dir")
+    parser.add_argument("--channels", type=int, default=10000, help="live channels")
+    parser.add_argument("--vod", type=int, default=None, help="VOD streams (default: same as --channels)")
+    parser.add_argument("--series", type=int, default=None, help="series (default: a tenth of --channels)")
+    parser.add_argument("--epg-mb", type=float, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    vod = args.channels if args.vod is None else args.vod
+    series = args.channels // 10 if args.series is None else args.series
+    manifest = generate(args.data_dir, args.channels, vod, series, args.epg_mb, args.seed)
+    for name, size in manifest["sizes"].items():
+        print(f"{name:28} {size / 1024 / 1024:9.1f} MB")
+    print(f"{manifest['programmes']} programmes")
+
+
+if __name__ == "__main__":
+    main()
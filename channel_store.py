@@ -0,0 +1,266 @@
+import hashlib
+import itertools
+import json
+import logging
+import os
+import pickle
+import re
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass
+
+from sqlalchemy import bindparam, delete, func, insert, or_, select, update
+
+from compressed_files import write_compressed_variants
+from filter_engine import ChannelMatcher, language_prefix, split_extinf
+from lineup_cache import filtered_playlist_path, parse_extinf
+from m3u_writer import M3UWriter, iter_m3u_entries
+from metrics import FILTER_CHANNELS, FILTER_DURATION
+from models import Channel, Item, engine
+
+logger = logging.getLogger(__name__)
+
+# Rows per executemany batch; all batches of a refresh share one transaction
+BATCH_SIZE = 5000
+
+# Channel-table writes of concurrent refreshes take turns here rather than
+# queueing on SQLite's lock, where a long wait runs into busy_timeout
+_write_lock = threading.Lock()
+
+_TVG_CHNO_RE = re.compile(r'tvg-chno="([^"]+)"')
+
+
+def entry_hash(extinf: str) -> str:
+    return hashlib.blake2b(extinf.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def filter_digest(item) -> str:
+    """Identifies the filter settings behind the stored filter decisions"""
+    key = json.dumps([item.languages, item.includes, item.excludes])
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _chno(filtered_extinf: str):
+    if filtered_extinf is None:
+        return None
+    match = _TVG_CHNO_RE.search(filtered_extinf.split(",", 1)[0])
+    return match.group(1) if match else None
+
+
+def _batches(rows, size: int = BATCH_SIZE):
+    rows = iter(rows)
+    while batch := list(itertools.islice(rows, size)):
+        yield batch
+
+
+def _language_clause(matcher: ChannelMatcher):
+    """WHERE clause for the language rule, so excluded languages never leave the index"""
+    if not matcher.languages:
+        return None
+    return or_(Channel.language == "", Channel.language.in_(matcher.languages))
+
+
+@dataclass
+class CatalogDiff:
+    added: int = 0
+    removed: int = 0
+    changed: int = 0
+    unchanged: int = 0
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+    def __str__(self) -> str:
+        return f"+{self.added} -{self.removed} ~{self.changed}"
+
+
+@dataclass
+class SyncResult:
+    diff: CatalogDiff
+    total: int
+    kept: int
+
+
+def sync_channels(item: Item, matcher: ChannelMatcher, playlist_path: str) -> SyncResult:
+    """Replace the item's channel rows with the entries of a fetched playlist.
+
+    The new entries are diffed against the stored rows by URL and EXTINF
+    hash. Unchanged entries keep their stored filter decision when the filter
+    settings are the same; only added and changed entries go through the
+    matcher. Parsing and filtering happen before any write: the rows are
+    spooled to a temp file, then swapped in with batched executemany in one
+    short transaction. Nothing is written when nothing passes the filter, so
+    the previous channels (and filtered playlist) stay in place.
+
+    The filtered playlist is re-exported only when its entries changed.
+    """
+    start = time.perf_counter()
+    digest = filter_digest(item)
+    reuse = item.filtered_with == digest
+    diff = CatalogDiff()
+    previous = {}
+    previous_filtered = hashlib.blake2b(digest_size=16)
+    new_filtered = hashlib.blake2b(digest_size=16)
+    counts = {"total": 0, "kept": 0}
+
+    def rows():
+        seen = set()
+        with open(playlist_path, "r", encoding="utf-8") as f:
+            for extinf, url in iter_m3u_entries(f):
+                if "," not in extinf:
+                    continue
+                entry_digest = entry_hash(extinf)
+                old = None
+                if url not in seen:
+                    seen.add(url)
+                    old = previous.pop(url, None)
+                    if old is None:
+                        diff.added += 1
+                    elif old[0] != entry_digest:
+                        diff.changed += 1
+                    else:
+                        diff.unchanged += 1
+                if reuse and old is not None and old[0] == entry_digest:
+                    filtered_extinf = old[1]
+                else:
+                    filtered_extinf = matcher.apply(extinf)
+                if filtered_extinf is not None:
+                    counts["kept"] += 1
+                    new_filtered.update(f"{filtered_extinf}\n{url}\n".encode("utf-8"))
+
+                parsed = parse_extinf(extinf, url)
+                tvg_name, _ = split_extinf(extinf)
+                yield {
+                    "item_id": item.id,
+                    "position": counts["total"],
+                    "stream_id": url.rstrip("/").rsplit("/", 1)[-1].split(".", 1)[0],
+                    "tvg_id": parsed.tvg_id,
+                    "tvg_name": tvg_name,
+                    "name": parsed.display_name,
+                    "norm_name": parsed.norm_name,
+                    "language": language_prefix(tvg_name),
+                    "group_title": parsed.group,
+                    "url": url,
+                    "extinf": extinf,
+                    "digest": entry_digest,
+                    "filtered_extinf": filtered_extinf,
+                    "chno": _chno(filtered_extinf),
+                }
+                counts["total"] += 1
+
+    with engine.connect() as conn:
+        stored = conn.execute(
+            select(Channel.url, Channel.digest, Channel.filtered_extinf)
+            .where(Channel.item_id == item.id)
+            .order_by(Channel.position)
+        )
+        for url, entry_digest, filtered_extinf in stored:
+            previous[url] = (entry_digest, filtered_extinf)
+            if filtered_extinf is not None:
+                previous_filtered.update(f"{filtered_extinf}\n{url}\n".encode("utf-8"))
+
+    with tempfile.TemporaryFile() as spool:
+        for batch in _batches(rows()):
+            pickle.dump(batch, spool, pickle.HIGHEST_PROTOCOL)
+        diff.removed = len(previous)
+
+        if counts["kept"]:
+            spool.seek(0)
+            with _write_lock, engine.begin() as conn:
+                conn.execute(delete(Channel).where(Channel.item_id == item.id))
+                while True:
+                    try:
+                        batch = pickle.load(spool)
+                    except EOFError:
+                        break
+                    conn.execute(insert(Channel), batch)
+                conn.execute(update(Item).where(Item.id == item.id).values(filtered_with=digest))
+
+    logger.info(f"Catalog diff for item {item.id}: {diff.added} added, {diff.removed} removed, "
+                f"{diff.changed} changed, {diff.unchanged} unchanged")
+    FILTER_CHANNELS.inc(counts["total"], stage="sync")
+    FILTER_DURATION.observe(time.perf_counter() - start, stage="sync")
+    result = SyncResult(diff=diff, total=counts["total"], kept=counts["kept"])
+    if result.kept == 0:
+        logger.warning(f"No records matched filter for item {item.id}: languages={item.languages}, includes={item.includes}, excludes={item.excludes}")
+        return result
+
+    filtered_path = filtered_playlist_path(item.id)
+    if new_filtered.digest() == previous_filtered.digest() and os.path.exists(filtered_path):
+        # Leave the file (and its mtime) alone so the lineup cache stays warm
+        logger.info(f"Filtered channels for item {item.id} unchanged ({result.kept} records)")
+    else:
+        export_playlist(item.id, filtered_path, filtered=True)
+    return result
+
+
+def filter_channels(item: Item, matcher: ChannelMatcher) -> SyncResult:
+    """Re-run the filter over every stored channel of the item and export the filtered playlist.
+
+    Returns None when the item has no stored channels. Nothing is changed
+    when no channel passes the filter.
+    """
+    start = time.perf_counter()
+    with engine.connect() as conn:
+        total = conn.execute(select(func.count()).select_from(Channel).where(Channel.item_id == item.id)).scalar()
+        if not total:
+            return None
+
+        query = select(Channel.id, Channel.extinf).where(Channel.item_id == item.id)
+        language_clause = _language_clause(matcher)
+        if language_clause is not None:
+            query = query.where(language_clause)
+        kept = []
+        for channel_id, extinf in conn.execute(query):
+            filtered_extinf = matcher.apply(extinf)
+            if filtered_extinf is not None:
+                kept.append({"channel_id": channel_id, "filtered_extinf": filtered_extinf, "chno": _chno(filtered_extinf)})
+
+    if not kept:
+        return SyncResult(diff=None, total=total, kept=0)
+
+    with _write_lock, engine.begin() as conn:
+        conn.execute(update(Channel).where(Channel.item_id == item.id).values(filtered_extinf=None, chno=None))
+        conn.execute(
+            update(Channel)
+            .where(Channel.id == bindparam("channel_id"))
+            .values(filtered_extinf=bindparam("filtered_extinf"), chno=bindparam("chno")),
+            kept,
+        )
+        conn.execute(update(Item).where(Item.id == item.id).values(filtered_with=filter_digest(item)))
+
+    export_playlist(item.id, filtered_playlist_path(item.id), filtered=True)
+    FILTER_CHANNELS.inc(total, stage="refilter")
+    FILTER_DURATION.observe(time.perf_counter() - start, stage="refilter")
+    return SyncResult(diff=None, total=total, kept=len(kept))
+
+
+def count_filtered(item_id: int) -> int:
+    with engine.connect() as conn:
+        return conn.execute(
+            select(func.count()).select_from(Channel)
+            .where(Channel.item_id == item_id, Channel.filtered_extinf.isnot(None))
+        ).scalar()
+
+
+def export_playlist(item_id: int, path: str, filtered: bool = False) -> M3UWriter:
+    """Write the item's stored channels (or only the filtered ones) to an M3U file and its compressed variants.
+
+    Returns the committed writer, or None when there is nothing to export.
+    """
+    column = Channel.filtered_extinf if filtered else Channel.extinf
+    query = select(column, Channel.url).where(Channel.item_id == item_id).order_by(Channel.position)
+    if filtered:
+        query = query.where(Channel.filtered_extinf.isnot(None))
+    with engine.connect() as conn:
+        rows = conn.execution_options(yield_per=BATCH_SIZE).execute(query)
+        with M3UWriter(path) as out:
+            for extinf, url in rows:
+                out.write_entry(extinf, url)
+            if out.count == 0:
+                out.abort()
+                return None
+    logger.info(f"Exported {out.count} {'filtered ' if filtered else ''}channels of item {item_id} to {path}")
+    write_compressed_variants(path)
+    return out
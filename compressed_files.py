@@ -0,0 +1,63 @@
+import gzip
+import logging
+import os
+import shutil
+
+from atomic_file import AtomicFile
+
+try:
+    import zstandard
+except ImportError:  # optional: only gzip sidecars are written without it
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+COPY_CHUNK = 1024 * 1024
+
+
+def _write_gzip(src, dst):
+    # mtime=0 keeps the output (and its size) identical for identical input
+    with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=GZIP_LEVEL, mtime=0) as out:
+        shutil.copyfileobj(src, out, COPY_CHUNK)
+
+
+def _write_zstd(src, dst):
+    zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(src, dst, read_size=COPY_CHUNK)
+
+
+# Content-Encoding -> (file suffix, writer), in order of preference
+VARIANTS = {"gzip": (".gz", _write_gzip)}
+if zstandard is not None:
+    VARIANTS = {"zstd": (".zst", _write_zstd), **VARIANTS}
+
+
+def variant_path(path: str, encoding: str) -> str:
+    return path + VARIANTS[encoding][0]
+
+
+def write_compressed_variants(path: str):
+    """Write a compressed sidecar of path for every supported encoding.
+
+    Called once after path is committed, so serving never compresses per
+    request. Sidecars are written atomically and are only served while they
+    are newer than path (see fresh_variants).
+    """
+    for encoding, (suffix, writer) in VARIANTS.items():
+        with open(path, "rb") as src, AtomicFile(path + suffix, "wb") as dst:
+            writer(src, dst)
+    logger.info(f"Wrote {', '.join(VARIANTS)} variants of {path}")
+
+
+def fresh_variants(path: str, source_stat: os.stat_result) -> dict:
+    """{encoding: (sidecar path, stat)} for sidecars written after path's current version"""
+    variants = {}
+    for encoding, (suffix, _) in VARIANTS.items():
+        try:
+            stat_result = os.stat(path + suffix)
+        except OSError:
+            continue
+        if stat_result.st_mtime_ns >= source_stat.st_mtime_ns:
+            variants[encoding] = (path + suffix, stat_result)
+    return variants
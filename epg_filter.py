@@ -0,0 +1,180 @@
+import calendar
+import functools
+import gzip
+import logging
+import os
+import time
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+from xml.sax.saxutils import quoteattr
+
+from atomic_file import AtomicFile
+from compressed_files import write_compressed_variants
+from filter_engine import strict_normalize
+
+logger = logging.getLogger(__name__)
+
+
+def _window_setting(name: str, default: str):
+    value = os.getenv(name, default).strip()
+    return float(value) if value else None
+
+
+# Programmes kept around now; empty keeps every programme on that side
+EPG_PAST_HOURS = _window_setting("EPG_PAST_HOURS", "6")
+EPG_FUTURE_DAYS = _window_setting("EPG_FUTURE_DAYS", "7")
+
+
+def programme_window(now: float = None) -> tuple:
+    """(start, end) epoch seconds of the programmes to keep; either may be None, or both (then None)"""
+    if EPG_PAST_HOURS is None and EPG_FUTURE_DAYS is None:
+        return None
+    now = time.time() if now is None else now
+    start = now - EPG_PAST_HOURS * 3600 if EPG_PAST_HOURS is not None else None
+    end = now + EPG_FUTURE_DAYS * 86400 if EPG_FUTURE_DAYS is not None else None
+    return start, end
+
+
+@functools.lru_cache(maxsize=4096)
+def xmltv_timestamp(value: str):
+    """Epoch seconds of an XMLTV "YYYYMMDDhhmmss +zzzz" time, or None when it doesn't parse.
+
+    Cached: a guide repeats the same slot times across all its channels.
+    """
+    try:
+        digits, _, offset = value.strip().partition(" ")
+        ts = calendar.timegm((int(digits[0:4]), int(digits[4:6]), int(digits[6:8]),
+                              int(digits[8:10] or 0), int(digits[10:12] or 0), int(digits[12:14] or 0)))
+        offset = offset.strip()
+        if offset:
+            sign = -1 if offset[0] == "-" else 1
+            ts -= sign * (int(offset[1:3]) * 3600 + int(offset[3:5]) * 60)
+        return ts
+    except (ValueError, IndexError, OverflowError):
+        return None
+
+
+def in_window(programme, window: tuple) -> bool:
+    """Whether a <programme> overlaps window; programmes with unreadable times are kept"""
+    window_start, window_end = window
+    start = xmltv_timestamp(programme.get("start") or "")
+    if start is None:
+        return True
+    if window_end is not None and start >= window_end:
+        return False
+    if window_start is not None:
+        stop = xmltv_timestamp(programme.get("stop") or "")
+        return (stop if stop is not None else start) > window_start
+    return True
+
+
+def find_epg_source(xml_path: str):
+    """Return the newest downloaded guide for xml_path, plain or gzipped, or None"""
+    candidates = [path for path in (xml_path, f"{xml_path}.gz") if os.path.exists(path)]
+    if not candidates:
+        return None
+    return max(candidates, key=os.path.getmtime)
+
+
+def open_epg_source(path: str):
+    """Open a downloaded guide as a binary stream, decompressing .gz on the fly"""
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def filter_epg(src, dst_path: str, keep_channel, window: tuple = None) -> tuple:
+    """Stream an XMLTV guide, keeping channels accepted by keep_channel and their programmes.
+
+    src is a path or binary file object. Top-level <channel> and <programme>
+    elements are written to dst_path as soon as they are parsed and then
+    cleared, so memory stays flat however large the guide is. XMLTV lists all
+    channels before any programme, so a programme is kept when its channel
+    attribute matches an already kept channel and, when a (start, end)
+    window is given, it overlaps the window.
+
+    Returns (channels_kept, programmes_kept). dst_path is only replaced when
+    the whole guide parsed successfully.
+    """
+    channels_kept = 0
+    programmes_kept = 0
+    kept_channel_ids = set()
+
+    with AtomicFile(dst_path, "w") as out:
+        out.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        context = ET.iterparse(src, events=("start", "end"))
+        root = None
+        depth = 0
+        for event, elem in context:
+            if event == "start":
+                if root is None:
+                    root = elem
+                    attrs = "".join(f" {key}={quoteattr(value)}" for key, value in root.attrib.items())
+                    out.write(f"<tv{attrs}>")
+                depth += 1
+                continue
+
+            depth -= 1
+            if depth != 1:
+                continue
+
+            if elem.tag == "channel":
+                if keep_channel(elem):
+                    out.write(ET.tostring(elem, encoding="unicode"))
+                    channels_kept += 1
+                    kept_channel_ids.add(elem.get("id"))
+            elif elem.tag == "programme":
+                if elem.get("channel") in kept_channel_ids and (window is None or in_window(elem, window)):
+                    out.write(ET.tostring(elem, encoding="unicode"))
+                    programmes_kept += 1
+            # Drop the processed element so the tree never grows
+            root.clear()
+
+        if root is None:
+            raise ValueError("EPG file is empty")
+        out.write("</tv>")
+
+    return channels_kept, programmes_kept
+
+
+def display_name_filter(channel_names: set):
+    """keep_channel callback matching the first <display-name> exactly"""
+    def keep_channel(channel) -> bool:
+        display_name_elem = channel.find("display-name")
+        return display_name_elem is not None and display_name_elem.text in channel_names
+    return keep_channel
+
+
+@dataclass(frozen=True)
+class LineupIndex:
+    """The guide ids and normalized names of a lineup, for matching guide channels to it"""
+    tvg_ids: frozenset
+    norm_names: frozenset
+
+    @classmethod
+    def from_channels(cls, channels) -> "LineupIndex":
+        """Index ParsedChannel records, e.g. an item's filtered channels"""
+        return cls(frozenset(ch.tvg_id for ch in channels if ch.tvg_id),
+                   frozenset(ch.norm_name for ch in channels if ch.norm_name))
+
+    def __len__(self) -> int:
+        return len(self.tvg_ids) + len(self.norm_names)
+
+    def keep_channel(self, channel) -> bool:
+        """Match on the channel id (the lineup's GuideSourceID), then on any display name"""
+        if channel.get("id") in self.tvg_ids:
+            return True
+        return any(strict_normalize(elem.text or "") in self.norm_names for elem in channel.iter("display-name"))
+
+
+def filter_epg_file(source_path: str, dst_path: str, channels, window: tuple = None) -> tuple:
+    """filter_epg for a downloaded guide, plus the output's compressed variants.
+
+    channels is a set of exact display names or a LineupIndex. Module-level
+    so it can run in the CPU worker pool.
+    """
+    keep_channel = channels.keep_channel if isinstance(channels, LineupIndex) else display_name_filter(channels)
+    with open_epg_source(source_path) as src:
+        kept = filter_epg(src, dst_path, keep_channel, window)
+    write_compressed_variants(dst_path)
+    return kept
@@ -0,0 +1,95 @@
+import os
+from email.utils import parsedate_to_datetime
+
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+
+from compressed_files import fresh_variants
+
+# Let IPTV players and web-based guide tools fetch playlists and guides cross-origin
+CORS_HEADERS = {"Access-Control-Allow-Origin": "*"}
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag == etag or tag == f"W/{etag}" for tag in candidates)
+
+
+def _not_modified_since(if_modified_since: str, mtime: float) -> bool:
+    if not if_modified_since:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+    # HTTP dates have whole-second resolution
+    return int(mtime) <= since
+
+
+def accepted_encodings(accept_encoding: str) -> dict:
+    """{coding: q} from an Accept-Encoding header; refused codings stay in with q=0 so they override "*" """
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def choose_variant(request: Request, path: str, stat_result: os.stat_result):
+    """The (encoding, path, stat) of the best pre-compressed variant the client accepts, or None"""
+    accepted = accepted_encodings(request.headers.get("accept-encoding"))
+    if not any(q > 0 for q in accepted.values()):
+        return None
+    best = None
+    # Variants come in order of preference, so ties keep the better codec
+    for encoding, (variant, variant_stat) in fresh_variants(path, stat_result).items():
+        q = accepted.get(encoding, accepted.get("*", 0))
+        if q > 0 and (best is None or q > best[0]):
+            best = (q, encoding, variant, variant_stat)
+    return best[1:] if best else None
+
+
+def serve_file(request: Request, path: str, media_type: str, filename: str, headers: dict = None) -> Response:
+    """Serve a file from disk in chunks with validators, 304s and Range support.
+
+    The file is never read into memory: FileResponse streams it (or hands it
+    to the server via pathsend) with Content-Length, ETag and Last-Modified
+    from a single stat, and answers Range / If-Range requests itself. A
+    matching If-None-Match, or If-Modified-Since when no ETag was sent,
+    gets an empty 304. The caller checks that path exists.
+
+    When a fresh compressed sidecar (see compressed_files) matches the
+    client's Accept-Encoding it is sent as-is with Content-Encoding; each
+    variant has its own ETag.
+    """
+    stat_result = os.stat(path)
+    headers = {**(headers or {}), "Vary": "Accept-Encoding"}
+    variant = choose_variant(request, path, stat_result)
+    encoding_headers = {}
+    if variant is not None:
+        encoding, path, stat_result = variant
+        encoding_headers["Content-Encoding"] = encoding
+    response = FileResponse(path, media_type=media_type, filename=filename,
+                            headers={**headers, **encoding_headers}, stat_result=stat_result)
+    if_none_match = request.headers.get("if-none-match")
+    if etag_matches(if_none_match, response.headers["etag"]) or (
+        if_none_match is None and _not_modified_since(request.headers.get("if-modified-since"), stat_result.st_mtime)
+    ):
+        not_modified = {name: response.headers[name] for name in ("etag", "last-modified")}
+        return Response(status_code=304, headers={**not_modified, **headers})
+    return response
@@ -0,0 +1,175 @@
+import logging
+import re
+import unicodedata
+
+logger = logging.getLogger(__name__)
+
+# Suffix variants an include also matches, e.g. "ESPN" also keeps "ESPN HD"
+INCLUDE_SUFFIXES = ("hd", "4k", "fhd", "uhd")
+
+_TVG_NAME_RE = re.compile(r'(?<!\S)tvg-name="([^"]*)"', re.IGNORECASE)
+_TVG_CHNO_RE = re.compile(r'\s*tvg-chno="[^"]*"')
+_NON_ALNUM_RE = re.compile(r'[^a-z0-9]+')
+
+
+def normalize(s: str) -> str:
+    """Lowercase, strip accents and collapse whitespace"""
+    s = s.lower()
+    if s.isascii():
+        # NFKD leaves ASCII untouched, so only whitespace needs collapsing
+        return ' '.join(s.split())
+    s = unicodedata.normalize('NFKD', s.strip())
+    s = ''.join(c for c in s if not unicodedata.combining(c))
+    return ' '.join(s.split())
+
+
+def strict_normalize(s: str) -> str:
+    """normalize() with every non-alphanumeric character removed, for exact name matching"""
+    return _NON_ALNUM_RE.sub('', normalize(s))
+
+
+def language_prefix(name: str) -> str:
+    """The lowercased "XX" of an "XX - Name" style name, or "" when it has none"""
+    if " - " not in name:
+        return ""
+    return name.split(" - ")[0].strip().lower()
+
+
+def _substring_pattern(terms) -> re.Pattern:
+    """Compile substring terms into one trie-shaped regex.
+
+    The regex engine walks the shared prefixes once per position instead of
+    trying every term separately. A term that is a prefix of another already
+    decides the match, so its longer siblings are dropped.
+    """
+    trie = {}
+    for term in terms:
+        node = trie
+        for ch in term:
+            node = node.setdefault(ch, {})
+        node[''] = True
+
+    def emit(node) -> str:
+        if '' in node:
+            return ''
+        alternatives = [re.escape(ch) + emit(child) for ch, child in sorted(node.items())]
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return '(?:' + '|'.join(alternatives) + ')'
+
+    return re.compile(emit(trie))
+
+
+def split_extinf(extinf: str) -> tuple:
+    """Return the lowercased tvg-name (last one wins) and the channel name of an #EXTINF line"""
+    tvg_name = ""
+    if " " in extinf and "," in extinf:
+        attr_part, channel_name = extinf.split(",", 1)
+        names = _TVG_NAME_RE.findall(attr_part)
+        if names:
+            tvg_name = names[-1].lower()
+    else:
+        channel_name = extinf.split(",", 1)[1] if "," in extinf else ""
+    return tvg_name, channel_name
+
+
+class ChannelMatcher:
+    """The languages/includes/excludes of an Item compiled once for filtering.
+
+    apply() returns the EXTINF line to write (with any tvg-chno from the
+    includes applied) or None when the channel is filtered out.
+    """
+
+    def __init__(self, languages: str = None, includes: str = None, excludes: str = None):
+        self.languages = [lang.strip().lower() for lang in (languages or "").split(",") if lang.strip()]
+        self.language_set = frozenset(self.languages)
+
+        # Exact name matching: normalized_name -> channel_number (or None)
+        self.includes_map = {}
+        self.raw_includes = []
+        for inc in (includes or "").split(","):
+            inc = inc.strip()
+            if not inc:
+                continue
+            if '|' in inc:
+                num, name = inc.split('|', 1)
+                self.raw_includes.append((num.strip(), name.strip()))
+                self.includes_map[strict_normalize(name)] = num.strip()
+            else:
+                self.raw_includes.append((None, inc))
+                self.includes_map[strict_normalize(inc)] = None
+
+        # Suffix variants first, so exact keys take precedence over them
+        self.include_lookup = {}
+        for key, num in self.includes_map.items():
+            for suffix in INCLUDE_SUFFIXES:
+                self.include_lookup.setdefault(key + suffix, num)
+        self.include_lookup.update(self.includes_map)
+
+        self.excludes = [ex.strip().lower() for ex in (excludes or "").split(",") if ex.strip()]
+        self.has_wildcard_exclude = "*" in self.excludes
+        exclude_terms = {normalize(ex) for ex in self.excludes}
+        self.exclude_pattern = _substring_pattern(exclude_terms) if exclude_terms and not self.has_wildcard_exclude else None
+
+    def __repr__(self):
+        return (f"ChannelMatcher(languages={self.languages}, includes={self.raw_includes}, "
+                f"excludes={self.excludes}, wildcard_exclude={self.has_wildcard_exclude})")
+
+    def language_allowed(self, name: str) -> bool:
+        """Apply the language rule to an "EN - Name" style name; names without a prefix pass"""
+        if not self.language_set:
+            return True
+        language = language_prefix(name)
+        return not language or language in self.language_set
+
+    def apply(self, extinf: str):
+        tvg_name, channel_name = split_extinf(extinf)
+
+        # 1. Language check (only if the tvg-name carries a language prefix)
+        if not self.language_allowed(tvg_name):
+            return None
+
+        # 2. Include logic (allow-list when provided): exact match after normalization
+        if self.include_lookup:
+            for candidate in (channel_name, tvg_name):
+                key = strict_normalize(candidate)
+                if key in self.include_lookup:
+                    return self._apply_chno(extinf, self.include_lookup[key])
+            return None
+
+        # 3. Exclude logic, only when no includes are given
+        if self.has_wildcard_exclude:
+            return None
+        if self.exclude_pattern is not None and self.exclude_pattern.search(normalize(f"{tvg_name} {channel_name}")):
+            return None
+        return extinf
+
+    @staticmethod
+    def _apply_chno(extinf: str, chno):
+        if not chno:
+            return extinf
+        extinf_new = _TVG_CHNO_RE.sub('', extinf)
+        idx = extinf_new.find(',')
+        if idx != -1:
+            return extinf_new[:idx] + f' tvg-chno="{chno}"' + extinf_new[idx:]
+        return extinf_new + f' tvg-chno="{chno}"'
+
+
+# Compiled matchers by item id, with the filter settings they were built from
+_matchers = {}
+
+
+def get_matcher(item) -> ChannelMatcher:
+    """Return the cached matcher for an Item, compiling it on first use"""
+    key = (item.languages, item.includes, item.excludes)
+    cached = _matchers.get(item.id)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    matcher = ChannelMatcher(item.languages, item.includes, item.excludes)
+    _matchers[item.id] = (key, matcher)
+    logger.info(f"Compiled filter for item {item.id}: {matcher}")
+    return matcher
+
+
+def invalidate_matcher(item_id: int):
+    _matchers.pop(item_id, None)
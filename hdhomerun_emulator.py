@@ -1,17 +1,49 @@
+import asyncio
 import socket
-import threading
-import time
 import logging
-import select
+import random
 import struct
 import os
 import hashlib
+import zlib
 
 logger = logging.getLogger(__name__)
 
+SSDP_ADDR = "239.255.255.250"
+SSDP_PORT = 1900
+SSDP_MAX_AGE = 1800
+# Seconds between ssdp:alive announcements, well inside max-age; the host IP is re-checked at the same time
+SSDP_NOTIFY_INTERVAL = int(os.getenv("HDHR_SSDP_NOTIFY_INTERVAL", "600"))
+# Longest reply delay honoured from an M-SEARCH MX header
+SSDP_MAX_MX = 5
+# Delayed replies allowed to wait at once; further M-SEARCHes are dropped so a flood can't queue unbounded work
+SSDP_MAX_PENDING = 4096
+# Native HDHomeRun discovery (libhdhomerun): a framed TLV packet on UDP 65001.
+# Frame: type (u16 BE), payload length (u16 BE), payload, CRC32 of all before it (u32 LE)
+HDHR_DISCOVER_PORT = 65001
+HDHR_TYPE_DISCOVER_REQ = 0x0002
+HDHR_TYPE_DISCOVER_RPY = 0x0003
+HDHR_TAG_DEVICE_TYPE = 0x01
+HDHR_TAG_DEVICE_ID = 0x02
+HDHR_TAG_TUNER_COUNT = 0x10
+HDHR_TAG_LINEUP_URL = 0x27
+HDHR_TAG_BASE_URL = 0x2A
+HDHR_TAG_DEVICE_AUTH_STR = 0x2B
+HDHR_DEVICE_TYPE_TUNER = 0x00000001
+HDHR_DEVICE_TYPE_WILDCARD = 0xFFFFFFFF
+HDHR_DEVICE_ID_WILDCARD = 0xFFFFFFFF
+# Device types answered besides upnp:rootdevice and the device UUID
+DEVICE_TYPES = [
+    "urn:schemas-upnp-org:device:MediaServer:1",
+    "urn:schemas-upnp-org:device:MediaRenderer:1",
+]
+
 class HDHomeRunEmulator:
-    def __init__(self, http_port=5005, config_items=None):
+    def __init__(self, http_port=5005, config_items=None, ssdp_port=SSDP_PORT, discover_port=HDHR_DISCOVER_PORT):
         self.http_port = http_port
+        self.ssdp_port = ssdp_port
+        self.discover_port = discover_port
+        self.host_ip = self.get_host_ip()
         self.device_id = self._generate_device_id(config_items)
         # Model number configurable via environment variable
         self.model = os.getenv("HDHR_MODEL", "HDHR3-US")
@@ -20,8 +52,16 @@ class HDHomeRunEmulator:
         # Tuner count configurable via environment variable (default 2)
         self.tuner_count = int(os.getenv("HDHR_TUNER_COUNT", "2"))
         self.running = False
-        self.thread = None
-        self._stop_event = threading.Event()
+        self._transport = None
+        self._discover_transport = None
+        self._notify_task = None
+        self._messages_key = None
+        self._messages_cache = None
+        self._pending_replies = 0
+        self.searches_received = 0
+        self.discover_requests = 0
+        self.replies_sent = 0
+        self.replies_dropped = 0
         # Check environment variable for default state, but allow runtime override
         self._env_disabled = os.getenv("HDHR_DISABLE_SSDP", "0") == "1"
         self.ssdp_disabled = self._env_disabled
@@ -32,7 +72,7 @@ class HDHomeRunEmulator:
         if ip_port_tuple:
             ip, port = ip_port_tuple
         else:
-            ip = self.get_host_ip()
+            ip = self.host_ip
             port = self.http_port
         id_source = f"{ip}:{port}"
         hash_obj = hashlib.md5(id_source.encode())
@@ -74,96 +114,188 @@ class HDHomeRunEmulator:
             logger.debug(f"get_host_ip failed: {e}")
             return "127.0.0.1"
     
-    def create_ssdp_response(self):
-        host_ip = self.get_host_ip()
-        base_url = f"http://{host_ip}:{self.http_port}"
-        
-        response = f"""HTTP/1.1 200 OK
-CACHE-CONTROL: max-age=1800
-EXT:
-LOCATION: {base_url}/discover.json
-SERVER: HDHomeRun/1.0 UPnP/1.0
-ST: upnp:rootdevice
-USN: uuid:{self.device_id}::upnp:rootdevice
-BOOTID.UPNP.ORG: 1
-CONFIGID.UPNP.ORG: 1
-DEVICEID.UPNP.ORG: {self.device_id}
-HDHomerun-Device: {self.device_id}
-HDHomerun-Device-Auth: iptv_emulator
-HDHomerun-Features: base
-
-"""
-        return response
-    
-    def handle_ssdp_discovery(self, data, addr, sock):
-        if "M-SEARCH" in data:
-            if any(st in data for st in ["upnp:rootdevice", "ssdp:all", "urn:schemas-upnp-org:device:MediaRenderer:1"]):
-                response = self.create_ssdp_response()
-                try:
-                    sock.sendto(response.encode('utf-8'), addr)
-                except Exception as e:
-                    pass
-    
-    def run_ssdp_server(self):
-        self.running = True
-        sock = None
+    def advertised_base_url(self) -> str:
+        """BaseURL clients should call us on: HDHR_ADVERTISE_HOST/PORT when set (e.g. behind Docker), else the detected IP"""
+        host = os.getenv("HDHR_ADVERTISE_HOST") or os.getenv("PUBLIC_HOST") or self.host_ip
+        scheme = os.getenv("HDHR_SCHEME", "http")
+        port = os.getenv("HDHR_ADVERTISE_PORT") or os.getenv("APP_PORT") or str(self.http_port)
+        return f"{scheme}://{host}:{port}"
+
+    def _location(self, base_url: str) -> str:
+        return f"{base_url}/discover.json"
+
+    def _usn(self, target: str) -> str:
+        device_uuid = f"uuid:{self.device_id}"
+        return device_uuid if target == device_uuid else f"{device_uuid}::{target}"
+
+    def search_targets(self) -> list:
+        """ST / NT values this device answers to and announces"""
+        return ["upnp:rootdevice", f"uuid:{self.device_id}", *DEVICE_TYPES]
+
+    def _messages(self) -> dict:
+        """Cached SSDP packets, rebuilt only when the advertised base URL or device ID changes"""
+        base_url = self.advertised_base_url()
+        key = (base_url, self.device_id)
+        if key != self._messages_key:
+            location = self._location(base_url)
+            responses, alive, byebye = {}, [], []
+            for target in self.search_targets():
+                usn = self._usn(target)
+                responses[target] = _ssdp_packet("HTTP/1.1 200 OK", [
+                    f"CACHE-CONTROL: max-age={SSDP_MAX_AGE}",
+                    "EXT:",
+                    f"LOCATION: {location}",
+                    "SERVER: HDHomeRun/1.0 UPnP/1.0",
+                    f"ST: {target}",
+                    f"USN: {usn}",
+                    "BOOTID.UPNP.ORG: 1",
+                    "CONFIGID.UPNP.ORG: 1",
+                    f"DEVICEID.UPNP.ORG: {self.device_id}",
+                    f"HDHomerun-Device: {self.device_id}",
+                    "HDHomerun-Device-Auth: iptv_emulator",
+                    "HDHomerun-Features: base",
+                ])
+                alive.append(_ssdp_packet("NOTIFY * HTTP/1.1", [
+                    f"HOST: {SSDP_ADDR}:{SSDP_PORT}",
+                    f"CACHE-CONTROL: max-age={SSDP_MAX_AGE}",
+                    f"LOCATION: {location}",
+                    f"NT: {target}",
+                    "NTS: ssdp:alive",
+                    "SERVER: HDHomeRun/1.0 UPnP/1.0",
+                    f"USN: {usn}",
+                    "BOOTID.UPNP.ORG: 1",
+                    "CONFIGID.UPNP.ORG: 1",
+                ]))
+                byebye.append(_ssdp_packet("NOTIFY * HTTP/1.1", [
+                    f"HOST: {SSDP_ADDR}:{SSDP_PORT}",
+                    f"NT: {target}",
+                    "NTS: ssdp:byebye",
+                    f"USN: {usn}",
+                    "BOOTID.UPNP.ORG: 1",
+                    "CONFIGID.UPNP.ORG: 1",
+                ]))
+            self._messages_cache = {
+                "responses": responses,
+                "alive": alive,
+                "byebye": byebye,
+                "discover_reply": self._build_discover_reply(base_url),
+            }
+            self._messages_key = key
+            logger.info(f"SSDP messages built for {location} (device {self.device_id})")
+        return self._messages_cache
+
+    def _build_discover_reply(self, base_url: str) -> bytes:
+        return hdhr_packet(HDHR_TYPE_DISCOVER_RPY, [
+            (HDHR_TAG_DEVICE_TYPE, struct.pack(">I", HDHR_DEVICE_TYPE_TUNER)),
+            (HDHR_TAG_DEVICE_ID, struct.pack(">I", int(self.device_id, 16))),
+            (HDHR_TAG_TUNER_COUNT, struct.pack(">B", self.tuner_count)),
+            (HDHR_TAG_BASE_URL, base_url.encode("utf-8")),
+            (HDHR_TAG_LINEUP_URL, f"{base_url}/lineup.json".encode("utf-8")),
+            (HDHR_TAG_DEVICE_AUTH_STR, b"iptv_emulator"),
+        ])
+
+    def handle_discover_datagram(self, data: bytes, addr):
+        """Answer a libhdhomerun discover request that asks for a tuner, or for this device ID"""
+        packet_type, tags = parse_hdhr_packet(data)
+        if packet_type != HDHR_TYPE_DISCOVER_REQ:
+            return
+        self.discover_requests += 1
+        # A request may repeat a tag, e.g. to ask for tuners and storage devices at once; any match will do
+        device_types = _tag_uint32s(tags, HDHR_TAG_DEVICE_TYPE)
+        if device_types and not device_types & {HDHR_DEVICE_TYPE_TUNER, HDHR_DEVICE_TYPE_WILDCARD}:
+            return
+        device_ids = _tag_uint32s(tags, HDHR_TAG_DEVICE_ID)
+        if device_ids and not device_ids & {int(self.device_id, 16), HDHR_DEVICE_ID_WILDCARD}:
+            return
+        if self._discover_transport is not None:
+            self._discover_transport.sendto(self._messages()["discover_reply"], addr)
+
+    def handle_ssdp_datagram(self, data: bytes, addr):
+        """Answer an M-SEARCH for one of our search targets after a random delay of up to MX seconds"""
+        if not data.startswith(b"M-SEARCH"):
+            return
+        self.searches_received += 1
+        headers = {}
+        for line in data.decode("latin-1").split("\r\n")[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+        if headers.get("man", '"ssdp:discover"').strip('"') != "ssdp:discover":
+            return
+
+        responses = self._messages()["responses"]
+        target = headers.get("st", "")
+        if target == "ssdp:all":
+            replies = list(responses.values())
+        elif target in responses:
+            replies = [responses[target]]
+        else:
+            return
+
+        try:
+            mx = min(max(int(headers.get("mx", "0")), 0), SSDP_MAX_MX)
+        except ValueError:
+            mx = 1
+        if self._pending_replies >= SSDP_MAX_PENDING:
+            self.replies_dropped += 1
+            return
+        self._pending_replies += 1
+        delay = random.uniform(0, mx) if mx else 0
+        asyncio.get_running_loop().call_later(delay, self._send_replies, replies, addr)
+
+    def _send_replies(self, replies: list, addr):
+        self._pending_replies -= 1
+        if self._transport is None:
+            return
+        for reply in replies:
+            self._transport.sendto(reply, addr)
+        self.replies_sent += len(replies)
+
+    def _announce(self, kind: str):
+        if self._transport is None:
+            return
+        for packet in self._messages()[kind]:
+            self._transport.sendto(packet, (SSDP_ADDR, self.ssdp_port))
+
+    async def _notify_loop(self):
+        """Re-check the host IP and multicast ssdp:alive every SSDP_NOTIFY_INTERVAL seconds"""
+        while True:
+            # get_host_ip can block briefly on some platforms
+            self.host_ip = await asyncio.to_thread(self.get_host_ip)
+            self._announce("alive")
+            await asyncio.sleep(SSDP_NOTIFY_INTERVAL)
+
+    def _open_ssdp_socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-            
-            # Set timeout on the socket BEFORE bind to prevent hanging on macOS
-            sock.settimeout(5.0)
-            
-            try:
-                t0 = time.time()
-                logger.info("Attempting to bind to SSDP port 1900 (may take a few seconds on macOS)...")
-                sock.bind(('0.0.0.0', 1900))
-                t1 = time.time()
-                logger.info(f"SSDP socket.bind completed in {t1 - t0:.3f}s")
-            except socket.timeout:
-                logger.error(f"SSDP bind timed out after 5 seconds - HDHomeRun discovery will not work")
-                logger.error("This is a known issue on macOS Docker. The app will continue without SSDP.")
-                # Don't raise - just log and return
-                self.running = False
-                return
-            except Exception as e:
-                logger.error(f"SSDP bind failed: {e}")
-                self.running = False
-                raise
-
-            mreq = struct.pack("4sl", socket.inet_aton("239.255.255.250"), socket.INADDR_ANY)
-            try:
-                t0 = time.time()
-                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-                t1 = time.time()
-                logger.info(f"SSDP setsockopt ADD_MEMBERSHIP completed in {t1 - t0:.3f}s")
-            except Exception as e:
-                logger.error(f"SSDP setsockopt ADD_MEMBERSHIP failed: {e}")
-                # Not fatal; continue but log
+            sock.setblocking(False)
+            sock.bind(("0.0.0.0", self.ssdp_port))
+        except OSError:
+            sock.close()
+            raise
+        mreq = struct.pack("4sl", socket.inet_aton(SSDP_ADDR), socket.INADDR_ANY)
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        except OSError as e:
+            # Not fatal: unicast M-SEARCH still works
+            logger.error(f"SSDP setsockopt ADD_MEMBERSHIP failed: {e}")
+        return sock
 
-            sock.setblocking(0)
+    async def _start_discover_responder(self):
+        """Listen for libhdhomerun discover broadcasts; failure leaves SSDP running on its own"""
+        try:
+            self._discover_transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: DiscoverProtocol(self), local_addr=("0.0.0.0", self.discover_port),
+                allow_broadcast=True,
+            )
+            logger.info(f"HDHomeRun discover responder listening on UDP {self.discover_port}")
+        except OSError as e:
+            logger.error(f"HDHomeRun discover bind on UDP {self.discover_port} failed: {e}")
 
-            while self.running:
-                try:
-                    ready = select.select([sock], [], [], 1.0)
-                    if ready[0]:
-                        data, addr = sock.recvfrom(1024)
-                        self.handle_ssdp_discovery(data.decode('utf-8'), addr, sock)
-                except Exception:
-                    logger.debug("SSDP listen error")
-                    time.sleep(1)
-        except Exception as e:
-            logger.error(f"SSDP server failed: {e}")
-        finally:
-            if sock is not None:
-                try:
-                    sock.close()
-                except Exception:
-                    pass
-    
-    def start(self, force=False):
-        """Start SSDP server. 
+    async def start(self, force=False):
+        """Start the SSDP responder on the running event loop.
         
         Args:
             force: If True, override environment variable setting and try to start anyway
@@ -177,31 +309,134 @@ HDHomerun-Features: base
             logger.warning("Attempting to enable SSDP despite HDHR_DISABLE_SSDP=1 environment variable")
             logger.warning("Note: Port 1900/udp must be exposed in docker-compose.yml for this to work")
         
-        if self.thread is None or not self.thread.is_alive():
-            logger.info("Starting SSDP thread for HDHomeRun emulator")
-            self.ssdp_disabled = False
-            self.thread = threading.Thread(target=self.run_ssdp_server, daemon=True)
-            self.thread.start()
+        if self.is_running():
+            logger.info("SSDP responder already running")
             return True
-        
-        logger.info("SSDP thread already running")
+
+        logger.info(f"Starting SSDP responder for HDHomeRun emulator on UDP {self.ssdp_port}")
+        try:
+            sock = self._open_ssdp_socket()
+            self._transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: SSDPProtocol(self), sock=sock
+            )
+        except OSError as e:
+            logger.error(f"SSDP bind failed: {e} - HDHomeRun discovery will not work")
+            return False
+        await self._start_discover_responder()
+        self.ssdp_disabled = False
+        self.running = True
+        self._notify_task = asyncio.ensure_future(self._notify_loop())
         return True
 
-    def stop(self, timeout: float = 2.0):
-        """Stop the SSDP thread gracefully."""
+    async def stop(self):
+        """Announce ssdp:byebye and close the SSDP socket."""
         try:
-            logger.info("Stopping SSDP thread for HDHomeRun emulator")
+            logger.info("Stopping SSDP responder for HDHomeRun emulator")
             self.running = False
             self.ssdp_disabled = True
-            if self.thread is not None and self.thread.is_alive():
-                self.thread.join(timeout)
+            if self._notify_task is not None:
+                self._notify_task.cancel()
+                await asyncio.gather(self._notify_task, return_exceptions=True)
+                self._notify_task = None
+            if self._transport is not None:
+                self._announce("byebye")
+                self._transport.close()
+                self._transport = None
+            if self._discover_transport is not None:
+                self._discover_transport.close()
+                self._discover_transport = None
             return True
         except Exception as e:
-            logger.error(f"Error stopping SSDP thread: {e}")
+            logger.error(f"Error stopping SSDP responder: {e}")
             return False
 
     def is_running(self) -> bool:
-        """Check if the emulator is running by verifying both the thread state and running flag."""
-        return bool(self.running and self.thread and self.thread.is_alive())
+        """Check if the SSDP responder's socket is open."""
+        return bool(self.running and self._transport is not None)
+
+
+def _hdhr_tlv_length(length: int) -> bytes:
+    # One byte up to 127, else low 7 bits with the high bit set followed by the rest
+    if length <= 0x7F:
+        return bytes([length])
+    return bytes([(length & 0x7F) | 0x80, length >> 7])
+
+
+def hdhr_packet(packet_type: int, tags: list) -> bytes:
+    """Frame (tag, value bytes) pairs as a libhdhomerun packet with its trailing CRC32"""
+    payload = b"".join(bytes([tag]) + _hdhr_tlv_length(len(value)) + value for tag, value in tags)
+    frame = struct.pack(">HH", packet_type, len(payload)) + payload
+    return frame + struct.pack("<I", zlib.crc32(frame))
+
+
+def parse_hdhr_packet(data: bytes):
+    """(packet type, {tag: [values]}) of a libhdhomerun packet, or (None, {}) if it is malformed or fails its CRC"""
+    if len(data) < 8:
+        return None, {}
+    packet_type, length = struct.unpack(">HH", data[:4])
+    if len(data) != 4 + length + 4:
+        return None, {}
+    if struct.unpack("<I", data[-4:])[0] != zlib.crc32(data[:-4]):
+        return None, {}
+    tags = {}
+    payload = data[4:-4]
+    pos = 0
+    while pos + 2 <= len(payload):
+        tag = payload[pos]
+        value_length = payload[pos + 1]
+        pos += 2
+        if value_length & 0x80:
+            if pos >= len(payload):
+                return None, {}
+            value_length = (value_length & 0x7F) | (payload[pos] << 7)
+            pos += 1
+        if pos + value_length > len(payload):
+            return None, {}
+        tags.setdefault(tag, []).append(payload[pos:pos + value_length])
+        pos += value_length
+    if pos != len(payload):
+        return None, {}
+    return packet_type, tags
+
+
+def _tag_uint32s(tags: dict, tag: int) -> set:
+    """The 4-byte values of a parsed tag as integers; values of other lengths are ignored"""
+    return {struct.unpack(">I", value)[0] for value in tags.get(tag, []) if len(value) == 4}
+
+
+def _ssdp_packet(start_line: str, header_lines: list) -> bytes:
+    return ("\r\n".join([start_line, *header_lines]) + "\r\n\r\n").encode("utf-8")
+
+
+class SSDPProtocol(asyncio.DatagramProtocol):
+    """Feeds datagrams from the SSDP socket to the emulator"""
+
+    def __init__(self, emulator: HDHomeRunEmulator):
+        self.emulator = emulator
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            self.emulator.handle_ssdp_datagram(data, addr)
+        except Exception as e:
+            logger.debug(f"Ignoring malformed SSDP datagram from {addr}: {e}")
+
+    def error_received(self, exc):
+        logger.debug(f"SSDP socket error: {exc}")
+
+
+class DiscoverProtocol(asyncio.DatagramProtocol):
+    """Feeds datagrams from the UDP 65001 discover socket to the emulator"""
+
+    def __init__(self, emulator: HDHomeRunEmulator):
+        self.emulator = emulator
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            self.emulator.handle_discover_datagram(data, addr)
+        except Exception as e:
+            logger.debug(f"Ignoring malformed discover packet from {addr}: {e}")
+
+    def error_received(self, exc):
+        logger.debug(f"Discover socket error: {exc}")
 
 hdhomerun_emulator = HDHomeRunEmulator()
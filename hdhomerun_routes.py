@@ -1,14 +1,22 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import JSONResponse, StreamingResponse, RedirectResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse, RedirectResponse, Response
 from sqlalchemy.orm import Session
-from models import get_db, Item
+from models import get_db, Item, SessionLocal
 from hdhomerun_emulator import HDHomeRunEmulator
+from lineup_cache import lineup_cache, LineupSnapshot
+from file_serving import etag_matches
+from metrics import CallbackMetric
+from stream_proxy import PROXY_ENABLED, TunerPool
+from stream_broadcaster import StreamBroadcaster
+from stream_health import HealthProber, health_tracker
 import logging
 import re
 import os
 import requests
 import subprocess
 import json
+import urllib.parse
 from typing import Iterator
 
 logger = logging.getLogger(__name__)
@@ -17,204 +25,116 @@ router = APIRouter()
 # Create emulator instance but don't start it yet
 hdhomerun_emulator = HDHomeRunEmulator()
 
+# Tuner slots enforced by the stream proxy, matching the advertised TunerCount;
+# viewers of the same channel share one upstream and one tuner
+tuner_pool = TunerPool(hdhomerun_emulator.tuner_count)
+broadcaster = StreamBroadcaster(tuner_pool, health_tracker)
+
+# Read from the live objects at scrape time, so nothing is recorded on the hot paths
+CallbackMetric("iptv_lineup_cache_hits_total", "Lineup requests served from the cache",
+               lambda: lineup_cache.hits, kind="counter")
+CallbackMetric("iptv_lineup_cache_misses_total", "Lineup requests that rebuilt the lineup",
+               lambda: lineup_cache.misses, kind="counter")
+CallbackMetric("iptv_lineup_cache_hit_ratio", "Share of lineup requests served from the cache",
+               lambda: lineup_cache.hits / max(lineup_cache.hits + lineup_cache.misses, 1))
+CallbackMetric("iptv_tuners", "Advertised tuners", lambda: tuner_pool.count)
+CallbackMetric("iptv_tuners_in_use", "Tuners held by proxied streams", lambda: tuner_pool.in_use)
+CallbackMetric("iptv_stream_channels", "Channels with an open upstream", lambda: len(broadcaster.channels))
+CallbackMetric("iptv_stream_viewers", "Viewers attached to proxied streams",
+               lambda: sum(channel.viewers for channel in broadcaster.channels.values()))
+CallbackMetric("iptv_stream_bytes_saved_total", "Upstream bytes saved by sharing streams between viewers",
+               lambda: broadcaster.status()["BytesSaved"], kind="counter")
+CallbackMetric("iptv_stream_sources", "Upstream URLs with health measurements", lambda: len(health_tracker.sources))
+CallbackMetric("iptv_stream_sources_unhealthy", "Upstream URLs skipped after repeated failures",
+               health_tracker.unhealthy)
+CallbackMetric("iptv_ssdp_searches_total", "SSDP M-SEARCH packets received",
+               lambda: hdhomerun_emulator.searches_received, kind="counter")
+CallbackMetric("iptv_ssdp_replies_total", "SSDP replies sent",
+               lambda: hdhomerun_emulator.replies_sent, kind="counter")
+CallbackMetric("iptv_ssdp_replies_dropped_total", "M-SEARCHes dropped over the pending reply cap",
+               lambda: hdhomerun_emulator.replies_dropped, kind="counter")
+CallbackMetric("iptv_hdhr_discover_requests_total", "HDHomeRun UDP 65001 discover requests received",
+               lambda: hdhomerun_emulator.discover_requests, kind="counter")
+
 def get_advertised_base_url() -> str:
     """
     Returns the public BaseURL we want Plex to use when calling us.
     Prefer environment variables; fall back to emulator-detected host IP.
+    The same URL goes out in SSDP and UDP discover replies.
     """
-    host = (
-        os.getenv("HDHR_ADVERTISE_HOST")
-        or os.getenv("PUBLIC_HOST")
-        or "127.0.0.1"  # Safe default, will be updated when emulator starts
-    )
-    scheme = os.getenv("HDHR_SCHEME", "http")
-    # Prefer explicit advertised port; otherwise fall back to APP_PORT if provided
-    port = os.getenv("HDHR_ADVERTISE_PORT") or os.getenv("APP_PORT") or "5005"
-    return f"{scheme}://{host}:{port}"
+    return hdhomerun_emulator.advertised_base_url()
 
-def load_channel_lineup(db: Session = Depends(get_db)) -> list:
-    """Load and merge channels from all filtered M3U files with de-duplication and explicit numbering preference"""
-    channels = []
-    # Get ALL items, not just the first one
-    items = db.query(Item).all()
-    if not items:
-        logger.warning("No IPTV configurations found")
-        return channels
+# Advertised base URL the device ID was last derived from
+_device_id_base_url = None
 
-    # Update device ID based on advertised IP/port
-    base_url = get_advertised_base_url()
-    import urllib.parse
+def sync_device_id(base_url: str):
+    """Update device ID based on advertised IP/port, once per distinct base URL"""
+    global _device_id_base_url
+    if base_url == _device_id_base_url:
+        return
     parsed = urllib.parse.urlparse(base_url)
     ip = parsed.hostname or "127.0.0.1"
     port = int(parsed.port) if parsed.port else 5005
     hdhomerun_emulator.update_device_id((ip, port))
+    _device_id_base_url = base_url
 
-    logger.info(f"Loading channels from {len(items)} IPTV configuration(s)")
-
-    # Helpers for name normalization
-    import unicodedata
-    import re as _re
-    def _normalize(s: str) -> str:
-        s = (s or "").lower().strip()
-        s = unicodedata.normalize('NFKD', s)
-        s = ''.join(c for c in s if not unicodedata.combining(c))
-        s = ' '.join(s.split())
-        return s
-    def _strict_norm(s: str) -> str:
-        return _re.sub(r'[^a-z0-9]+', '', _normalize(s))
-
-    # Track used channel numbers to avoid conflicts and deduplicate by name
-    used_guide_numbers = set()
-    next_available_number = 1
-    channels_by_name = {}
-
-    for item in items:
-        filtered_path = os.path.join("/app/m3u_files", f"filtered_playlist_{item.id}.m3u")
-        if not os.path.exists(filtered_path):
-            logger.warning(f"Filtered M3U not found for config '{item.name}' (ID {item.id})")
-            continue
-
-        logger.info(f"Loading channels from '{item.name}' ({filtered_path})")
-
-        with open(filtered_path, 'r') as f:
-            lines = f.readlines()
-
-        i = 0
-        config_channel_count = 0
-
-        while i < len(lines):
-            line = lines[i].strip()
-            if line.startswith('#EXTINF'):
-                if i + 1 < len(lines):
-                    # Parse the EXTINF line
-                    if ',' in line:
-                        attrs, name = line.split(',', 1)
-                        name = name.strip()
-
-                        # Extract metadata
-                        tvg_id = ""
-                        tvg_name = ""
-                        tvg_chno = ""
-                        group = ""
-
-                        id_match = re.search(r'tvg-id="([^"]+)"', attrs)
-                        if id_match:
-                            tvg_id = id_match.group(1)
-
-                        name_match = re.search(r'tvg-name="([^"]+)"', attrs)
-                        if name_match:
-                            tvg_name = name_match.group(1)
-
-                        chno_match = re.search(r'tvg-chno="([^"]+)"', attrs)
-                        if chno_match:
-                            tvg_chno = chno_match.group(1)
-
-                        group_match = re.search(r'group-title="([^"]+)"', attrs)
-                        if group_match:
-                            group = group_match.group(1)
-
-                        # Prefer tvg-name over channel name if available
-                        display_name = tvg_name or name
-                        # Clean up common name issues
-                        display_name = display_name.replace('_', ' ').strip()
-
-                        # Get the URL
-                        url = lines[i + 1].strip()
-
-                        # Determine guide number - prefer explicit tvg-chno when present
-                        explicit_number = False
-                        if tvg_chno:
-                            guide_number = tvg_chno
-                            explicit_number = True
-                        else:
-                            # Find next available sequential number avoiding conflicts
-                            while str(next_available_number) in used_guide_numbers:
-                                next_available_number += 1
-                            guide_number = str(next_available_number)
-                            next_available_number += 1
-
-                        # We'll manage used_guide_numbers when finalizing insert/replace
-
-                        # Add required fields for Plex
-                        channel_data = {
-                            "GuideNumber": guide_number,
-                            "GuideName": display_name,
-                            "GuideSourceID": tvg_id,  # Important for EPG matching
-                            "HD": 1,
-                            "URL": url,
-                            "Favorite": 0,
-                            "DRM": 0,
-                            "VideoCodec": "H264",
-                            "AudioCodec": "AAC",
-                            # Internal flag to prefer channels with explicit numbering
-                            "_ExplicitNumber": 1 if explicit_number else 0
-                        }
-
-                        # Optional group/network info
-                        if group:
-                            channel_data["NetworkName"] = group
-                            channel_data["NetworkAffiliate"] = group
-
-                        # Deduplicate by normalized name; prefer explicit-number entries
-                        norm_name = _strict_norm(display_name)
-                        existing = channels_by_name.get(norm_name)
-                        if existing is None:
-                            channels_by_name[norm_name] = channel_data
-                            used_guide_numbers.add(guide_number)
-                            config_channel_count += 1
-                        else:
-                            if (not existing.get("_ExplicitNumber")) and channel_data.get("_ExplicitNumber"):
-                                # Replace non-explicit with explicit; update used numbers
-                                try:
-                                    used_guide_numbers.discard(existing.get("GuideNumber", ""))
-                                except Exception:
-                                    pass
-                                channels_by_name[norm_name] = channel_data
-                                used_guide_numbers.add(guide_number)
-                            else:
-                                # Keep existing (either both non-explicit or existing already explicit)
-                                pass
-
-                i += 2
-            else:
-                i += 1
+def get_lineup_snapshot(db: Session) -> LineupSnapshot:
+    """Return the cached lineup, rebuilding it only when a playlist or config changed"""
+    items = db.query(Item.id, Item.name, Item.priority).all()
+    if not items:
+        logger.warning("No IPTV configurations found")
 
-        logger.info(f"  Loaded {config_channel_count} channels from '{item.name}'")
+    base_url = get_advertised_base_url()
+    sync_device_id(base_url)
+    return lineup_cache.get([tuple(row) for row in items], base_url, proxy=PROXY_ENABLED)
 
-    # Produce final channel list from dedup map
-    channels = list(channels_by_name.values())
-    # Remove internal flags
-    for ch in channels:
-        if "_ExplicitNumber" in ch:
-            del ch["_ExplicitNumber"]
+def load_lineup_snapshot() -> LineupSnapshot:
+    """get_lineup_snapshot in a short-lived session, for handlers that outlive their request's work"""
+    db = SessionLocal()
+    try:
+        return get_lineup_snapshot(db)
+    finally:
+        db.close()
 
-    logger.info(f"Total: Loaded {len(channels)} channels for HDHomeRun lineup from {len(items)} configuration(s)")
+async def probe_sources() -> dict:
+    """The lineup's failover URLs, for the stream health prober"""
+    snapshot = await run_in_threadpool(load_lineup_snapshot)
+    return snapshot.upstream_urls
 
-    # Log the first few channels for debugging
-    if channels:
-        logger.info("First channel example:")
-        logger.info(json.dumps(channels[0], indent=2))
+# Failover only happens through the stream proxy, so sources are only probed when it's on
+health_prober = HealthProber(health_tracker, probe_sources, broadcaster.upstream_urls)
 
-    return channels
+def load_channel_lineup(db: Session = Depends(get_db)) -> list:
+    """Load and merge channels from all filtered M3U files with de-duplication and explicit numbering preference"""
+    return get_lineup_snapshot(db).channels
 
 @router.on_event("startup")
 async def startup_event():
     logger.info("HDHomeRun emulator lazy-start enabled (will start on first HDHR request)")
-
-def ensure_emulator_started(force=False) -> bool:
-    """Start the emulator thread if it's not already running.
+    if PROXY_ENABLED:
+        health_prober.start()
+
+@router.on_event("shutdown")
+async def shutdown_event():
+    await health_prober.stop()
+    # Tell control points the device is going away
+    if hdhomerun_emulator.is_running():
+        await hdhomerun_emulator.stop()
+
+async def ensure_emulator_started(force=False) -> bool:
+    """Start the emulator's SSDP responder if it's not already running.
     
     Args:
         force: If True, attempt to start even if disabled via environment variable
     """
     try:
         if not hdhomerun_emulator.is_running():
-            logger.info("Starting HDHomeRun emulator thread on demand...")
-            result = hdhomerun_emulator.start(force=force)
+            logger.info("Starting HDHomeRun emulator on demand...")
+            result = await hdhomerun_emulator.start(force=force)
             if result:
-                logger.info("HDHomeRun emulator thread started")
+                logger.info("HDHomeRun emulator started")
             else:
-                logger.warning("HDHomeRun emulator thread failed to start (may be disabled)")
+                logger.warning("HDHomeRun emulator failed to start (may be disabled)")
             return result
         return True
     except Exception as e:
@@ -225,7 +145,7 @@ def ensure_emulator_started(force=False) -> bool:
 async def enable_discovery():
     """Enable HDHomeRun discovery"""
     # Use force=True to override environment variable
-    if ensure_emulator_started(force=True):
+    if await ensure_emulator_started(force=True):
         success_msg = "HDHomeRun discovery enabled successfully"
         if hdhomerun_emulator.is_env_disabled():
             success_msg += " (Note: Port 1900/UDP may not be exposed - check docker-compose.yml)"
@@ -236,7 +156,7 @@ async def enable_discovery():
 async def disable_discovery():
     """Disable HDHomeRun discovery"""
     try:
-        if hdhomerun_emulator.stop():
+        if await hdhomerun_emulator.stop():
             return RedirectResponse(url="/?success=HDHomeRun discovery disabled", status_code=303)
         return RedirectResponse(url="/?error=Failed to stop HDHomeRun emulator", status_code=303)
     except Exception as e:
@@ -261,21 +181,48 @@ async def hdhr_discover():
     }
 
 @router.get("/lineup_status.json")
-async def hdhr_lineup_status(db: Session = Depends(get_db)):
+def hdhr_lineup_status(db: Session = Depends(get_db)):
     """Return scanning status"""
     # Note: SSDP doesn't need to be running for HTTP endpoints to work
-    channels = load_channel_lineup(db)
+    snapshot = get_lineup_snapshot(db)
     return {
         "ScanInProgress": 0,
         "ScanPossible": 1,
         "Source": "Cable",
         "SourceList": ["Cable"],
-        "Found": len(channels)
+        "Found": snapshot.count
     }
 
 @router.get("/lineup.json")
-async def hdhr_lineup(db: Session = Depends(get_db)):
+def hdhr_lineup(request: Request, db: Session = Depends(get_db)):
     """Return channel lineup"""
     # Note: SSDP doesn't need to be running for HTTP endpoints to work
-    channels = load_channel_lineup(db)
-    return channels
+    snapshot = get_lineup_snapshot(db)
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), snapshot.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot.body, media_type="application/json", headers=headers)
+
+@router.get("/auto/v{guide_number}")
+async def hdhr_tune(guide_number: str):
+    """Relay a channel's upstream stream, shared by everyone watching that channel"""
+    # No request-scoped session: it would stay checked out for as long as the stream runs
+    snapshot = await run_in_threadpool(load_lineup_snapshot)
+    urls = snapshot.upstream_urls.get(guide_number)
+    if urls is None:
+        return Response(content="Unknown channel", status_code=404, media_type="text/plain")
+    if not PROXY_ENABLED:
+        # Proxy off: send the client straight to the provider, as the lineup does, without taking a tuner
+        return RedirectResponse(url=urls[0], status_code=302)
+    return await broadcaster.attach(guide_number, urls, f"channel {guide_number}")
+
+@router.get("/stream_status.json")
+async def hdhr_stream_status():
+    """Active proxied channels with their viewer counts and provider bandwidth saved"""
+    return broadcaster.status()
+
+@router.get("/stream_health.json")
+async def hdhr_stream_health(db: Session = Depends(get_db)):
+    """Time to first byte and failure rate of every source of channels with failover URLs"""
+    snapshot = await run_in_threadpool(get_lineup_snapshot, db)
+    return {**health_prober.status(), "Channels": health_tracker.status(snapshot.upstream_urls)}
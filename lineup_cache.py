@@ -0,0 +1,204 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from dataclasses import dataclass
+
+from filter_engine import strict_normalize
+from lineup_merge import Provider, load_guide_numbers, merge_providers, save_guide_numbers
+from models import Channel, SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Playlists and guides; overridable so benchmarks can run against a scratch directory
+M3U_DIR = os.getenv("M3U_DIR", "/app/m3u_files")
+
+_TVG_ID_RE = re.compile(r'tvg-id="([^"]+)"')
+_TVG_NAME_RE = re.compile(r'tvg-name="([^"]+)"')
+_TVG_CHNO_RE = re.compile(r'tvg-chno="([^"]+)"')
+_GROUP_RE = re.compile(r'group-title="([^"]+)"')
+
+
+@dataclass(frozen=True)
+class ParsedChannel:
+    """One entry of a filtered playlist, before guide numbers are assigned"""
+    display_name: str
+    norm_name: str
+    tvg_id: str
+    tvg_chno: str
+    group: str
+    url: str
+
+
+@dataclass(frozen=True)
+class LineupSnapshot:
+    """A built lineup together with its pre-serialized lineup.json body"""
+    channels: list
+    body: bytes
+    etag: str
+    # GuideNumber -> provider URLs, best first, for the stream proxy to fail over through
+    upstream_urls: dict
+
+    @property
+    def count(self) -> int:
+        return len(self.channels)
+
+
+def filtered_playlist_path(item_id: int) -> str:
+    return os.path.join(M3U_DIR, f"filtered_playlist_{item_id}.m3u")
+
+
+def parse_extinf(line: str, url: str) -> ParsedChannel:
+    """Parse an #EXTINF line (which must contain a comma) and its URL"""
+    attrs, name = line.split(',', 1)
+    id_match = _TVG_ID_RE.search(attrs)
+    name_match = _TVG_NAME_RE.search(attrs)
+    chno_match = _TVG_CHNO_RE.search(attrs)
+    group_match = _GROUP_RE.search(attrs)
+    # Prefer tvg-name over channel name if available, and clean up common name issues
+    display_name = ((name_match.group(1) if name_match else "") or name.strip()).replace('_', ' ').strip()
+    return ParsedChannel(
+        display_name=display_name,
+        norm_name=strict_normalize(display_name),
+        tvg_id=id_match.group(1) if id_match else "",
+        tvg_chno=chno_match.group(1) if chno_match else "",
+        group=group_match.group(1) if group_match else "",
+        url=url,
+    )
+
+
+def parse_filtered_playlist(path: str) -> list:
+    """Parse a filtered playlist into ParsedChannel records"""
+    with open(path, 'r') as f:
+        lines = f.readlines()
+
+    channels = []
+    i = 0
+    while i < len(lines):
+        line = lines[i].strip()
+        if line.startswith('#EXTINF'):
+            if i + 1 < len(lines) and ',' in line:
+                channels.append(parse_extinf(line, lines[i + 1].strip()))
+            i += 2
+        else:
+            i += 1
+    return channels
+
+
+def load_filtered_channels(item_id: int) -> list:
+    """The item's filtered channels from the channels table, in playlist order.
+
+    Returns None when the item has no rows yet (playlists fetched before the
+    table existed), so the caller can fall back to the playlist file.
+    """
+    db = SessionLocal()
+    try:
+        if db.query(Channel.id).filter(Channel.item_id == item_id).first() is None:
+            return None
+        rows = (
+            db.query(Channel.name, Channel.norm_name, Channel.tvg_id, Channel.chno, Channel.group_title, Channel.url)
+            .filter(Channel.item_id == item_id, Channel.filtered_extinf.isnot(None))
+            .order_by(Channel.position)
+            .all()
+        )
+    finally:
+        db.close()
+    return [
+        ParsedChannel(display_name=name, norm_name=norm_name, tvg_id=tvg_id or "", tvg_chno=chno or "", group=group or "", url=url)
+        for name, norm_name, tvg_id, chno, group, url in rows
+    ]
+
+
+class LineupCache:
+    """In-process HDHomeRun lineup, rebuilt only when a playlist or config changes.
+
+    Channels come from the channels table (or the filtered playlist for items
+    fetched before it existed). The filtered playlist is re-exported whenever
+    an item's filtered channels change, so the cache key is the advertised
+    base URL plus each item's id, name, priority and filtered playlist mtime/size.
+    Loaded channels are also kept per item, so a change to one provider only
+    reloads that provider's channels. Guide numbers given out by earlier
+    merges are loaded once and kept in step with what each merge saves.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key = None
+        self._snapshot = None
+        self._parsed = {}
+        self._guide_numbers = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _file_key(path: str):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def get(self, items: list, base_url: str, proxy: bool = False) -> LineupSnapshot:
+        """Return the lineup for (id, name, priority) item rows, rebuilding it if anything changed.
+
+        With proxy set, channel URLs point at {base_url}/auto/v{GuideNumber}.
+        """
+        file_keys = tuple((item_id, name, priority or 0, self._file_key(filtered_playlist_path(item_id)))
+                          for item_id, name, priority in items)
+        key = (base_url, proxy, file_keys)
+        with self._lock:
+            if key == self._key and self._snapshot is not None:
+                self.hits += 1
+                return self._snapshot
+            self.misses += 1
+            self._snapshot = self._build(file_keys, base_url if proxy else None)
+            self._key = key
+            return self._snapshot
+
+    def _build(self, file_keys: tuple, proxy_base_url: str = None) -> LineupSnapshot:
+        logger.info(f"Rebuilding channel lineup from {len(file_keys)} IPTV configuration(s)")
+        providers = []
+        parsed_cache = {}
+        for item_id, name, priority, file_key in file_keys:
+            path = filtered_playlist_path(item_id)
+            if file_key is None:
+                logger.warning(f"Filtered M3U not found for config '{name}' (ID {item_id})")
+                continue
+            cached = self._parsed.get(item_id)
+            if cached is not None and cached[0] == file_key:
+                parsed = cached[1]
+            else:
+                logger.info(f"Loading channels for '{name}' (ID {item_id})")
+                parsed = load_filtered_channels(item_id)
+                if parsed is None:
+                    try:
+                        parsed = parse_filtered_playlist(path)
+                    except FileNotFoundError:
+                        logger.warning(f"Filtered M3U disappeared for config '{name}' (ID {item_id})")
+                        continue
+            parsed_cache[item_id] = (file_key, parsed)
+            providers.append(Provider(item_id=item_id, name=name, priority=priority, channels=parsed))
+        # Drop parsed playlists of deleted items
+        self._parsed = parsed_cache
+
+        if self._guide_numbers is None:
+            self._guide_numbers = load_guide_numbers()
+        merged = merge_providers(providers, self._guide_numbers)
+        save_guide_numbers(merged.assigned)
+        self._guide_numbers.update(merged.assigned)
+        channels = merged.channels
+        upstream_urls = merged.failover_urls
+        for ch in channels:
+            if proxy_base_url:
+                ch["URL"] = f"{proxy_base_url}/auto/v{ch['GuideNumber']}"
+        body = json.dumps(channels, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+        etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+        logger.info(f"Total: Loaded {len(channels)} channels for HDHomeRun lineup from {len(file_keys)} configuration(s)")
+        if channels:
+            logger.debug(f"First channel example: {json.dumps(channels[0], indent=2)}")
+        return LineupSnapshot(channels=channels, body=body, etag=etag, upstream_urls=upstream_urls)
+
+
+lineup_cache = LineupCache()
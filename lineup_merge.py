@@ -0,0 +1,145 @@
+import logging
+from dataclasses import dataclass, field
+
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+
+from models import GuideNumber, engine
+
+logger = logging.getLogger(__name__)
+
+# Rows per executemany batch when saving guide numbers
+BATCH_SIZE = 5000
+
+
+@dataclass(frozen=True)
+class Provider:
+    """One item's filtered channels (ParsedChannel records, in playlist order) for merging"""
+    item_id: int
+    name: str
+    priority: int
+    channels: list
+
+
+@dataclass
+class MergeResult:
+    # lineup.json entries, in merge order
+    channels: list
+    # GuideNumber -> URLs of every provider carrying the channel, the lineup's own URL first
+    failover_urls: dict
+    # norm_name -> guide number, for channels whose number is new or changed
+    assigned: dict = field(default_factory=dict)
+
+
+def merge_providers(providers: list, known: dict) -> MergeResult:
+    """Merge providers' channels into one lineup with stable guide numbers.
+
+    Providers are merged in (priority, item_id) order, lower priority first,
+    and channels are de-duplicated by normalized name. The first provider to
+    carry a channel supplies it unless a later one has an explicit tvg-chno;
+    the others' URLs become its failover URLs. The result only depends on the
+    providers' contents, not on the order they are passed in.
+
+    Guide numbers are handed out in three passes, each in merge order:
+    explicit tvg-chno numbers (the first channel to claim a number keeps
+    it), then each remaining channel's number from known (norm_name ->
+    number from earlier merges) unless an explicit number took it, then the
+    lowest numbers not in use and not in known. A channel that drops out
+    and comes back therefore gets its old number, and no number is reused
+    for a different channel. Every pass is a single sweep, so merging is
+    O(channels + known).
+    """
+    # norm_name -> [chosen channel, urls in merge order]
+    groups = {}
+    for provider in sorted(providers, key=lambda p: (p.priority, p.item_id)):
+        added = 0
+        for ch in provider.channels:
+            group = groups.get(ch.norm_name)
+            if group is None:
+                groups[ch.norm_name] = [ch, [ch.url]]
+                added += 1
+                continue
+            if ch.tvg_chno and not group[0].tvg_chno:
+                group[0] = ch
+            group[1].append(ch.url)
+        logger.info(f"  Loaded {added} channels from '{provider.name}'")
+
+    numbers = {}
+    taken = set()
+    for norm_name, (ch, _) in groups.items():
+        if not ch.tvg_chno:
+            continue
+        if ch.tvg_chno in taken:
+            logger.warning(f"Guide number {ch.tvg_chno} of '{ch.display_name}' is already taken, assigning another")
+            continue
+        numbers[norm_name] = ch.tvg_chno
+        taken.add(ch.tvg_chno)
+
+    pending = []
+    for norm_name in groups:
+        if norm_name in numbers:
+            continue
+        number = known.get(norm_name)
+        if number is not None and number not in taken:
+            numbers[norm_name] = number
+            taken.add(number)
+        else:
+            pending.append(norm_name)
+
+    # Numbers of absent channels stay reserved for when they come back. The
+    # counter only moves forward, so the probing is O(channels + known) overall.
+    reserved = taken.union(known.values())
+    next_number = 1
+    for norm_name in pending:
+        while str(next_number) in reserved:
+            next_number += 1
+        numbers[norm_name] = str(next_number)
+        next_number += 1
+
+    channels = []
+    failover_urls = {}
+    assigned = {}
+    for norm_name, (ch, urls) in groups.items():
+        guide_number = numbers[norm_name]
+        if known.get(norm_name) != guide_number:
+            assigned[norm_name] = guide_number
+        # Add required fields for Plex
+        channel_data = {
+            "GuideNumber": guide_number,
+            "GuideName": ch.display_name,
+            "GuideSourceID": ch.tvg_id,  # Important for EPG matching
+            "HD": 1,
+            "URL": ch.url,
+            "Favorite": 0,
+            "DRM": 0,
+            "VideoCodec": "H264",
+            "AudioCodec": "AAC",
+        }
+        # Optional group/network info
+        if ch.group:
+            channel_data["NetworkName"] = ch.group
+            channel_data["NetworkAffiliate"] = ch.group
+        channels.append(channel_data)
+        failover_urls[guide_number] = tuple(dict.fromkeys([ch.url, *urls]))
+
+    return MergeResult(channels=channels, failover_urls=failover_urls, assigned=assigned)
+
+
+def load_guide_numbers() -> dict:
+    """norm_name -> guide number of every channel ever merged"""
+    with engine.connect() as conn:
+        return dict(conn.execute(select(GuideNumber.norm_name, GuideNumber.guide_number)).all())
+
+
+def save_guide_numbers(assigned: dict):
+    """Upsert MergeResult.assigned, so the next merge keeps these numbers"""
+    if not assigned:
+        return
+    rows = [{"norm_name": norm_name, "guide_number": number} for norm_name, number in assigned.items()]
+    stmt = insert(GuideNumber)
+    stmt = stmt.on_conflict_do_update(index_elements=[GuideNumber.norm_name],
+                                      set_={"guide_number": stmt.excluded.guide_number})
+    with engine.begin() as conn:
+        for start in range(0, len(rows), BATCH_SIZE):
+            conn.execute(stmt, rows[start:start + BATCH_SIZE])
+    logger.info(f"Saved {len(assigned)} new guide numbers")
@@ -0,0 +1,76 @@
+from atomic_file import AtomicFile
+
+
+def iter_m3u_entries(lines):
+    """Yield (extinf, url) pairs from an iterable of M3U lines.
+
+    An #EXTINF line is paired with the line right after it unless that line is
+    another directive; anything else is skipped.
+    """
+    pending = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if pending is not None:
+            if not line.startswith('#'):
+                yield pending, line
+                pending = None
+                continue
+            pending = None
+        if line.startswith('#EXTINF'):
+            pending = line
+
+
+class M3UWriter:
+    """Stream M3U entries to a temp file and atomically rename it over the target.
+
+    Entries go straight to disk so memory stays flat regardless of playlist
+    size, and readers never see a half-written playlist:
+
+        with M3UWriter(path) as out:
+            out.write_entry(extinf, url)
+    """
+
+    def __init__(self, path: str, header: str = "#EXTM3U"):
+        self.path = path
+        self.header = header
+        self.count = 0
+        self.lines = 0
+        self._atomic = AtomicFile(path, "w")
+        self._file = None
+
+    def open(self):
+        self._file = self._atomic.open()
+        if self.header:
+            self._file.write(f"{self.header}\n")
+            self.lines = 1
+        return self
+
+    def write_entry(self, extinf: str, url: str):
+        self._file.write(f"{extinf}\n{url}\n")
+        self.count += 1
+        self.lines += 2
+
+    def write_raw(self, text: str):
+        """Write pre-formatted playlist text (e.g. a provider's own M3U)"""
+        self._file.write(text)
+        self.lines += text.count("\n")
+
+    @property
+    def closed(self) -> bool:
+        return self._atomic.closed
+
+    def commit(self):
+        self._atomic.commit()
+
+    def abort(self):
+        """Discard the playlist being written, leaving any existing one untouched"""
+        self._atomic.abort()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
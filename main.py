@@ -2,6 +2,11 @@ from fastapi import FastAPI
 from models import init_db
 from routes import router
 from hdhomerun_routes import router as hdhomerun_router
+from xtream_client import close_clients
+from stream_proxy import close_upstream_client
+from scheduler import refresh_scheduler
+from workers import start_workers, stop_workers
+from metrics import HTTP_REQUEST_DURATION, HTTP_REQUESTS
 
 import logging
 import time
@@ -22,8 +27,18 @@ def create_app():
     async def startup_event():
         # Perform quick startup
         logger.info("Starting application...")
+        start_workers()
         init_db()
         logger.info("Database initialized")
+        refresh_scheduler.start()
+    
+    @app.on_event("shutdown")
+    async def shutdown_event():
+        await refresh_scheduler.stop()
+        # Close pooled provider connections
+        await close_clients()
+        await close_upstream_client()
+        stop_workers()
     
     @app.middleware("http")
     async def log_request_time(request: Request, call_next):
@@ -32,13 +47,20 @@ def create_app():
         # Only log non-static requests to reduce noise
         if not path.startswith(("/static/", "/favicon.ico")):
             logger.info(f"--> START {request.method} {path}")
+        status = 500
         try:
             response = await call_next(request)
+            status = response.status_code
             return response
         finally:
             duration = time.time() - start
             if not path.startswith(("/static/", "/favicon.ico")):
                 logger.info(f"<-- END   {request.method} {path}  duration={duration:.3f}s")
+            # Label by route template (/stream_epg/{item_id}), not raw path, to keep series bounded
+            route = request.scope.get("route")
+            route = route.path if route is not None else "unmatched"
+            HTTP_REQUEST_DURATION.observe(duration, method=request.method, route=route)
+            HTTP_REQUESTS.inc(method=request.method, route=route, status=status)
 
     logger.info("Application initialized, routing configured")
 
@@ -0,0 +1,164 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Prometheus text exposition format, without the client library: recording is
+# a dict update under an uncontended lock, rendering happens only on scrape.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REQUEST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+JOB_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+_registry = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self):
+        """(suffix, label values, extra label, value) tuples"""
+        raise NotImplementedError
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, values, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [("", key, "", value) for key, value in items]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=REQUEST_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (+Inf last), sum]
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                samples.append(("_bucket", key, f'le="{_format_value(bound)}"', cumulative))
+            samples.append(("_sum", key, "", total))
+            samples.append(("_count", key, "", cumulative))
+        return samples
+
+
+class CallbackMetric(_Metric):
+    """A gauge or counter read from existing state at scrape time, costing nothing in between.
+
+    callback returns a number, or a list of (label values tuple, number).
+    """
+
+    def __init__(self, name: str, documentation: str, callback, kind: str = "gauge", labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self.callback = callback
+
+    def samples(self):
+        result = self.callback()
+        if isinstance(result, (int, float)):
+            return [("", (), "", result)]
+        return [("", key, "", value) for key, value in result]
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+HTTP_REQUEST_DURATION = Histogram(
+    "iptv_http_request_duration_seconds", "HTTP request latency by route template", ("method", "route"))
+HTTP_REQUESTS = Counter(
+    "iptv_http_requests_total", "HTTP requests by route template and status", ("method", "route", "status"))
+PROVIDER_FETCH_DURATION = Histogram(
+    "iptv_provider_fetch_duration_seconds", "Provider request duration including retries, by action",
+    ("action",), buckets=JOB_BUCKETS)
+PROVIDER_FETCH_BYTES = Counter(
+    "iptv_provider_fetch_bytes_total", "Bytes received from providers, by action", ("action",))
+FILTER_CHANNELS = Counter(
+    "iptv_filter_channels_total", "Channels run through the filter (sync: fetched playlist, refilter: filter change)",
+    ("stage",))
+FILTER_DURATION = Histogram(
+    "iptv_filter_duration_seconds", "Time spent filtering and storing channels", ("stage",), buckets=JOB_BUCKETS)
+EPG_FILTER_BYTES = Counter(
+    "iptv_epg_filter_bytes_total", "Bytes of downloaded guides parsed by the EPG filter")
+EPG_FILTER_PROGRAMMES = Counter(
+    "iptv_epg_filter_programmes_kept_total", "Programmes written by the EPG filter")
+EPG_FILTER_DURATION = Histogram(
+    "iptv_epg_filter_duration_seconds", "Time spent filtering guides", buckets=JOB_BUCKETS)
+STREAM_PROBES = Counter(
+    "iptv_stream_probes_total", "Background probes of channel sources, by result", ("result",))
+STREAM_TTFB = Histogram(
+    "iptv_stream_ttfb_seconds", "Time to the first stream bytes of a source, from tunes and probes")
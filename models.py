@@ -1,6 +1,6 @@
 import os
 import logging
-from sqlalchemy import create_engine, Column, Integer, String, Boolean
+from sqlalchemy import create_engine, event, Column, Integer, String, Boolean, Text, Float, ForeignKey, Index, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -9,20 +9,39 @@ logger = logging.getLogger(__name__)
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 # Use data directory for database
-DATA_DIR = os.path.join(BASE_DIR, 'data')
+DATA_DIR = os.getenv("DATA_DIR", os.path.join(BASE_DIR, 'data'))
 os.makedirs(DATA_DIR, exist_ok=True)
 DB_PATH = os.path.join(DATA_DIR, 'data.db')
 SQLALCHEMY_DATABASE_URL = f"sqlite:///{DB_PATH}"
 
+# Applied to every new connection. WAL lets lineup reads run while a refresh
+# is writing; synchronous=NORMAL is durable across crashes in WAL mode and
+# only fsyncs at checkpoints.
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "busy_timeout": 5000,  # ms to wait for a writer's lock
+    "cache_size": -65536,  # KiB, i.e. 64 MiB of page cache per connection
+    "mmap_size": 268435456,  # map up to 256 MiB of the file for reads
+    "temp_store": "MEMORY",
+}
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
     connect_args={
         "check_same_thread": False,
         "timeout": 5  # 5 second timeout on connections
     },
-    pool_pre_ping=True,  # Verify connection is still valid before using
-    pool_recycle=3600,  # Recycle connections after 1 hour
 )
+event.listen(engine, "connect", set_sqlite_pragmas)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -37,25 +56,74 @@ class Item(Base):
     includes = Column(String(200), nullable=True)
     excludes = Column(String(200), nullable=True)
     epg_channels = Column(String(1000), nullable=True)
+    refresh_interval = Column(Integer, nullable=True)  # minutes; None uses the default, 0 disables
+    filtered_with = Column(String(32), nullable=True)  # digest of the filter behind channels.filtered_extinf
+    priority = Column(Integer, nullable=True)  # lineup merge order, lower first; None counts as 0
+
+class Channel(Base):
+    """One playlist entry of an item, as fetched, with the item's filter decision"""
+    __tablename__ = "channels"
+    id = Column(Integer, primary_key=True)
+    item_id = Column(Integer, ForeignKey("items.id"), nullable=False)
+    position = Column(Integer, nullable=False)  # order in the provider catalog
+    stream_id = Column(String(50), nullable=True)
+    tvg_id = Column(String(200), nullable=True)
+    tvg_name = Column(String(200), nullable=True)
+    name = Column(String(200), nullable=False)  # display name for the lineup
+    norm_name = Column(String(200), nullable=False)
+    language = Column(String(20), nullable=False)  # tvg-name "XX - " prefix, "" if none
+    group_title = Column(String(200), nullable=True)
+    url = Column(Text, nullable=False)
+    extinf = Column(Text, nullable=False)
+    digest = Column(String(16), nullable=False)  # hash of extinf, for diffing refreshes
+    filtered_extinf = Column(Text, nullable=True)  # NULL when filtered out
+    chno = Column(String(20), nullable=True)  # tvg-chno of filtered_extinf
+
+    __table_args__ = (
+        Index("ix_channels_item_norm_name", "item_id", "norm_name"),
+        Index("ix_channels_item_language", "item_id", "language"),
+        Index("ix_channels_item_position", "item_id", "position"),
+    )
+
+class GuideNumber(Base):
+    """The guide number a channel (by normalized name) was given, kept so rebuilds never renumber it"""
+    __tablename__ = "guide_numbers"
+    norm_name = Column(String(200), primary_key=True)
+    guide_number = Column(String(20), nullable=False)
+
+class CachedResponse(Base):
+    """Latest raw provider response for one request, by the digest of its blob in the response cache"""
+    __tablename__ = "response_cache"
+    key = Column(String(64), primary_key=True)  # request_key(): provider, account and request
+    label = Column(String(200), nullable=False)  # host, username and request, without the password
+    digest = Column(String(64), nullable=False, index=True)  # sha256 of the response body
+    size = Column(Integer, nullable=False)  # bytes of the body
+    stored_size = Column(Integer, nullable=False)  # bytes of the compressed blob
+    fetched_at = Column(Float, nullable=False)  # when the provider last sent or confirmed it
+    used_at = Column(Float, nullable=False)  # last store or replay, for LRU eviction
+
+# Columns added after the first release; create_all doesn't add columns to existing tables
+ADDED_COLUMNS = {
+    "items": {
+        "refresh_interval": "INTEGER",
+        "filtered_with": "VARCHAR(32)",
+        "priority": "INTEGER",
+    },
+}
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        for table, added in ADDED_COLUMNS.items():
+            columns = {row[1] for row in conn.execute(text(f"PRAGMA table_info({table})"))}
+            for column, column_type in added.items():
+                if column not in columns:
+                    logger.info(f"Adding {table}.{column} column")
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}"))
 
 def get_db():
-    db = None
+    db = SessionLocal()
     try:
-        db = SessionLocal()
-        # Test connection immediately using SQLAlchemy text()
-        from sqlalchemy import text
-        db.execute(text("SELECT 1"))
-        yield db
-    except Exception as e:
-        logger.error(f"Database connection error: {e}")
-        if db:
-            db.close()
-        # Return a new session if the first one failed
-        db = SessionLocal()
         yield db
     finally:
-        if db:
-            db.close()
+        db.close()
@@ -0,0 +1,385 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import urllib.parse
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+
+import httpx
+
+from channel_store import CatalogDiff, count_filtered, filter_channels, filter_digest, sync_channels
+from compressed_files import write_compressed_variants
+from epg_filter import LineupIndex, filter_epg_file, find_epg_source, programme_window
+from filter_engine import get_matcher
+from hdhomerun_routes import get_lineup_snapshot
+from lineup_cache import M3U_DIR, filtered_playlist_path, load_filtered_channels, parse_filtered_playlist
+from m3u_writer import M3UWriter
+from metrics import EPG_FILTER_BYTES, EPG_FILTER_DURATION, EPG_FILTER_PROGRAMMES
+from models import Item, SessionLocal
+from workers import run_cpu
+from xtream_client import CATALOG_ACTIONS, CATALOG_FIELDS, get_client, iter_catalog_items
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshError(Exception):
+    """A refresh stage failed; the message is shown to the user as-is"""
+
+
+@dataclass
+class RefreshResult:
+    records: int = 0
+    lines: int = 0
+    source: str = ""
+    playlist_unchanged: bool = False
+    filtered: int = None
+    diff: CatalogDiff = None
+    epg: str = "skipped"
+    epg_error: str = None
+
+    @property
+    def summary(self) -> str:
+        if self.playlist_unchanged:
+            text = f"Playlist unchanged ({self.records} records) from {self.source}"
+        else:
+            text = f"Saved {self.records} records ({self.lines} lines) to M3U file from {self.source}"
+        if self.diff is not None:
+            text += f" ({self.diff})"
+        if self.filtered is not None:
+            text += f", {self.filtered} after filtering"
+        text += f", EPG {self.epg}"
+        return text
+
+
+def playlist_path(item_id: int) -> str:
+    return os.path.join(M3U_DIR, f"xtream_playlist_{item_id}.m3u")
+
+
+def epg_path(item_id: int) -> str:
+    return os.path.join(M3U_DIR, f"epg_{item_id}.xml")
+
+
+def filtered_epg_path(item_id: int) -> str:
+    return os.path.join(M3U_DIR, f"filtered_epg_{item_id}.xml")
+
+
+def load_item(item_id: int) -> Item:
+    """Load an item in a short-lived session, for work done outside a request"""
+    db = SessionLocal()
+    try:
+        item = db.query(Item).filter(Item.id == item_id).first()
+        if item is not None:
+            db.expunge(item)
+        return item
+    finally:
+        db.close()
+
+
+def iter_xtream_entries(server_url: str, username: str, user_pass: str, live_streams, vod_streams, series):
+    """Yield (kind, extinf, url) M3U entries for Xtream catalog items, kind being live, vod or series"""
+    server_url = server_url.rstrip('/')
+    for stream in live_streams:
+        stream_id = stream.get('stream_id')
+        name = stream.get('name', 'Unknown')
+        stream_url = f"{server_url}/live/{username}/{user_pass}/{stream_id}.ts"
+        # The guide's channel id, as in the panel's own m3u_plus output, so guides and lineups match by tvg-id
+        yield "live", f"#EXTINF:-1 tvg-id=\"{stream.get('epg_channel_id') or ''}\" tvg-name=\"{name}\" tvg-logo=\"{stream.get('stream_icon', '')}\" group-title=\"{stream.get('category_name', 'Live')}\", {name}", stream_url
+
+    for stream in vod_streams:
+        stream_id = stream.get('stream_id')
+        name = stream.get('name', 'Unknown')
+        stream_url = f"{server_url}/movie/{username}/{user_pass}/{stream_id}.mp4"
+        yield "vod", f"#EXTINF:-1 tvg-id=\"{stream.get('stream_id', '')}\" tvg-name=\"{name}\" tvg-logo=\"{stream.get('stream_icon', '')}\" group-title=\"{stream.get('category_name', 'VOD')}\", {name}", stream_url
+
+    for serie in series:
+        series_id = serie.get('series_id')
+        name = serie.get('name', 'Unknown')
+        stream_url = f"{server_url}/series/{username}/{user_pass}/{series_id}.m3u8"
+        yield "series", f"#EXTINF:-1 tvg-id=\"{series_id}\" tvg-name=\"{name}\" tvg-logo=\"{serie.get('cover', '')}\" group-title=\"Series\", {name}", stream_url
+
+
+def _fingerprint(item: Item, chunks) -> str:
+    """Digest of the provider response plus everything else that shapes the playlist"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps([item.server_url, item.username, item.user_pass]).encode("utf-8"))
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _iter_file_chunks(files, size: int = 1024 * 1024):
+    for f in files:
+        f.seek(0)
+        while chunk := f.read(size):
+            yield chunk
+        f.seek(0)
+
+
+async def fetch_playlist(item: Item, result: RefreshResult, fingerprints: dict, manual: bool = False):
+    """Fetch the provider catalog into xtream_playlist_{id}.m3u.
+
+    Uses player_api when it works and falls back to get.php. When the
+    provider's response matches fingerprints["playlist"] and the playlist is
+    still on disk, the file is left alone and result.playlist_unchanged is set.
+    Otherwise the playlist replaces the item's rows in the channels table,
+    diffed against them and filtered incrementally (result.diff, result.filtered).
+    A manual refresh asks the provider even when its cached responses are fresh.
+    """
+    client = get_client(item.server_url, item.username, item.user_pass, use_ttl=not manual)
+    logger.info(f"Attempting Xtream API auth: {client.api_url}?username={urllib.parse.quote(item.username)}")
+    m3u_file_path = playlist_path(item.id)
+    have_playlist = os.path.exists(m3u_file_path)
+    result.source = "Xtream API"
+    try:
+        user_data = await client.authenticate()
+        logger.info(f"Xtream API auth response: {json.dumps(user_data, indent=2)[:500]}")
+        logger.info(f"Authenticated with Xtream Codes for user {item.username}")
+
+        # Download the three catalogs concurrently, then decode them item by item
+        # straight into the playlist so no catalog is ever held in memory whole
+        start = time.time()
+        catalog_files = await client.download_catalogs()
+        try:
+            files = [catalog_files[action] for action in CATALOG_ACTIONS]
+            fingerprint = await asyncio.to_thread(_fingerprint, item, _iter_file_chunks(files))
+            if have_playlist and fingerprint == fingerprints.get("playlist"):
+                logger.info(f"Xtream catalogs for item {item.id} unchanged since last refresh")
+                result.playlist_unchanged = True
+                result.records = fingerprints.get("records", 0)
+                return
+
+            def write_playlist():
+                # Every entry is kept: the raw playlist mirrors the provider, and the
+                # filter decides per entry, since an entry's own name may pass where
+                # its category's language prefix would not
+                catalogs = [iter_catalog_items(catalog_files[action], CATALOG_FIELDS[action]) for action in CATALOG_ACTIONS]
+                counts = {"live": 0, "vod": 0, "series": 0}
+                with M3UWriter(m3u_file_path) as out:
+                    for kind, extinf, url in iter_xtream_entries(item.server_url, item.username, item.user_pass, *catalogs):
+                        out.write_entry(extinf, url)
+                        counts[kind] += 1
+                write_compressed_variants(m3u_file_path)
+                return counts, out.lines, sync_channels(item, get_matcher(item), m3u_file_path)
+            counts, result.lines, synced = await asyncio.to_thread(write_playlist)
+        finally:
+            for f in catalog_files.values():
+                f.close()
+
+        result.records = sum(counts.values())
+        logger.info(f"Fetched {counts['live']} live streams, {counts['vod']} VOD streams, {counts['series']} series (total: {result.records}) in {time.time() - start:.3f}s")
+
+    except (httpx.HTTPError, ValueError) as e:
+        logger.warning(f"Xtream API failed for item {item.id}: {str(e)}, falling back to M3U URL")
+        result.source = "M3U URL"
+
+        logger.info(f"Attempting M3U fetch from: {client.server_url}/get.php")
+        try:
+            m3u_content = await client.fetch_m3u()
+            logger.debug(f"M3U response content (first 200 chars): {m3u_content[:200]}")
+        except httpx.HTTPError as e:
+            response_text = e.response.text[:500] if isinstance(e, httpx.HTTPStatusError) else 'No response text'
+            logger.error(f"Failed to fetch M3U for item {item.id}: {str(e)}, response text: {response_text}")
+            raise RefreshError(f"Failed to fetch M3U: {str(e)}") from e
+
+        if not m3u_content.startswith("#EXTM3U"):
+            logger.warning(f"Invalid M3U content received for item {item.id}: {m3u_content[:100]}")
+            raise RefreshError("Invalid M3U content from provider")
+
+        result.records = len(re.findall(r'^#EXTINF', m3u_content, re.MULTILINE))
+        fingerprint = _fingerprint(item, [m3u_content.encode("utf-8")])
+        if have_playlist and fingerprint == fingerprints.get("playlist"):
+            logger.info(f"M3U for item {item.id} unchanged since last refresh")
+            result.playlist_unchanged = True
+            return
+        # The provider's playlist is stored verbatim
+        def write_playlist():
+            with M3UWriter(m3u_file_path, header=None) as out:
+                out.write_raw(m3u_content)
+            write_compressed_variants(m3u_file_path)
+            return sync_channels(item, get_matcher(item), m3u_file_path)
+        synced = await asyncio.to_thread(write_playlist)
+        result.lines = len(m3u_content.splitlines())
+        del m3u_content
+
+    result.diff = synced.diff
+    result.filtered = synced.kept
+    if synced.kept:
+        fingerprints["playlist"] = fingerprint
+        fingerprints["records"] = result.records
+    else:
+        # Nothing was committed, so the next refresh has to sync whatever it fetches
+        fingerprints.pop("playlist", None)
+    logger.info(f"Generated and saved {result.source} playlist for item {item.id} ({result.records} records, {result.lines} lines) at {m3u_file_path}")
+
+
+def filter_playlist(item: Item) -> tuple:
+    """Re-filter the item's stored channels and export filtered_playlist_{id}.m3u.
+
+    Returns (records kept, input records, file lines). Items fetched before
+    the channels table existed are imported from their playlist first. An
+    empty result keeps the previous filtered playlist and raises RefreshError.
+    """
+    matcher = get_matcher(item)
+    logger.info(f"Filtering item {item.id} with {matcher}")
+
+    result = filter_channels(item, matcher)
+    if result is None:
+        m3u_path = playlist_path(item.id)
+        if not os.path.exists(m3u_path):
+            logger.warning(f"M3U file not found for item {item.id} at {m3u_path}")
+            raise RefreshError("M3U file not found, fetch M3U first")
+        logger.info(f"Importing {m3u_path} into the channels table")
+        result = sync_channels(item, matcher, m3u_path)
+
+    if result.kept == 0:
+        logger.warning(f"No records matched filter for item {item.id}: languages={item.languages}, includes={item.includes}, excludes={item.excludes}")
+        raise RefreshError("No records matched the filter criteria.")
+
+    total_lines = 1 + 2 * result.kept
+    # Log both input and output record counts
+    logger.info(
+        f"Filtered M3U for item {item.id}: input records={result.total}, "
+        f"written records={result.kept}, file lines={total_lines}, path={filtered_playlist_path(item.id)}"
+    )
+    return result.kept, result.total, total_lines
+
+
+def epg_channel_set(item: Item):
+    """The item's guide channels: its EPG channel names, or else a LineupIndex of its filtered channels"""
+    if item.epg_channels:
+        return {name.strip() for name in item.epg_channels.split(",") if name.strip()}
+    channels = load_filtered_channels(item.id)
+    if channels is None and os.path.exists(filtered_playlist_path(item.id)):
+        channels = parse_filtered_playlist(filtered_playlist_path(item.id))
+    return LineupIndex.from_channels(channels or [])
+
+
+def epg_filter_key(channels, window: tuple) -> str:
+    """What the filtered guide depends on besides the download, to skip re-filtering when unchanged"""
+    if isinstance(channels, LineupIndex):
+        names = sorted(channels.tvg_ids) + ["|"] + sorted(channels.norm_names)
+    else:
+        names = sorted(channels)
+    key = hashlib.sha256("\n".join(names).encode("utf-8")).hexdigest()[:32]
+    # The window moves with time; re-filter at least once a day to drop past programmes
+    if window is not None and window[0] is not None:
+        key += f"|{int(window[0] // 86400)}"
+    return key
+
+
+async def filter_item_epg(item: Item, channels=None, window: tuple = None) -> tuple:
+    """Filter the downloaded guide down to the item's channels in the CPU worker pool.
+
+    Guide channels are matched by the item's EPG channel names when it has
+    any, otherwise by the tvg-ids and names of its filtered channels, so the
+    guide covers exactly the lineup. Only programmes overlapping window (see
+    programme_window) are kept, or all of them when it is None. channels
+    defaults to epg_channel_set(item).
+
+    Returns (channels kept, programmes kept), or None when there is nothing to filter.
+    """
+    if channels is None:
+        channels = await asyncio.to_thread(epg_channel_set, item)
+    if not channels:
+        logger.info(f"No EPG channels specified or filtered for item {item.id}")
+        return None
+
+    source_path = find_epg_source(epg_path(item.id))
+    if source_path is None:
+        logger.warning(f"EPG file not found for item {item.id} in {M3U_DIR}")
+        return None
+
+    if isinstance(channels, LineupIndex):
+        logger.info(f"Filtering EPG for the lineup's {len(channels.tvg_ids)} guide ids and {len(channels.norm_names)} names")
+    else:
+        logger.info(f"Filtering EPG for {len(channels)} channel names: {list(channels)[:10]}")
+
+    # Stream the original EPG straight into the filtered file
+    start = time.perf_counter()
+    channels_kept, programmes_kept = await run_cpu(filter_epg_file, source_path, filtered_epg_path(item.id), channels, window)
+    EPG_FILTER_DURATION.observe(time.perf_counter() - start)
+    EPG_FILTER_BYTES.inc(os.path.getsize(source_path))
+    EPG_FILTER_PROGRAMMES.inc(programmes_kept)
+
+    logger.info(f"EPG filtering kept {channels_kept} channels and {programmes_kept} programmes")
+    return channels_kept, programmes_kept
+
+
+async def refresh_epg(item: Item, result: RefreshResult, fingerprints: dict, manual: bool = False):
+    """Download the provider guide and re-filter it when it or the channel list changed"""
+    client = get_client(item.server_url, item.username, item.user_pass, use_ttl=not manual)
+    try:
+        changed = await client.download_epg(epg_path(item.id))
+    except (httpx.HTTPError, ValueError) as e:
+        result.epg_error = f"Failed to fetch EPG: {str(e)}"
+        result.epg = "failed"
+        logger.warning(result.epg_error)
+        return
+    if changed:
+        logger.info(f"Saved EPG for item {item.id}")
+    else:
+        logger.info(f"EPG for item {item.id} unchanged, kept existing file")
+    result.epg = "updated" if changed else "unchanged"
+
+    channels = await asyncio.to_thread(epg_channel_set, item)
+    window = programme_window()
+    filter_key = epg_filter_key(channels, window)
+    if not changed and fingerprints.get("epg_filter") == filter_key and os.path.exists(filtered_epg_path(item.id)):
+        return
+    try:
+        kept = await filter_item_epg(item, channels, window)
+    except (OSError, SyntaxError, ValueError, BrokenProcessPool) as e:
+        # ElementTree's ParseError is a SyntaxError; BrokenProcessPool means the worker died mid-filter
+        result.epg_error = f"Failed to filter EPG: {str(e)}"
+        logger.warning(result.epg_error)
+        return
+    if kept is not None:
+        fingerprints["epg_filter"] = filter_key
+        result.epg += f", {kept[0]} guide channels kept"
+
+
+def rebuild_lineup():
+    """Build the lineup snapshot (queries, M3U parsing, guide number upserts); blocking"""
+    db = SessionLocal()
+    try:
+        get_lineup_snapshot(db)
+    finally:
+        db.close()
+
+
+async def refresh_item(item_id: int, fingerprints: dict, manual: bool = False) -> RefreshResult:
+    """Run fetch -> filter -> EPG -> lineup rebuild for one item.
+
+    fingerprints carries what the previous run saw, so unchanged stages are
+    skipped; it is updated in place. manual marks a user-initiated refresh,
+    which never takes provider responses from the cache just because they
+    are younger than its TTL (see xtream_client.get_client).
+    """
+    item = await asyncio.to_thread(load_item, item_id)
+    if item is None:
+        raise RefreshError("Item not found")
+
+    result = RefreshResult()
+    await fetch_playlist(item, result, fingerprints, manual)
+
+    # A fetched playlist has already been diffed and filtered incrementally;
+    # an unchanged one only needs filtering again if the filter changed
+    if result.filtered == 0:
+        raise RefreshError("No records matched the filter criteria.")
+    if result.filtered is None:
+        if item.filtered_with == filter_digest(item) and os.path.exists(filtered_playlist_path(item.id)):
+            result.filtered = await asyncio.to_thread(count_filtered, item.id)
+        else:
+            result.filtered, _, _ = await asyncio.to_thread(filter_playlist, item)
+
+    await refresh_epg(item, result, fingerprints, manual)
+
+    # Rebuild the lineup now rather than on the next tuner request
+    await asyncio.to_thread(rebuild_lineup)
+
+    logger.info(f"Refreshed item {item_id}: {result.summary}")
+    return result
@@ -0,0 +1,269 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib.parse
+from dataclasses import dataclass
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.sqlite import insert
+
+from metrics import CallbackMetric
+from models import DATA_DIR, CachedResponse, engine
+
+try:
+    import zstandard
+except ImportError:  # optional: blobs are gzipped without it
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Compressed size the cache is kept under, least recently used responses going first; 0 disables it
+CACHE_MB = float(os.getenv("RESPONSE_CACHE_MB", "2048"))
+# Responses younger than this are replayed instead of asking the provider again
+TTL_MINUTES = float(os.getenv("RESPONSE_CACHE_TTL_MINUTES", "30"))
+# Never contact providers: every request is answered from the cache, whatever its age
+OFFLINE = os.getenv("RESPONSE_CACHE_OFFLINE", "0") == "1"
+CACHE_DIR = os.getenv("RESPONSE_CACHE_DIR", os.path.join(DATA_DIR, "response_cache"))
+
+# Fast levels: blobs are written on the refresh path
+GZIP_LEVEL = 1
+ZSTD_LEVEL = 3
+COPY_CHUNK = 1024 * 1024
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+@dataclass(frozen=True)
+class CacheEntry:
+    key: str
+    label: str
+    digest: str
+    size: int
+    stored_size: int
+    fetched_at: float
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+
+def request_key(server_url: str, username: str, password: str, name: str) -> str:
+    """Cache key of one provider request; name is the player_api action, "auth", "m3u" or "epg" """
+    return hashlib.sha256(json.dumps([server_url.rstrip('/'), username, password, name]).encode("utf-8")).hexdigest()
+
+
+def request_label(server_url: str, username: str, name: str) -> str:
+    """What the key stands for, without the password"""
+    return f"{urllib.parse.urlsplit(server_url).netloc} {username} {name}"
+
+
+class ResponseCache:
+    """Raw provider responses, stored compressed and content-addressed on disk.
+
+    Each request key (see request_key) points at the sha256 of its latest
+    response body in the response_cache table; bodies live in
+    blobs/<2 hex>/<sha256><suffix>, so identical responses (the same panel
+    seen through two accounts, or an unchanged catalog) are stored once.
+    Blobs are zstd-compressed when zstandard is installed, gzip otherwise,
+    and bodies that are already gzip are stored as-is. Once the blobs
+    outgrow max_bytes the least recently used keys are dropped, along with
+    the blobs nothing else points at.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.replays = 0
+
+    def _blob_path(self, digest: str, suffix: str) -> str:
+        return os.path.join(self.directory, "blobs", digest[:2], digest + suffix)
+
+    def _find_blob(self, digest: str):
+        for suffix in (".zst", ".gz", ""):
+            path = self._blob_path(digest, suffix)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def lookup(self, key: str):
+        """The CacheEntry for key, or None"""
+        with engine.connect() as conn:
+            row = conn.execute(select(CachedResponse).where(CachedResponse.key == key)).first()
+        if row is None:
+            return None
+        return CacheEntry(key=row.key, label=row.label, digest=row.digest, size=row.size,
+                          stored_size=row.stored_size, fetched_at=row.fetched_at)
+
+    def is_fresh(self, entry: CacheEntry) -> bool:
+        return entry.age < self.ttl
+
+    def open(self, entry: CacheEntry):
+        """The cached body as a binary stream, or None when its blob is gone"""
+        path = self._find_blob(entry.digest)
+        if path is None:
+            return None
+        with engine.begin() as conn:
+            conn.execute(update(CachedResponse).where(CachedResponse.key == entry.key).values(used_at=time.time()))
+        if path.endswith(".zst"):
+            return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+        if path.endswith(".gz"):
+            return gzip.open(path, "rb")
+        return open(path, "rb")
+
+    def read_into(self, entry: CacheEntry, fileobj) -> bool:
+        """Replace fileobj's contents with the cached body, leaving it at 0; False when the blob is gone"""
+        src = self.open(entry)
+        if src is None:
+            return False
+        with src:
+            fileobj.seek(0)
+            fileobj.truncate()
+            shutil.copyfileobj(src, fileobj, COPY_CHUNK)
+        fileobj.seek(0)
+        return True
+
+    def _write_blob(self, fileobj) -> tuple:
+        """Hash and compress fileobj into a temp blob in one pass: (digest, size, temp path, suffix)"""
+        fileobj.seek(0)
+        first = fileobj.read(len(GZIP_MAGIC))
+        fileobj.seek(0)
+        digest = hashlib.sha256()
+        size = 0
+        directory = os.path.join(self.directory, "blobs")
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".blob.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw:
+                if first == GZIP_MAGIC:
+                    suffix, out = "", raw
+                elif zstandard is not None:
+                    suffix, out = ".zst", zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(raw, closefd=False)
+                else:
+                    suffix, out = ".gz", gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=GZIP_LEVEL, mtime=0)
+                while chunk := fileobj.read(COPY_CHUNK):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    out.write(chunk)
+                if out is not raw:
+                    out.close()
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        fileobj.seek(0)
+        return digest.hexdigest(), size, tmp_path, suffix
+
+    def store(self, key: str, label: str, fileobj) -> CacheEntry:
+        """Cache fileobj's contents as the latest response for key, leaving fileobj at 0"""
+        digest, size, tmp_path, suffix = self._write_blob(fileobj)
+        now = time.time()
+        with self._lock:
+            existing = self._find_blob(digest)
+            if existing is None:
+                path = self._blob_path(digest, suffix)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+                existing = path
+            else:
+                os.unlink(tmp_path)
+            stored_size = os.path.getsize(existing)
+            previous = self.lookup(key)
+            values = {"key": key, "label": label, "digest": digest, "size": size, "stored_size": stored_size,
+                      "fetched_at": now, "used_at": now}
+            stmt = insert(CachedResponse).values(**values)
+            stmt = stmt.on_conflict_do_update(index_elements=[CachedResponse.key], set_=values)
+            with engine.begin() as conn:
+                conn.execute(stmt)
+            if previous is not None and previous.digest != digest:
+                self._drop_unreferenced([previous.digest])
+            self._evict()
+        logger.info(f"Cached {label} ({size} bytes, {stored_size} stored)")
+        return CacheEntry(key=key, label=label, digest=digest, size=size, stored_size=stored_size, fetched_at=now)
+
+    def refresh(self, key: str):
+        """Mark key's response as just confirmed by the provider (e.g. a 304), restarting its TTL"""
+        now = time.time()
+        with engine.begin() as conn:
+            conn.execute(update(CachedResponse).where(CachedResponse.key == key).values(fetched_at=now, used_at=now))
+
+    def _drop_unreferenced(self, digests: list):
+        with engine.connect() as conn:
+            referenced = set(conn.execute(
+                select(CachedResponse.digest).where(CachedResponse.digest.in_(digests))).scalars())
+        for digest in set(digests) - referenced:
+            path = self._find_blob(digest)
+            if path is not None:
+                os.unlink(path)
+
+    def _evict(self):
+        """Drop least recently used keys until the blobs fit in max_bytes"""
+        with engine.connect() as conn:
+            rows = conn.execute(select(CachedResponse.key, CachedResponse.digest, CachedResponse.stored_size)
+                                .order_by(CachedResponse.used_at)).all()
+        blob_sizes = {digest: stored_size for _, digest, stored_size in rows}
+        total = sum(blob_sizes.values())
+        if total <= self.max_bytes:
+            return
+        refs = {}
+        for _, digest, _ in rows:
+            refs[digest] = refs.get(digest, 0) + 1
+        dropped_keys, dropped_digests = [], []
+        for key, digest, _ in rows:
+            if total <= self.max_bytes:
+                break
+            dropped_keys.append(key)
+            refs[digest] -= 1
+            if refs[digest] == 0:
+                dropped_digests.append(digest)
+                total -= blob_sizes[digest]
+        with engine.begin() as conn:
+            conn.execute(delete(CachedResponse).where(CachedResponse.key.in_(dropped_keys)))
+        self._drop_unreferenced(dropped_digests)
+        logger.info(f"Evicted {len(dropped_keys)} cached responses, {total} bytes left")
+
+    def total_bytes(self) -> int:
+        with engine.connect() as conn:
+            sizes = conn.execute(select(CachedResponse.digest, func.max(CachedResponse.stored_size))
+                                 .group_by(CachedResponse.digest)).all()
+        return sum(size for _, size in sizes)
+
+    def status(self) -> dict:
+        with engine.connect() as conn:
+            rows = conn.execute(select(CachedResponse).order_by(CachedResponse.label)).all()
+        now = time.time()
+        return {
+            "Offline": OFFLINE,
+            "TTLMinutes": self.ttl / 60,
+            "MaxBytes": self.max_bytes,
+            "StoredBytes": sum({row.digest: row.stored_size for row in rows}.values()),
+            "Hits": self.hits,
+            "Misses": self.misses,
+            "Replays": self.replays,
+            "Responses": [{
+                "Request": row.label,
+                "Digest": row.digest,
+                "Bytes": row.size,
+                "StoredBytes": row.stored_size,
+                "AgeSeconds": round(now - row.fetched_at),
+                "Fresh": now - row.fetched_at < self.ttl,
+            } for row in rows],
+        }
+
+
+response_cache = ResponseCache(CACHE_DIR, int(CACHE_MB * 1024 * 1024), TTL_MINUTES * 60) if CACHE_MB > 0 else None
+
+if response_cache is not None:
+    CallbackMetric("iptv_response_cache_bytes", "Compressed size of the provider response cache",
+                   response_cache.total_bytes)
+    CallbackMetric("iptv_response_cache_requests_total", "Provider requests by cache outcome (hit: fresh, "
+                   "miss: fetched, replay: stale response served offline or after a failed request)",
+                   lambda: [(("hit",), response_cache.hits), (("miss",), response_cache.misses),
+                            (("replay",), response_cache.replays)], kind="counter", labelnames=("result",))
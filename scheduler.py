@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass, field
+
+from fastapi.concurrency import run_in_threadpool
+
+from models import Item, SessionLocal
+from pipeline import RefreshError, playlist_path, refresh_item
+
+logger = logging.getLogger(__name__)
+
+# Default minutes between refreshes; an item's own refresh_interval overrides it, 0 disables
+REFRESH_INTERVAL_MINUTES = int(os.getenv("REFRESH_INTERVAL_MINUTES", "720"))
+# Each interval is stretched or shrunk by up to this fraction so items don't refresh in lockstep
+REFRESH_JITTER = float(os.getenv("REFRESH_JITTER", "0.1"))
+# Items refreshed at the same time; requests to each provider host are limited separately (xtream_client)
+# and channel-table writes take turns (channel_store), so only downloads and parsing overlap
+REFRESH_CONCURRENCY = int(os.getenv("REFRESH_CONCURRENCY", "8"))
+# Items that have never been fetched are spread over this many seconds after startup
+STARTUP_SPREAD_SECONDS = 60
+TICK_SECONDS = 30
+
+
+@dataclass
+class RefreshJob:
+    """Schedule and last outcome of one item's refresh"""
+    item_id: int
+    name: str
+    interval: int = None  # seconds, None when scheduled refreshes are off
+    state: str = "idle"  # idle, queued or running
+    manual: bool = False  # the queued or running refresh was asked for by a user
+    next_run: float = None
+    last_started: float = None
+    last_finished: float = None
+    last_ok: bool = None
+    last_message: str = ""
+    last_diff: dict = None  # added/removed/changed/unchanged streams of the last fetch
+    # What the previous run saw, so unchanged stages are skipped
+    fingerprints: dict = field(default_factory=dict)
+
+    def to_dict(self) -> dict:
+        return {
+            "item_id": self.item_id,
+            "name": self.name,
+            "state": self.state,
+            "interval_minutes": self.interval // 60 if self.interval else 0,
+            "next_run": self.next_run,
+            "last_started": self.last_started,
+            "last_finished": self.last_finished,
+            "last_ok": self.last_ok,
+            "last_message": self.last_message,
+            "last_diff": self.last_diff,
+        }
+
+
+def item_interval(refresh_interval) -> int:
+    """Seconds between refreshes for an item's refresh_interval column, or None"""
+    minutes = REFRESH_INTERVAL_MINUTES if refresh_interval is None else refresh_interval
+    return minutes * 60 if minutes > 0 else None
+
+
+def load_schedules() -> list:
+    """(id, name, refresh_interval) of every item; blocking"""
+    db = SessionLocal()
+    try:
+        return db.query(Item.id, Item.name, Item.refresh_interval).all()
+    finally:
+        db.close()
+
+
+def jittered(interval: int) -> float:
+    return interval * (1 + random.uniform(-REFRESH_JITTER, REFRESH_JITTER))
+
+
+class RefreshScheduler:
+    """Runs the refresh pipeline for every item on its interval, and on demand.
+
+    Jobs live in memory: after a restart each item is next due one interval
+    after its playlist was last written.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self._tasks = {}
+        self._semaphore = None
+        self._loop_task = None
+
+    def start(self):
+        self._semaphore = asyncio.Semaphore(REFRESH_CONCURRENCY)
+        self._loop_task = asyncio.ensure_future(self._run())
+        logger.info(f"Refresh scheduler started (default interval {REFRESH_INTERVAL_MINUTES} min, concurrency {REFRESH_CONCURRENCY})")
+
+    async def stop(self):
+        tasks = [t for t in (self._loop_task, *self._tasks.values()) if t is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._loop_task = None
+        self._tasks.clear()
+
+    def _first_run(self, item_id: int, interval: int) -> float:
+        try:
+            return os.path.getmtime(playlist_path(item_id)) + jittered(interval)
+        except OSError:
+            return time.time() + random.uniform(0, STARTUP_SPREAD_SECONDS)
+
+    async def sync_items(self):
+        """Pick up added, renamed, re-scheduled and deleted items"""
+        rows = await run_in_threadpool(load_schedules)
+        seen = set()
+        for item_id, name, refresh_interval in rows:
+            seen.add(item_id)
+            interval = item_interval(refresh_interval)
+            job = self.jobs.get(item_id)
+            if job is None:
+                job = self.jobs[item_id] = RefreshJob(item_id=item_id, name=name)
+                job.interval = interval
+                job.next_run = self._first_run(item_id, interval) if interval else None
+                continue
+            job.name = name
+            if interval != job.interval:
+                job.interval = interval
+                base = job.last_finished or time.time()
+                job.next_run = base + jittered(interval) if interval else None
+        for item_id in set(self.jobs) - seen:
+            del self.jobs[item_id]
+
+    async def _run(self):
+        while True:
+            try:
+                await self.sync_items()
+                now = time.time()
+                for job in list(self.jobs.values()):
+                    if job.next_run is not None and job.next_run <= now and job.state == "idle":
+                        await self.enqueue(job.item_id)
+            except Exception as e:
+                logger.error(f"Refresh scheduler tick failed: {e}")
+            await asyncio.sleep(TICK_SECONDS)
+
+    async def enqueue(self, item_id: int, manual: bool = False) -> bool:
+        """Queue a refresh of item_id; False if one is already queued or running.
+
+        Manual refreshes ("Refresh Now", "Refresh All") skip cached provider
+        responses that are still within their TTL.
+        """
+        job = self.jobs.get(item_id)
+        if job is None:
+            await self.sync_items()
+            job = self.jobs.get(item_id)
+            if job is None:
+                raise KeyError(item_id)
+        if job.state != "idle":
+            return False
+        job.state = "queued"
+        job.manual = manual
+        self._tasks[item_id] = asyncio.ensure_future(self._execute(job))
+        return True
+
+    async def enqueue_all(self, manual: bool = False) -> tuple:
+        """Queue a refresh of every item; returns the names queued and those already queued or running"""
+        await self.sync_items()
+        queued, busy = [], []
+        for job in sorted(self.jobs.values(), key=lambda j: j.item_id):
+            (queued if await self.enqueue(job.item_id, manual) else busy).append(job.name)
+        return queued, busy
+
+    async def _execute(self, job: RefreshJob):
+        try:
+            async with self._semaphore:
+                job.state = "running"
+                job.last_started = time.time()
+                logger.info(f"Refreshing item {job.item_id} ('{job.name}')")
+                try:
+                    result = await refresh_item(job.item_id, job.fingerprints, job.manual)
+                    job.last_ok = result.epg_error is None
+                    job.last_message = result.summary
+                    job.last_diff = result.diff.to_dict() if result.diff else None
+                    if result.epg_error:
+                        job.last_message += f" ({result.epg_error})"
+                except RefreshError as e:
+                    job.last_ok = False
+                    job.last_message = str(e)
+                except Exception as e:
+                    logger.error(f"Refresh of item {job.item_id} failed: {str(e)}")
+                    job.last_ok = False
+                    job.last_message = f"Refresh failed: {str(e)}"
+        finally:
+            job.state = "idle"
+            job.last_finished = time.time()
+            job.next_run = job.last_finished + jittered(job.interval) if job.interval else None
+            self._tasks.pop(job.item_id, None)
+
+    def status(self) -> list:
+        return [job.to_dict() for job in sorted(self.jobs.values(), key=lambda j: j.item_id)]
+
+
+refresh_scheduler = RefreshScheduler()
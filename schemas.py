@@ -11,6 +11,7 @@ class ItemBase(BaseModel):
     includes: str | None = None
     excludes: str | None = None
     epg_channels: str | None = None 
+    refresh_interval: int | None = None
 
 class ItemCreate(ItemBase):
     pass
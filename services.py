@@ -1,16 +1,17 @@
 # services.py
 import logging
 from sqlalchemy.orm import Session
-from models import Item
+from models import Channel, Item
+from filter_engine import invalidate_matcher
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # services.py
-def create_item(db: Session, name: str, server_url: str, username: str, user_pass: str, languages: str, includes: str, excludes: str, epg_channels: str):
+def create_item(db: Session, name: str, server_url: str, username: str, user_pass: str, languages: str, includes: str, excludes: str, epg_channels: str, refresh_interval: int = None, priority: int = None):
     try:
-        db_item = Item(name=name, server_url=server_url, username=username, user_pass=user_pass, languages=languages, includes=includes, excludes=excludes, epg_channels=epg_channels)
+        db_item = Item(name=name, server_url=server_url, username=username, user_pass=user_pass, languages=languages, includes=includes, excludes=excludes, epg_channels=epg_channels, refresh_interval=refresh_interval, priority=priority)
         db.add(db_item)
         db.commit()
         db.refresh(db_item)
@@ -21,7 +22,7 @@ def create_item(db: Session, name: str, server_url: str, username: str, user_pas
         db.rollback()
         return None
 
-def update_item(db: Session, item_id: int, name: str, server_url: str, username: str, user_pass: str, languages: str, includes: str, excludes: str, epg_channels: str):
+def update_item(db: Session, item_id: int, name: str, server_url: str, username: str, user_pass: str, languages: str, includes: str, excludes: str, epg_channels: str, refresh_interval: int = None, priority: int = None):
     try:
         db_item = db.query(Item).filter(Item.id == item_id).first()
         if db_item:
@@ -33,8 +34,12 @@ def update_item(db: Session, item_id: int, name: str, server_url: str, username:
             db_item.includes = includes
             db_item.excludes = excludes
             db_item.epg_channels = epg_channels  # New field
+            db_item.refresh_interval = refresh_interval
+            db_item.priority = priority
             db.commit()
             db.refresh(db_item)
+            # Filter settings may have changed, recompile on next use
+            invalidate_matcher(item_id)
             logger.info(f"Updated item with id {item_id} to name '{name}'")
             return db_item
         logger.warning(f"Item with id {item_id} not found for update")
@@ -48,8 +53,10 @@ def delete_item(db: Session, item_id: int):
     try:
         db_item = db.query(Item).filter(Item.id == item_id).first()
         if db_item:
+            db.query(Channel).filter(Channel.item_id == item_id).delete(synchronize_session=False)
             db.delete(db_item)
             db.commit()
+            invalidate_matcher(item_id)
             logger.info(f"Deleted item with id {item_id}")
             return True
         logger.warning(f"Item with id {item_id} not found for deletion")
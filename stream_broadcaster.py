@@ -0,0 +1,226 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import httpx
+from fastapi.responses import Response, StreamingResponse
+
+from stream_health import HealthTracker
+from stream_proxy import CHUNK_SIZE, TunerPool, open_upstream, tuners_busy_response, upstream_unavailable_response
+
+logger = logging.getLogger(__name__)
+
+# Recent upstream chunks kept per channel; new viewers start from the oldest one
+BUFFER_CHUNKS = int(os.getenv("HDHR_STREAM_BUFFER_CHUNKS", "16"))
+# Seconds an upstream stays open after its last viewer leaves, so a quick re-tune reuses it
+GRACE_SECONDS = float(os.getenv("HDHR_STREAM_GRACE_SECONDS", "10"))
+# A viewer that falls behind the ring buffer more often than this is disconnected
+MAX_RESYNCS = int(os.getenv("HDHR_STREAM_MAX_RESYNCS", "3"))
+
+
+class ChannelBroadcast:
+    """One upstream stream shared by every viewer of a channel.
+
+    A pump task reads the upstream into a ring buffer of sequence-numbered
+    chunks at the upstream's own pace. Each viewer follows the buffer with
+    its own cursor, so a slow viewer never holds up the others: when it
+    falls off the end of the buffer it skips ahead to the oldest chunk still
+    held (chunks are whole TS packets, so the stream stays aligned).
+
+    urls are the channel's sources in priority order. They are tried
+    fastest healthy source first, per the health tracker, and the first one
+    that answers is used; its time to first byte, or its failure, is fed
+    back to the tracker.
+    """
+
+    def __init__(self, key: str, urls: tuple, label: str, on_close, health: HealthTracker):
+        self.key = key
+        self.urls = tuple(urls)
+        self.url = None
+        self.label = label
+        self._health = health
+        self._started = None
+        self._on_close = on_close
+        self._buffer = deque(maxlen=BUFFER_CHUNKS)
+        self._next_seq = 0
+        self._cond = asyncio.Condition()
+        self._upstream = None
+        self._pump_task = None
+        self._close_task = None
+        self.done = False
+        self.viewers = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Bytes sent to a viewer that another viewer had already been sent,
+        # i.e. provider traffic a separate connection would have cost
+        self.bytes_saved = 0
+        self.resyncs = 0
+        self.dropped = 0
+        self.opened = asyncio.ensure_future(self._open())
+
+    async def _open(self) -> bool:
+        for i, url in enumerate(self._health.order(self.urls)):
+            self._started = time.perf_counter()
+            self._upstream = await open_upstream(url, self.label)
+            if self._upstream is not None:
+                self.url = url
+                if i:
+                    logger.info(f"Failed over to source {i + 1} of {len(self.urls)} for {self.label}")
+                break
+            self._health.record_failure(url)
+        if self._upstream is None:
+            await self.close()
+            return False
+        self._pump_task = asyncio.ensure_future(self._pump())
+        # Covers a viewer that disconnects before it starts reading
+        self._close_task = asyncio.ensure_future(self._close_after_grace())
+        return True
+
+    async def _pump(self):
+        try:
+            async for chunk in self._upstream.aiter_raw(CHUNK_SIZE):
+                if not self.bytes_in:
+                    self._health.record_success(self.url, time.perf_counter() - self._started)
+                self.bytes_in += len(chunk)
+                async with self._cond:
+                    # [chunk, already sent to some viewer]
+                    self._buffer.append([chunk, False])
+                    self._next_seq += 1
+                    self._cond.notify_all()
+            logger.info(f"Upstream ended for {self.label}")
+            if not self.bytes_in:
+                self._health.record_failure(self.url)
+        except httpx.HTTPError as e:
+            logger.warning(f"Upstream stream error on {self.label}: {e}")
+            if not self.bytes_in:
+                self._health.record_failure(self.url)
+        finally:
+            self._pump_task = None
+            await self.close()
+
+    async def close(self):
+        """Stop the upstream and release its tuner; viewers drain what is buffered"""
+        if self.done:
+            return
+        self.done = True
+        if self._close_task is not None and self._close_task is not asyncio.current_task():
+            self._close_task.cancel()
+        pump = self._pump_task
+        if pump is not None and pump is not asyncio.current_task():
+            pump.cancel()
+            await asyncio.gather(pump, return_exceptions=True)
+        if self._upstream is not None:
+            await self._upstream.aclose()
+        async with self._cond:
+            self._cond.notify_all()
+        self._on_close(self)
+
+    async def _close_after_grace(self):
+        await asyncio.sleep(GRACE_SECONDS)
+        if self.viewers == 0:
+            logger.info(f"No viewers left on {self.label}, closing upstream")
+            await self.close()
+
+    def _has_data(self, seq: int) -> bool:
+        return seq < self._next_seq or self.done
+
+    async def stream(self):
+        """Async generator of TS chunks for one viewer"""
+        self.viewers += 1
+        if self._close_task is not None:
+            self._close_task.cancel()
+            self._close_task = None
+        seq = self._next_seq - len(self._buffer)
+        resyncs = 0
+        try:
+            while True:
+                async with self._cond:
+                    await self._cond.wait_for(lambda: self._has_data(seq))
+                if seq >= self._next_seq:
+                    break
+                oldest = self._next_seq - len(self._buffer)
+                if seq < oldest:
+                    resyncs += 1
+                    self.resyncs += 1
+                    if resyncs > MAX_RESYNCS:
+                        self.dropped += 1
+                        logger.warning(f"Dropping slow viewer of {self.label} after {MAX_RESYNCS} resyncs")
+                        break
+                    logger.info(f"Viewer of {self.label} fell behind by {oldest - seq} chunks, resyncing")
+                    seq = oldest
+                entry = self._buffer[seq - oldest]
+                chunk = entry[0]
+                if entry[1]:
+                    self.bytes_saved += len(chunk)
+                else:
+                    entry[1] = True
+                seq += 1
+                self.bytes_out += len(chunk)
+                yield chunk
+        finally:
+            self.viewers -= 1
+            if self.viewers == 0 and not self.done:
+                self._close_task = asyncio.ensure_future(self._close_after_grace())
+
+    def status(self) -> dict:
+        return {
+            "Channel": self.label,
+            "Viewers": self.viewers,
+            "BytesIn": self.bytes_in,
+            "BytesOut": self.bytes_out,
+            "BytesSaved": self.bytes_saved,
+            "Resyncs": self.resyncs,
+            "DroppedViewers": self.dropped,
+        }
+
+
+class StreamBroadcaster:
+    """Shares one upstream (and one tuner) per channel across all of its viewers"""
+
+    def __init__(self, tuners: TunerPool, health: HealthTracker):
+        self.tuners = tuners
+        self.health = health
+        self.channels = {}
+        # Savings of channels that have already closed
+        self.closed_bytes_saved = 0
+
+    def _channel_closed(self, channel: ChannelBroadcast):
+        if self.channels.get(channel.key) is channel:
+            del self.channels[channel.key]
+        self.closed_bytes_saved += channel.bytes_saved
+        self.tuners.release()
+        logger.info(f"Released tuner for {channel.label} ({self.tuners.in_use}/{self.tuners.count} tuners in use)")
+
+    async def attach(self, key: str, urls: tuple, label: str) -> Response:
+        """Return a streaming response for key, opening its upstream from urls if nobody is watching it"""
+        channel = self.channels.get(key)
+        if channel is None or channel.done or channel.urls != tuple(urls):
+            if not self.tuners.try_acquire():
+                logger.warning(f"All {self.tuners.count} tuners busy, rejecting {label}")
+                return tuners_busy_response()
+            channel = ChannelBroadcast(key, urls, label, self._channel_closed, self.health)
+            self.channels[key] = channel
+            logger.info(f"Tuned {label} ({self.tuners.in_use}/{self.tuners.count} tuners in use)")
+        else:
+            logger.info(f"Sharing the open upstream of {label}")
+
+        if not await asyncio.shield(channel.opened):
+            return upstream_unavailable_response()
+        return StreamingResponse(channel.stream(), media_type="video/mp2t", headers={"Cache-Control": "no-cache"})
+
+    def upstream_urls(self) -> list:
+        """URLs open (or, while a channel is still tuning, being tried) for viewers"""
+        return [url for channel in self.channels.values() if not channel.done
+                for url in ((channel.url,) if channel.url else channel.urls)]
+
+    def status(self) -> dict:
+        channels = [channel.status() for channel in self.channels.values()]
+        return {
+            "TunerCount": self.tuners.count,
+            "TunersInUse": self.tuners.in_use,
+            "Viewers": sum(ch["Viewers"] for ch in channels),
+            "BytesSaved": self.closed_bytes_saved + sum(ch["BytesSaved"] for ch in channels),
+            "Channels": channels,
+        }
@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import os
+import time
+import urllib.parse
+from dataclasses import dataclass
+
+import httpx
+
+from metrics import STREAM_PROBES, STREAM_TTFB
+from stream_proxy import CHUNK_SIZE, get_upstream_client
+from xtream_client import get_limiter
+
+logger = logging.getLogger(__name__)
+
+# Minutes between background probes of channels with more than one source, 0 disables
+PROBE_INTERVAL_MINUTES = float(os.getenv("HDHR_HEALTH_PROBE_MINUTES", "30"))
+# Sources probed at the same time
+PROBE_CONCURRENCY = int(os.getenv("HDHR_HEALTH_PROBE_CONCURRENCY", "4"))
+# A probe that hasn't received stream data after this many seconds counts as a failure
+PROBE_TIMEOUT = 10.0
+# Weight of the newest measurement in the moving averages
+EWMA_ALPHA = 0.3
+# After this many failures in a row a source is skipped until RETRY_SECONDS have passed
+MAX_FAILURES = 2
+RETRY_SECONDS = 300
+# Seconds added to a source's score at a 100% failure rate, so flaky sources lose to slower steady ones
+FAILURE_PENALTY_SECONDS = 10.0
+
+
+@dataclass
+class SourceHealth:
+    """Moving averages of one upstream URL's time to first byte and failure rate"""
+    ttfb: float = None  # seconds to the first stream bytes
+    failure_rate: float = 0.0
+    attempts: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    last_checked: float = None
+
+    def healthy(self, now: float) -> bool:
+        return self.consecutive_failures < MAX_FAILURES or now - self.last_checked >= RETRY_SECONDS
+
+    def score(self):
+        """Expected seconds to start streaming, None when it never has"""
+        if self.ttfb is None:
+            return None
+        return self.ttfb + self.failure_rate * FAILURE_PENALTY_SECONDS
+
+
+class HealthTracker:
+    """Health of every upstream URL, fed by tunes and background probes"""
+
+    def __init__(self):
+        self.sources = {}
+
+    def _get(self, url: str) -> SourceHealth:
+        health = self.sources.get(url)
+        if health is None:
+            health = self.sources[url] = SourceHealth()
+        return health
+
+    def record_success(self, url: str, ttfb: float):
+        health = self._get(url)
+        health.ttfb = ttfb if health.ttfb is None else EWMA_ALPHA * ttfb + (1 - EWMA_ALPHA) * health.ttfb
+        health.failure_rate *= 1 - EWMA_ALPHA
+        health.attempts += 1
+        health.consecutive_failures = 0
+        health.last_checked = time.time()
+        STREAM_TTFB.observe(ttfb)
+
+    def record_failure(self, url: str):
+        health = self._get(url)
+        health.failure_rate = EWMA_ALPHA + (1 - EWMA_ALPHA) * health.failure_rate
+        health.attempts += 1
+        health.failures += 1
+        health.consecutive_failures += 1
+        health.last_checked = time.time()
+
+    def order(self, urls: tuple) -> tuple:
+        """urls with the fastest healthy source first.
+
+        Healthy sources with measurements come first, fastest score first,
+        then unmeasured ones, then those that keep failing. Ties keep the
+        given (priority) order.
+        """
+        now = time.time()
+
+        def key(url):
+            health = self.sources.get(url)
+            if health is None:
+                return (False, True, 0.0)
+            score = health.score()
+            return (not health.healthy(now), score is None, score or 0.0)
+
+        return tuple(sorted(urls, key=key))
+
+    def unhealthy(self) -> int:
+        now = time.time()
+        return sum(1 for health in self.sources.values() if not health.healthy(now))
+
+    def prune(self, urls: set):
+        """Forget URLs that are no longer in the lineup"""
+        for url in set(self.sources) - urls:
+            del self.sources[url]
+
+    def status(self, failover_urls: dict) -> list:
+        """Per-channel health of every source, for channels with more than one"""
+        now = time.time()
+        channels = []
+        for guide_number, urls in failover_urls.items():
+            if len(urls) < 2:
+                continue
+            preferred = self.order(urls)[0]
+            sources = []
+            for i, url in enumerate(urls):
+                health = self.sources.get(url)
+                entry = {"Source": i + 1, "Host": urllib.parse.urlsplit(url).hostname, "Preferred": url == preferred}
+                if health is not None:
+                    entry.update({
+                        "TTFBMs": None if health.ttfb is None else round(health.ttfb * 1000),
+                        "FailureRate": round(health.failure_rate, 3),
+                        "Attempts": health.attempts,
+                        "Failures": health.failures,
+                        "Healthy": health.healthy(now),
+                    })
+                sources.append(entry)
+            channels.append({"GuideNumber": guide_number, "Sources": sources})
+        return channels
+
+
+def source_host(url: str) -> str:
+    return urllib.parse.urlsplit(url).netloc.lower()
+
+
+async def probe(url: str, tracker: HealthTracker) -> bool:
+    """Open url, wait for its first stream bytes and hang up, recording the outcome.
+
+    The request goes through the host's limiter (xtream_client.get_limiter),
+    like catalog requests, so probes don't add to a provider's load limits.
+    """
+    client = get_upstream_client()
+    try:
+        async with get_limiter(url).slot():
+            start = time.perf_counter()
+            async with asyncio.timeout(PROBE_TIMEOUT):
+                async with client.stream("GET", url) as response:
+                    if response.is_error:
+                        raise httpx.HTTPStatusError(f"HTTP {response.status_code}", request=response.request,
+                                                    response=response)
+                    async for chunk in response.aiter_raw(CHUNK_SIZE):
+                        if chunk:
+                            break
+                    else:
+                        raise httpx.ReadError("no stream data")
+    except (httpx.HTTPError, TimeoutError) as e:
+        logger.debug(f"Probe of {urllib.parse.urlsplit(url).hostname} failed: {e or 'timed out'}")
+        tracker.record_failure(url)
+        STREAM_PROBES.inc(result="failure")
+        return False
+    tracker.record_success(url, time.perf_counter() - start)
+    STREAM_PROBES.inc(result="success")
+    return True
+
+
+class HealthProber:
+    """Probes the sources of channels with failover URLs in the background.
+
+    sources is an async callable returning the lineup's GuideNumber -> URL
+    tuple. Channels with a single source aren't probed, since there is
+    nothing to choose between. busy() returns the upstream URLs being
+    streamed; sources on those hosts are skipped, checked again right before
+    each probe, since an extra connection on a single-connection account
+    can kick the viewer off.
+    """
+
+    def __init__(self, tracker: HealthTracker, sources, busy):
+        self.tracker = tracker
+        self.sources = sources
+        self.busy = busy
+        self._task = None
+        self.last_run = None
+        self.last_duration = None
+        self.last_probed = 0
+
+    def start(self):
+        if PROBE_INTERVAL_MINUTES <= 0:
+            logger.info("Stream health probing disabled")
+            return
+        self._task = asyncio.ensure_future(self._run())
+        logger.info(f"Stream health probing every {PROBE_INTERVAL_MINUTES:g} min, {PROBE_CONCURRENCY} at a time")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def probe_all(self):
+        failover_urls = await self.sources()
+        self.tracker.prune({url for urls in failover_urls.values() for url in urls})
+        urls = list(dict.fromkeys(url for urls in failover_urls.values() if len(urls) > 1 for url in urls))
+        semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+
+        async def bounded(url):
+            async with semaphore:
+                if source_host(url) in self.busy_hosts():
+                    return None
+                return await probe(url, self.tracker)
+
+        start = time.perf_counter()
+        results = await asyncio.gather(*(bounded(url) for url in urls))
+        self.last_run = time.time()
+        self.last_duration = time.perf_counter() - start
+        self.last_probed = len(urls) - results.count(None)
+        logger.info(f"Probed {self.last_probed} sources in {self.last_duration:.1f}s, {results.count(False)} failed, "
+                    f"{results.count(None)} skipped on hosts in use")
+
+    def busy_hosts(self) -> set:
+        return {source_host(url) for url in self.busy()}
+
+    async def _run(self):
+        while True:
+            try:
+                await self.probe_all()
+            except Exception as e:
+                logger.error(f"Stream health probe failed: {e}")
+            await asyncio.sleep(PROBE_INTERVAL_MINUTES * 60)
+
+    def status(self) -> dict:
+        return {
+            "ProbeIntervalMinutes": PROBE_INTERVAL_MINUTES,
+            "LastProbe": self.last_run,
+            "LastProbeSeconds": self.last_duration,
+            "LastProbed": self.last_probed,
+            "UnhealthySources": self.tracker.unhealthy(),
+        }
+
+
+health_tracker = HealthTracker()
@@ -0,0 +1,79 @@
+import logging
+import os
+
+import httpx
+from fastapi.responses import Response
+
+from xtream_client import DEFAULT_HEADERS
+
+logger = logging.getLogger(__name__)
+
+# When enabled, lineup URLs point at /auto/v{GuideNumber} instead of the provider
+PROXY_ENABLED = os.getenv("HDHR_STREAM_PROXY", "0") == "1"
+CHUNK_SIZE = 188 * 1024  # a whole number of 188-byte TS packets
+
+UPSTREAM_TIMEOUT = httpx.Timeout(connect=10.0, read=30.0, write=10.0, pool=10.0)
+
+
+class TunerPool:
+    """Fixed number of tuner slots, one held by each active upstream stream"""
+
+    def __init__(self, count: int):
+        self.count = count
+        self.in_use = 0
+
+    def try_acquire(self) -> bool:
+        if self.in_use >= self.count:
+            return False
+        self.in_use += 1
+        return True
+
+    def release(self):
+        self.in_use = max(0, self.in_use - 1)
+
+
+def tuners_busy_response() -> Response:
+    """What a real HDHomeRun answers when every tuner is in use"""
+    return Response(
+        content="All tuners in use",
+        status_code=503,
+        media_type="text/plain",
+        headers={"X-HDHomeRun-Error": "805 All Tuners In Use"},
+    )
+
+
+_upstream_client = None
+
+
+def get_upstream_client() -> httpx.AsyncClient:
+    global _upstream_client
+    if _upstream_client is None:
+        headers = {"User-Agent": DEFAULT_HEADERS["User-Agent"]}
+        _upstream_client = httpx.AsyncClient(headers=headers, follow_redirects=True, timeout=UPSTREAM_TIMEOUT)
+    return _upstream_client
+
+
+async def close_upstream_client():
+    global _upstream_client
+    if _upstream_client is not None:
+        await _upstream_client.aclose()
+        _upstream_client = None
+
+
+async def open_upstream(url: str, label: str):
+    """Start a streaming GET for url, returning the response or None if it failed"""
+    client = get_upstream_client()
+    try:
+        upstream = await client.send(client.build_request("GET", url), stream=True)
+    except httpx.HTTPError as e:
+        logger.warning(f"Upstream failed for {label}: {e}")
+        return None
+    if upstream.is_error:
+        await upstream.aclose()
+        logger.warning(f"Upstream failed for {label}: HTTP {upstream.status_code}")
+        return None
+    return upstream
+
+
+def upstream_unavailable_response() -> Response:
+    return Response(content="Upstream stream unavailable", status_code=502, media_type="text/plain")
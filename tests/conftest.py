@@ -0,0 +1,12 @@
+"""Point the app at scratch directories before any app module is imported"""
+import os
+import sys
+import tempfile
+
+SCRATCH = tempfile.mkdtemp(prefix="iptv-manager-tests-")
+os.environ["DATA_DIR"] = os.path.join(SCRATCH, "data")
+os.environ["M3U_DIR"] = os.path.join(SCRATCH, "m3u")
+os.makedirs(os.environ["DATA_DIR"], exist_ok=True)
+os.makedirs(os.environ["M3U_DIR"], exist_ok=True)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,87 @@
+import asyncio
+
+from benchmarks.fake_xtream import FakeXtreamServer
+from models import SessionLocal, init_db
+from pipeline import RefreshResult, fetch_playlist, load_item
+from services import create_item, delete_item
+
+
+def test_fingerprint_only_recorded_once_channels_are_committed():
+    init_db()
+    with FakeXtreamServer(live=50, vod=50, series=5) as server:
+        db = SessionLocal()
+        try:
+            # Everything excluded: the sync finds nothing to keep and writes nothing
+            item_id = create_item(db, "fingerprint", server.url, server.username, server.password,
+                                  "", "", "*", "", refresh_interval=0).id
+        finally:
+            db.close()
+
+        async def run():
+            from xtream_client import close_clients
+            fingerprints = {}
+            item = load_item(item_id)
+            try:
+                first = RefreshResult()
+                await fetch_playlist(item, first, fingerprints, manual=True)
+                second = RefreshResult()
+                await fetch_playlist(item, second, fingerprints, manual=True)
+            finally:
+                await close_clients()
+            return fingerprints, first, second
+
+        try:
+            fingerprints, first, second = asyncio.run(run())
+        finally:
+            db = SessionLocal()
+            try:
+                delete_item(db, item_id)
+            finally:
+                db.close()
+    assert first.filtered == 0
+    assert "playlist" not in fingerprints
+    # The identical response is synced again rather than reported unchanged
+    assert not second.playlist_unchanged
+    assert second.diff is not None
+
+
+def test_raw_playlist_and_channels_keep_every_catalog_entry():
+    from channel_store import count_filtered
+    from filter_engine import ChannelMatcher
+    from lineup_cache import M3U_DIR
+
+    init_db()
+    live, vod, series = 40, 60, 6
+    with FakeXtreamServer(live=live, vod=vod, series=series) as server:
+        db = SessionLocal()
+        try:
+            item_id = create_item(db, "complete", server.url, server.username, server.password,
+                                  "fr", "", "", "", refresh_interval=0).id
+        finally:
+            db.close()
+
+        async def run():
+            from xtream_client import close_clients
+            result = RefreshResult()
+            try:
+                await fetch_playlist(load_item(item_id), result, {}, manual=True)
+            finally:
+                await close_clients()
+            return result
+
+        try:
+            result = asyncio.run(run())
+            with open(f"{M3U_DIR}/xtream_playlist_{item_id}.m3u", encoding="utf-8") as f:
+                extinfs = [line.rstrip("\n") for line in f if line.startswith("#EXTINF")]
+            filtered = count_filtered(item_id)
+        finally:
+            db = SessionLocal()
+            try:
+                delete_item(db, item_id)
+            finally:
+                db.close()
+    # Entries of other-language categories stay in the raw mirror, and the
+    # filter keeps the ones whose own names pass it
+    assert result.records == len(extinfs) == live + vod + series
+    matcher = ChannelMatcher(languages="fr")
+    assert filtered == result.filtered == sum(matcher.apply(extinf) is not None for extinf in extinfs)
@@ -0,0 +1,47 @@
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from compressed_files import write_compressed_variants
+from file_serving import accepted_encodings, serve_file
+
+
+@pytest.fixture
+def client(tmp_path):
+    path = tmp_path / "playlist.m3u"
+    path.write_text("#EXTM3U\n" + "#EXTINF:-1,US - CHANNEL\nhttp://example/1.ts\n" * 200)
+    write_compressed_variants(str(path))
+    app = FastAPI()
+
+    @app.get("/playlist")
+    def playlist(request: Request):
+        return serve_file(request, str(path), "audio/x-mpegurl", "playlist.m3u")
+
+    return TestClient(app)
+
+
+def content_encoding(client, accept_encoding: str):
+    response = client.get("/playlist", headers={"Accept-Encoding": accept_encoding})
+    assert response.status_code == 200
+    return response.headers.get("content-encoding")
+
+
+def test_accepted_encodings_keeps_refusals():
+    assert accepted_encodings("gzip;q=0, *") == {"gzip": 0.0, "*": 1.0}
+    assert accepted_encodings("GZIP; q=0.5, br;q=bogus") == {"gzip": 0.5, "br": 0.0}
+    assert accepted_encodings(None) == {}
+
+
+def test_serves_gzip_when_accepted(client):
+    assert content_encoding(client, "gzip") == "gzip"
+    assert content_encoding(client, "gzip;q=0.5, identity") == "gzip"
+
+
+@pytest.mark.parametrize("accept_encoding", ["identity", "gzip;q=0", "*;q=0", ""])
+def test_nothing_compressed_when_refused(client, accept_encoding):
+    assert content_encoding(client, accept_encoding) is None
+
+
+def test_explicit_refusal_overrides_wildcard(client):
+    assert content_encoding(client, "gzip;q=0, *") != "gzip"
+    assert content_encoding(client, "*, gzip;q=0, zstd;q=0") is None
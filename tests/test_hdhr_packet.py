@@ -0,0 +1,146 @@
+import struct
+import zlib
+
+import pytest
+
+from hdhomerun_emulator import (
+    HDHR_DEVICE_ID_WILDCARD, HDHR_DEVICE_TYPE_TUNER, HDHR_DEVICE_TYPE_WILDCARD, HDHR_TAG_BASE_URL,
+    HDHR_TAG_DEVICE_ID, HDHR_TAG_DEVICE_TYPE, HDHR_TAG_LINEUP_URL, HDHR_TYPE_DISCOVER_REQ,
+    HDHR_TYPE_DISCOVER_RPY, HDHomeRunEmulator, hdhr_packet, parse_hdhr_packet,
+)
+
+HDHR_DEVICE_TYPE_STORAGE = 0x00000005
+
+
+def framed(packet_type: int, payload: bytes) -> bytes:
+    """A packet with a correct header and CRC around an arbitrary (possibly bad) payload"""
+    frame = struct.pack(">HH", packet_type, len(payload)) + payload
+    return frame + struct.pack("<I", zlib.crc32(frame))
+
+
+def uint32(value: int) -> bytes:
+    return struct.pack(">I", value)
+
+
+def test_round_trip():
+    data = hdhr_packet(HDHR_TYPE_DISCOVER_REQ, [(HDHR_TAG_DEVICE_TYPE, uint32(HDHR_DEVICE_TYPE_TUNER)),
+                                                 (HDHR_TAG_DEVICE_ID, uint32(HDHR_DEVICE_ID_WILDCARD))])
+    assert parse_hdhr_packet(data) == (HDHR_TYPE_DISCOVER_REQ, {
+        HDHR_TAG_DEVICE_TYPE: [uint32(HDHR_DEVICE_TYPE_TUNER)],
+        HDHR_TAG_DEVICE_ID: [uint32(HDHR_DEVICE_ID_WILDCARD)],
+    })
+
+
+def test_crc_is_little_endian_crc32_of_header_and_payload():
+    data = hdhr_packet(HDHR_TYPE_DISCOVER_REQ, [(HDHR_TAG_DEVICE_TYPE, uint32(HDHR_DEVICE_TYPE_TUNER))])
+    assert data[-4:] == struct.pack("<I", zlib.crc32(data[:-4]))
+
+
+def test_bad_crc_is_rejected():
+    data = bytearray(hdhr_packet(HDHR_TYPE_DISCOVER_REQ, [(HDHR_TAG_DEVICE_TYPE, uint32(HDHR_DEVICE_TYPE_TUNER))]))
+    data[-1] ^= 0xFF
+    assert parse_hdhr_packet(bytes(data)) == (None, {})
+    data = bytearray(hdhr_packet(HDHR_TYPE_DISCOVER_REQ, [(HDHR_TAG_DEVICE_TYPE, uint32(HDHR_DEVICE_TYPE_TUNER))]))
+    data[6] ^= 0x01
+    assert parse_hdhr_packet(bytes(data)) == (None, {})
+
+
+@pytest.mark.parametrize("length", [0, 1, 127, 128, 129, 255, 300, 16383])
+def test_tlv_lengths(length):
+    value = bytes(i % 251 for i in range(length))
+    data = hdhr_packet(HDHR_TYPE_DISCOVER_RPY, [(HDHR_TAG_BASE_URL, value)])
+    if length <= 127:
+        assert data[5] == length
+    else:
+        # Low 7 bits with the high bit set, then the rest
+        assert data[5:7] == bytes([(length & 0x7F) | 0x80, length >> 7])
+    assert parse_hdhr_packet(data) == (HDHR_TYPE_DISCOVER_RPY, {HDHR_TAG_BASE_URL: [value]})
+
+
+def test_repeated_tags_are_all_kept():
+    data = hdhr_packet(HDHR_TYPE_DISCOVER_REQ, [(HDHR_TAG_DEVICE_TYPE, uint32(HDHR_DEVICE_TYPE_STORAGE)),
+                                                 (HDHR_TAG_DEVICE_TYPE, uint32(HDHR_DEVICE_TYPE_TUNER))])
+    _, tags = parse_hdhr_packet(data)
+    assert tags[HDHR_TAG_DEVICE_TYPE] == [uint32(HDHR_DEVICE_TYPE_STORAGE), uint32(HDHR_DEVICE_TYPE_TUNER)]
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"\x00\x02\x00\x00",
+    # Truncated: the header promises more payload than the datagram holds
+    hdhr_packet(HDHR_TYPE_DISCOVER_REQ, [(HDHR_TAG_DEVICE_TYPE, uint32(1))])[:-1],
+    hdhr_packet(HDHR_TYPE_DISCOVER_REQ, [(HDHR_TAG_DEVICE_TYPE, uint32(1))])[:6],
+    # Trailing bytes after the CRC
+    hdhr_packet(HDHR_TYPE_DISCOVER_REQ, [(HDHR_TAG_DEVICE_TYPE, uint32(1))]) + b"\x00",
+    # A TLV value running past the payload
+    framed(HDHR_TYPE_DISCOVER_REQ, bytes([HDHR_TAG_DEVICE_TYPE, 8]) + uint32(1)),
+    # A two-byte length missing its second byte
+    framed(HDHR_TYPE_DISCOVER_REQ, bytes([HDHR_TAG_DEVICE_TYPE, 0x80])),
+    # A lone tag byte without a length
+    framed(HDHR_TYPE_DISCOVER_REQ, bytes([HDHR_TAG_DEVICE_TYPE, 4]) + uint32(1) + bytes([HDHR_TAG_DEVICE_ID])),
+])
+def test_malformed_datagrams_are_rejected(data):
+    assert parse_hdhr_packet(data) == (None, {})
+
+
+class FakeTransport:
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, addr):
+        self.sent.append((data, addr))
+
+
+@pytest.fixture
+def emulator(monkeypatch):
+    monkeypatch.setenv("HDHR_ADVERTISE_HOST", "tuner.example")
+    monkeypatch.setenv("HDHR_ADVERTISE_PORT", "15005")
+    emulator = HDHomeRunEmulator(http_port=5005)
+    emulator._discover_transport = FakeTransport()
+    return emulator
+
+
+def discover(emulator, tags: list) -> list:
+    emulator._discover_transport.sent.clear()
+    emulator.handle_discover_datagram(hdhr_packet(HDHR_TYPE_DISCOVER_REQ, tags), ("192.0.2.10", 40000))
+    return emulator._discover_transport.sent
+
+
+@pytest.mark.parametrize("device_types", [
+    [],
+    [HDHR_DEVICE_TYPE_TUNER],
+    [HDHR_DEVICE_TYPE_WILDCARD],
+    [HDHR_DEVICE_TYPE_STORAGE, HDHR_DEVICE_TYPE_TUNER],
+    [HDHR_DEVICE_TYPE_TUNER, HDHR_DEVICE_TYPE_STORAGE],
+])
+def test_answers_requests_for_tuners(emulator, device_types):
+    tags = [(HDHR_TAG_DEVICE_TYPE, uint32(device_type)) for device_type in device_types]
+    assert len(discover(emulator, tags)) == 1
+
+
+def test_ignores_requests_for_other_device_types(emulator):
+    assert discover(emulator, [(HDHR_TAG_DEVICE_TYPE, uint32(HDHR_DEVICE_TYPE_STORAGE))]) == []
+
+
+def test_device_id_matching(emulator):
+    own_id = int(emulator.device_id, 16)
+    tuner = (HDHR_TAG_DEVICE_TYPE, uint32(HDHR_DEVICE_TYPE_TUNER))
+    assert len(discover(emulator, [tuner, (HDHR_TAG_DEVICE_ID, uint32(own_id))])) == 1
+    assert len(discover(emulator, [tuner, (HDHR_TAG_DEVICE_ID, uint32(HDHR_DEVICE_ID_WILDCARD))])) == 1
+    assert discover(emulator, [tuner, (HDHR_TAG_DEVICE_ID, uint32(own_id ^ 1))]) == []
+
+
+def test_ignores_malformed_and_non_discover_packets(emulator):
+    emulator.handle_discover_datagram(b"\x00\x02\x00\x00garbage!", ("192.0.2.10", 40000))
+    emulator.handle_discover_datagram(hdhr_packet(HDHR_TYPE_DISCOVER_RPY, []), ("192.0.2.10", 40000))
+    assert emulator._discover_transport.sent == []
+
+
+def test_reply_advertises_the_configured_base_url(emulator):
+    (reply, addr), = discover(emulator, [(HDHR_TAG_DEVICE_TYPE, uint32(HDHR_DEVICE_TYPE_TUNER))])
+    packet_type, tags = parse_hdhr_packet(reply)
+    assert addr == ("192.0.2.10", 40000)
+    assert packet_type == HDHR_TYPE_DISCOVER_RPY
+    assert tags[HDHR_TAG_DEVICE_ID] == [uint32(int(emulator.device_id, 16))]
+    assert tags[HDHR_TAG_BASE_URL] == [b"http://tuner.example:15005"]
+    assert tags[HDHR_TAG_LINEUP_URL] == [b"http://tuner.example:15005/lineup.json"]
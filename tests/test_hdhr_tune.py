@@ -0,0 +1,23 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import hdhomerun_routes
+from lineup_cache import LineupSnapshot
+
+
+def test_tune_redirects_upstream_when_proxy_disabled(monkeypatch):
+    snapshot = LineupSnapshot(channels=[], body=b"[]", etag='"x"',
+                              upstream_urls={"101": ("http://provider/live/u/p/1.ts", "http://backup/live/u/p/1.ts")})
+    monkeypatch.setattr(hdhomerun_routes, "PROXY_ENABLED", False)
+    monkeypatch.setattr(hdhomerun_routes, "load_lineup_snapshot", lambda: snapshot)
+    app = FastAPI()
+    app.include_router(hdhomerun_routes.router)
+    client = TestClient(app)
+
+    response = client.get("/auto/v101", follow_redirects=False)
+    assert response.status_code == 302
+    assert response.headers["location"] == "http://provider/live/u/p/1.ts"
+    assert hdhomerun_routes.broadcaster.tuners.in_use == 0
+    assert not hdhomerun_routes.broadcaster.channels
+
+    assert client.get("/auto/v999", follow_redirects=False).status_code == 404
@@ -0,0 +1,85 @@
+from filter_engine import strict_normalize
+from lineup_cache import ParsedChannel
+from lineup_merge import Provider, load_guide_numbers, merge_providers, save_guide_numbers
+from models import init_db
+
+
+def channel(name: str, host: str, tvg_chno: str = "") -> ParsedChannel:
+    return ParsedChannel(display_name=name, norm_name=strict_normalize(name), tvg_id=f"{name}.example",
+                         tvg_chno=tvg_chno, group="US", url=f"http://{host}/live/u/p/{strict_normalize(name)}.ts")
+
+
+def provider(item_id: int, priority: int, *channels: ParsedChannel) -> Provider:
+    return Provider(item_id=item_id, name=f"provider {item_id}", priority=priority, channels=list(channels))
+
+
+def rebuild(providers: list, known: dict) -> dict:
+    """Merge like LineupCache does, carrying assigned numbers into known; {GuideName: GuideNumber}"""
+    result = merge_providers(providers, known)
+    known.update(result.assigned)
+    return {ch["GuideName"]: ch["GuideNumber"] for ch in result.channels}
+
+
+def test_numbers_are_stable_across_rebuilds():
+    providers = [provider(1, 0, channel("CBS", "a"), channel("NBC", "a")),
+                 provider(2, 1, channel("NBC", "b"), channel("ABC", "b"))]
+    known = {}
+    first = rebuild(providers, known)
+    assert sorted(first.values()) == ["1", "2", "3"]
+    assert merge_providers(providers, known).assigned == {}
+    assert rebuild(providers, known) == first
+    # Nor does the order the providers come in matter
+    assert rebuild(list(reversed(providers)), known) == first
+
+
+def test_explicit_tvg_chno_wins():
+    known = {}
+    rebuild([provider(1, 0, channel("CBS", "a"), channel("NBC", "a"))], known)
+    assert known == {"cbs": "1", "nbc": "2"}
+    # NBC now asks for 1, which CBS had: NBC gets it, CBS moves to a number nobody holds
+    numbers = rebuild([provider(1, 0, channel("CBS", "a"), channel("NBC", "a", tvg_chno="1"))], known)
+    assert numbers == {"CBS": "3", "NBC": "1"}
+
+
+def test_explicit_tvg_chno_from_a_lower_priority_provider_supplies_the_channel():
+    result = merge_providers([provider(1, 0, channel("CBS", "a")),
+                              provider(2, 1, channel("CBS", "b", tvg_chno="42"))], {})
+    (cbs,) = result.channels
+    assert cbs["GuideNumber"] == "42"
+    assert cbs["URL"] == "http://b/live/u/p/cbs.ts"
+    assert result.failover_urls["42"] == ("http://b/live/u/p/cbs.ts", "http://a/live/u/p/cbs.ts")
+
+
+def test_clashing_tvg_chno_keeps_the_first_in_merge_order():
+    numbers = rebuild([provider(1, 0, channel("CBS", "a", tvg_chno="5")),
+                       provider(2, 1, channel("NBC", "b", tvg_chno="5"))], {})
+    assert numbers["CBS"] == "5"
+    assert numbers["NBC"] != "5"
+
+
+def test_reserved_numbers_are_never_reused():
+    known = {}
+    rebuild([provider(1, 0, channel("CBS", "a"), channel("NBC", "a"))], known)
+    # CBS drops out and a new channel arrives: it must not take CBS's number
+    numbers = rebuild([provider(1, 0, channel("NBC", "a"), channel("ABC", "a"))], known)
+    assert numbers == {"NBC": "2", "ABC": "3"}
+    # CBS comes back to its old number
+    numbers = rebuild([provider(1, 0, channel("CBS", "a"), channel("NBC", "a"), channel("ABC", "a"))], known)
+    assert numbers == {"CBS": "1", "NBC": "2", "ABC": "3"}
+
+
+def test_failover_urls_follow_provider_priority():
+    result = merge_providers([provider(3, 2, channel("CBS", "c")),
+                              provider(1, 0, channel("CBS", "a")),
+                              provider(2, 1, channel("CBS", "b"))], {})
+    assert result.channels[0]["URL"] == "http://a/live/u/p/cbs.ts"
+    assert result.failover_urls["1"] == ("http://a/live/u/p/cbs.ts", "http://b/live/u/p/cbs.ts",
+                                         "http://c/live/u/p/cbs.ts")
+
+
+def test_guide_numbers_persist():
+    init_db()
+    result = merge_providers([provider(1, 0, channel("Persisted One", "a"), channel("Persisted Two", "a"))], {})
+    save_guide_numbers(result.assigned)
+    stored = load_guide_numbers()
+    assert {name: stored[name] for name in result.assigned} == result.assigned
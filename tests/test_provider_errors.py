@@ -0,0 +1,67 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from models import SessionLocal, init_db
+from pipeline import RefreshError, RefreshResult, fetch_playlist, load_item
+from services import create_item, delete_item
+
+ERROR_BODY = b"Invalid credentials"
+
+
+class ForbiddenHandler(BaseHTTPRequestHandler):
+    """A panel that refuses every request, the way it does after a password change"""
+
+    def do_GET(self):
+        self.send_response(403)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(ERROR_BODY)))
+        self.end_headers()
+        self.wfile.write(ERROR_BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def forbidding_server():
+    # A real socket: httpx.MockTransport pre-reads bodies, which hides unread streamed responses
+    server = ThreadingHTTPServer(("127.0.0.1", 0), ForbiddenHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_refused_m3u_fallback_raises_refresh_error(forbidding_server, caplog):
+    from xtream_client import close_clients
+
+    init_db()
+    db = SessionLocal()
+    try:
+        item_id = create_item(db, "forbidden", forbidding_server, "user", "wrong", "", "", "", "",
+                              refresh_interval=0).id
+    finally:
+        db.close()
+
+    async def run():
+        try:
+            await fetch_playlist(load_item(item_id), RefreshResult(), {}, manual=True)
+        finally:
+            await close_clients()
+
+    try:
+        with pytest.raises(RefreshError, match="Failed to fetch M3U"):
+            asyncio.run(run())
+    finally:
+        db = SessionLocal()
+        try:
+            delete_item(db, item_id)
+        finally:
+            db.close()
+    assert "Invalid credentials" in caplog.text
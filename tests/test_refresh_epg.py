@@ -0,0 +1,50 @@
+import asyncio
+import os
+
+import pipeline
+from benchmarks.fake_xtream import FakeXtreamServer
+from models import SessionLocal, init_db
+from services import create_item, delete_item
+
+
+def crash(*args):
+    """Stands in for filter_epg_file in a worker that dies, e.g. killed for memory"""
+    os._exit(1)
+
+
+def test_crashed_epg_worker_is_reported_not_raised(monkeypatch):
+    from workers import stop_workers
+    from xtream_client import close_clients
+
+    init_db()
+    monkeypatch.setattr(pipeline, "filter_epg_file", crash)
+    with FakeXtreamServer(live=50, vod=10, series=1) as server:
+        db = SessionLocal()
+        try:
+            item_id = create_item(db, "crashing epg", server.url, server.username, server.password,
+                                  "", "", "", "", refresh_interval=0).id
+        finally:
+            db.close()
+
+        async def run():
+            item = pipeline.load_item(item_id)
+            result = pipeline.RefreshResult()
+            fingerprints = {}
+            try:
+                await pipeline.fetch_playlist(item, result, fingerprints, manual=True)
+                await pipeline.refresh_epg(item, result, fingerprints, manual=True)
+            finally:
+                await close_clients()
+                stop_workers()
+            return result, fingerprints
+
+        try:
+            result, fingerprints = asyncio.run(run())
+        finally:
+            db = SessionLocal()
+            try:
+                delete_item(db, item_id)
+            finally:
+                db.close()
+    assert result.epg_error.startswith("Failed to filter EPG")
+    assert "epg_filter" not in fingerprints
@@ -0,0 +1,41 @@
+import asyncio
+
+from benchmarks.fake_xtream import FakeXtreamServer
+from models import init_db
+from response_cache import ResponseCache
+from xtream_client import XtreamClient
+
+
+def test_manual_refresh_bypasses_ttl_but_still_replays(tmp_path):
+    init_db()
+    cache = ResponseCache(str(tmp_path), 64 * 1024 * 1024, ttl=3600)
+    server = FakeXtreamServer(live=10, vod=10, series=1)
+    server.start()
+
+    async def run():
+        client = XtreamClient(server.url, server.username, server.password, cache=cache)
+        try:
+            first = await client.authenticate()
+            requests = len(server.request_starts)
+            # A scheduled refresh within the TTL replays the cached response
+            assert await client.authenticate() == first
+            assert len(server.request_starts) == requests
+            # A manual one asks the provider
+            assert await client.bypassing_ttl().authenticate() == first
+            assert len(server.request_starts) == requests + 1
+        finally:
+            await client.aclose()
+
+        # and still falls back to the cache when the provider is down
+        server.stop()
+        client = XtreamClient(server.url, server.username, server.password, cache=cache)
+        try:
+            assert await client.bypassing_ttl().authenticate() == first
+            assert cache.replays == 1
+        finally:
+            await client.aclose()
+
+    try:
+        asyncio.run(run())
+    finally:
+        server.stop()
@@ -0,0 +1,139 @@
+import asyncio
+import time
+
+import pipeline
+from benchmarks.fake_xtream import FakeXtreamServer
+from models import SessionLocal, init_db
+from services import create_item, delete_item
+
+# A lineup rebuild this slow stands in for a large one
+SLOW_REBUILD_SECONDS = 1.0
+# Longest the event loop may go without running a ready task while a refresh runs
+MAX_LAG_SECONDS = 0.5
+TICK_SECONDS = 0.01
+
+
+async def max_loop_lag(work) -> float:
+    """Run work() while a ticker measures how late the event loop wakes it"""
+    lags = []
+
+    async def ticker():
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(TICK_SECONDS)
+            lags.append(time.perf_counter() - start - TICK_SECONDS)
+
+    task = asyncio.ensure_future(ticker())
+    try:
+        await work()
+        # Let the ticker record a stall at the very end of work()
+        await asyncio.sleep(TICK_SECONDS * 2)
+    finally:
+        task.cancel()
+    return max(lags)
+
+
+def test_refresh_keeps_event_loop_responsive(monkeypatch):
+    from workers import start_workers, stop_workers
+    from xtream_client import close_clients
+
+    real_snapshot = pipeline.get_lineup_snapshot
+
+    def slow_snapshot(db):
+        time.sleep(SLOW_REBUILD_SECONDS)
+        return real_snapshot(db)
+
+    monkeypatch.setattr(pipeline, "get_lineup_snapshot", slow_snapshot)
+    init_db()
+    with FakeXtreamServer(live=20000, vod=20000, series=2000) as server:
+        db = SessionLocal()
+        try:
+            item_id = create_item(db, "responsiveness", server.url, server.username, server.password,
+                                  "en,us", "", "", "", refresh_interval=0).id
+        finally:
+            db.close()
+
+        async def run():
+            start_workers()
+            try:
+                return await max_loop_lag(lambda: pipeline.refresh_item(item_id, {}))
+            finally:
+                await close_clients()
+                stop_workers()
+
+        try:
+            lag = asyncio.run(run())
+        finally:
+            db = SessionLocal()
+            try:
+                delete_item(db, item_id)
+            finally:
+                db.close()
+    assert lag < MAX_LAG_SECONDS, f"event loop stalled for {lag:.2f}s during a refresh"
+
+
+# Latency budgets for requests served while providers are being refreshed
+MAX_DISCOVER_P99_SECONDS = 0.1
+MAX_CACHE_STATUS_SECONDS = 1.0
+REFRESHING_ITEMS = 6
+
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def test_requests_stay_fast_during_refresh_all():
+    import httpx
+
+    from main import app
+    from scheduler import refresh_scheduler
+    from workers import start_workers, stop_workers
+    from xtream_client import close_clients
+
+    init_db()
+    with FakeXtreamServer(live=10000, vod=10000, series=1000) as server:
+        db = SessionLocal()
+        try:
+            item_ids = [create_item(db, f"refresh all {i}", server.url, server.username, server.password,
+                                    "en,us", "", "", "", refresh_interval=0).id for i in range(REFRESHING_ITEMS)]
+        finally:
+            db.close()
+
+        async def run():
+            start_workers()
+            refresh_scheduler.start()
+            transport = httpx.ASGITransport(app=app)
+            discover, cache_status = [], []
+            try:
+                async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                    response = await client.post("/refresh_all", follow_redirects=False)
+                    assert response.status_code == 303 and "success" in response.headers["location"]
+                    while any(refresh_scheduler.jobs[item_id].state != "idle" for item_id in item_ids):
+                        start = time.perf_counter()
+                        (await client.get("/discover.json")).raise_for_status()
+                        discover.append(time.perf_counter() - start)
+                        if len(discover) % 50 == 0:
+                            start = time.perf_counter()
+                            (await client.get("/response_cache.json")).raise_for_status()
+                            cache_status.append(time.perf_counter() - start)
+                        await asyncio.sleep(TICK_SECONDS)
+            finally:
+                await refresh_scheduler.stop()
+                await close_clients()
+                stop_workers()
+            return discover, cache_status
+
+        try:
+            discover, cache_status = asyncio.run(run())
+        finally:
+            db = SessionLocal()
+            try:
+                for item_id in item_ids:
+                    delete_item(db, item_id)
+            finally:
+                db.close()
+    assert len(discover) > 20, "the refresh finished before it could be measured"
+    p99 = percentile(discover, 0.99)
+    assert p99 < MAX_DISCOVER_P99_SECONDS, f"discover.json p99 {p99 * 1000:.0f} ms during Refresh All"
+    assert max(cache_status, default=0) < MAX_CACHE_STATUS_SECONDS
@@ -0,0 +1,41 @@
+import asyncio
+
+import httpx
+
+import stream_health
+from stream_health import HealthProber, HealthTracker
+
+
+class StreamBody(httpx.AsyncByteStream):
+    async def __aiter__(self):
+        yield b"\x47" * 188
+
+
+def test_probes_skip_hosts_in_use(monkeypatch):
+    requested = []
+
+    def handler(request):
+        requested.append(request.url.host)
+        return httpx.Response(200, stream=StreamBody())
+
+    async def sources():
+        return {
+            "101": ("http://busy.example/live/u/p/2.ts", "http://idle.example/live/u/p/2.ts"),
+            "102": ("http://single.example/live/u/p/3.ts",),
+        }
+
+    async def run():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(stream_health, "get_upstream_client", lambda: client)
+        prober = HealthProber(HealthTracker(), sources, lambda: ["http://busy.example/live/u/p/1.ts"])
+        try:
+            await prober.probe_all()
+        finally:
+            await client.aclose()
+        return prober
+
+    prober = asyncio.run(run())
+    # Another channel is streaming from busy.example, and single.example has nothing to fail over to
+    assert requested == ["idle.example"]
+    assert prober.last_probed == 1
+    assert set(prober.tracker.sources) == {"http://idle.example/live/u/p/2.ts"}
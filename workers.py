@@ -0,0 +1,63 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import anyio.to_thread
+
+logger = logging.getLogger(__name__)
+
+# Threads for blocking refresh work (file writes, SQLite bulk writes); asyncio.to_thread uses this pool
+IO_WORKERS = int(os.getenv("IO_WORKERS", "4"))
+# Threads for synchronous route handlers, kept apart so a busy refresh can't starve requests
+HTTP_WORKERS = int(os.getenv("HTTP_WORKERS", "16"))
+# Processes for CPU-bound work such as guide filtering
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", str(min(2, os.cpu_count() or 1))))
+
+_io_pool = None
+_cpu_pool = None
+
+
+def start_workers():
+    """Install the bounded pools on the running event loop"""
+    global _io_pool
+    _io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+    asyncio.get_running_loop().set_default_executor(_io_pool)
+    anyio.to_thread.current_default_thread_limiter().total_tokens = HTTP_WORKERS
+    logger.info(f"Worker pools: {IO_WORKERS} I/O threads, {HTTP_WORKERS} request threads, {CPU_WORKERS} CPU processes")
+
+
+def _get_cpu_pool() -> ProcessPoolExecutor:
+    global _cpu_pool
+    if _cpu_pool is None:
+        # spawn rather than fork: the server process has threads (and their locks) running
+        _cpu_pool = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _cpu_pool
+
+
+async def run_cpu(func, *args, **kwargs):
+    """Run a picklable module-level function in the process pool"""
+    pool = _get_cpu_pool()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(pool, functools.partial(func, *args, **kwargs))
+    except BrokenProcessPool:
+        # A worker died (e.g. killed for memory); start a fresh pool for the next job
+        global _cpu_pool
+        logger.error("CPU worker pool broke, restarting it")
+        if _cpu_pool is pool:
+            _cpu_pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+
+
+def stop_workers():
+    global _io_pool, _cpu_pool
+    if _cpu_pool is not None:
+        _cpu_pool.shutdown(wait=False, cancel_futures=True)
+        _cpu_pool = None
+    if _io_pool is not None:
+        _io_pool.shutdown(wait=False, cancel_futures=True)
+        _io_pool = None
@@ -0,0 +1,496 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+import urllib.parse
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+
+import httpx
+import ijson
+
+from atomic_file import AtomicFile
+from metrics import PROVIDER_FETCH_BYTES, PROVIDER_FETCH_DURATION
+from response_cache import OFFLINE, CacheEntry, ResponseCache, request_key, request_label, response_cache
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/129.0.0.0 Safari/537.36"
+
+DEFAULT_HEADERS = {
+    "User-Agent": os.getenv("PROVIDER_USER_AGENT") or DEFAULT_USER_AGENT,
+    "Accept": "application/json, text/plain, */*",
+    "Accept-Encoding": "gzip, deflate",
+    "Connection": "keep-alive"
+}
+
+# Xtream panels ban clients that hit them too hard, so requests to one host
+# (across all accounts on it) are limited in number and start rate. A slot is
+# held until the body has been read, so below 3 the live, VOD and series
+# catalogs of one account no longer download side by side
+HOST_CONCURRENCY = int(os.getenv("PROVIDER_HOST_CONCURRENCY", "3"))
+HOST_REQUESTS_PER_SECOND = float(os.getenv("PROVIDER_REQUESTS_PER_SECOND", "2"))
+# Longest Retry-After honoured on a 429 before giving up
+MAX_RETRY_AFTER = 60
+
+CATALOG_ACTIONS = ("get_live_streams", "get_vod_streams", "get_series")
+
+# The only catalog fields the M3U generation reads
+CATALOG_FIELDS = {
+    "get_live_streams": ("stream_id", "name", "stream_icon", "epg_channel_id", "category_name"),
+    "get_vod_streams": ("stream_id", "name", "stream_icon", "category_name"),
+    "get_series": ("series_id", "name", "cover"),
+}
+
+
+@dataclass(frozen=True)
+class ActionPolicy:
+    """Timeout (seconds) and retry budget for one provider request type"""
+    timeout: float
+    attempts: int
+    backoff: float = 1.0
+
+
+# The VOD and series catalogs are the big ones, so they get a longer read timeout
+ACTION_POLICIES = {
+    "auth": ActionPolicy(timeout=30, attempts=2),
+    "get_live_streams": ActionPolicy(timeout=30, attempts=3),
+    "get_vod_streams": ActionPolicy(timeout=120, attempts=2),
+    "get_series": ActionPolicy(timeout=120, attempts=2),
+    "m3u": ActionPolicy(timeout=30, attempts=3),
+    "epg": ActionPolicy(timeout=60, attempts=2),
+}
+
+
+class HostLimiter:
+    """Caps concurrent requests to one provider host and spaces out their starts"""
+
+    def __init__(self, concurrency: int, requests_per_second: float):
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+        self._interval = 1 / requests_per_second if requests_per_second > 0 else 0
+        self._next_start = 0.0
+
+    @asynccontextmanager
+    async def slot(self):
+        async with self._semaphore:
+            if self._interval:
+                # Reserve the next start time before sleeping, so waiters queue up in order
+                now = time.monotonic()
+                start = max(now, self._next_start)
+                self._next_start = start + self._interval
+                if start > now:
+                    await asyncio.sleep(start - now)
+            yield
+
+
+class OfflineError(httpx.TransportError):
+    """Offline replay is on (RESPONSE_CACHE_OFFLINE) and the response isn't cached"""
+
+
+def retry_after(response: httpx.Response):
+    """Seconds a 429 response asks us to wait, or None"""
+    try:
+        return float(response.headers.get("retry-after", ""))
+    except ValueError:
+        return None
+
+
+def provider_unavailable(error: httpx.HTTPError) -> bool:
+    """Whether error means the provider couldn't answer (rather than refused), so a cached response may stand in"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return True
+
+
+class XtreamClient:
+    """Async client for a single Xtream Codes provider.
+
+    Holds one pooled httpx.AsyncClient so every action against the provider
+    reuses the same keep-alive connections. Every request attempt goes
+    through the limiter shared by all accounts on the same host. With a
+    cache, raw responses are kept in it and replayed (see _cached).
+    """
+
+    def __init__(self, server_url: str, username: str, password: str, max_connections: int = 4,
+                 limiter: HostLimiter = None, cache: ResponseCache = None):
+        self.server_url = server_url.rstrip('/')
+        self.username = username
+        self.password = password
+        self.limiter = limiter or HostLimiter(HOST_CONCURRENCY, HOST_REQUESTS_PER_SECOND)
+        self.cache = cache
+        # Replay cached responses younger than the cache's TTL instead of asking the provider
+        self.use_ttl = True
+        self.api_url = f"{self.server_url}/player_api.php"
+        headers = dict(DEFAULT_HEADERS)
+        headers["Referer"] = self.server_url
+        self._client = httpx.AsyncClient(
+            headers=headers,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+
+    def bypassing_ttl(self) -> "XtreamClient":
+        """This client (same connections, limiter and cache) asking the provider even when a cached response is fresh"""
+        client = copy.copy(self)
+        client.use_ttl = False
+        return client
+
+    @property
+    def credentials(self) -> dict:
+        return {"username": self.username, "password": self.password}
+
+    async def _with_retries(self, policy_name: str, request):
+        """Run request(timeout) with the per-action timeout and retry budget.
+
+        Transport errors, 5xx and 429 responses are retried, a 429 after
+        its Retry-After; other HTTP errors are raised immediately.
+        """
+        with PROVIDER_FETCH_DURATION.time(action=policy_name):
+            return await self._retry(policy_name, request)
+
+    async def _retry(self, policy_name: str, request):
+        policy = ACTION_POLICIES[policy_name]
+        for attempt in range(1, policy.attempts + 1):
+            delay = policy.backoff * attempt
+            try:
+                async with self.limiter.slot():
+                    return await request(policy.timeout)
+            except httpx.HTTPStatusError as e:
+                status = e.response.status_code
+                if (status < 500 and status != 429) or attempt == policy.attempts:
+                    raise
+                if status == 429:
+                    wait = retry_after(e.response)
+                    if wait is not None and wait > MAX_RETRY_AFTER:
+                        raise
+                    delay = max(delay, wait or 0)
+                logger.warning(f"Attempt {attempt} for {policy_name} failed: {e}")
+            except httpx.TransportError as e:
+                if attempt == policy.attempts:
+                    raise
+                logger.warning(f"Attempt {attempt} for {policy_name} failed: {e!r}")
+            await asyncio.sleep(delay)
+
+    async def _download(self, url: str, policy_name: str, fileobj, params: dict = None):
+        """Stream a response body into fileobj chunk by chunk"""
+        async def request(timeout):
+            fileobj.seek(0)
+            fileobj.truncate()
+            async with self._client.stream("GET", url, params=params, timeout=timeout) as response:
+                if response.is_error:
+                    # Read the (small) error body so handlers can show the provider's message
+                    await response.aread()
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(64 * 1024):
+                    fileobj.write(chunk)
+            PROVIDER_FETCH_BYTES.inc(fileobj.tell(), action=policy_name)
+            fileobj.seek(0)
+        await self._with_retries(policy_name, request)
+
+    def _cache_key(self, name: str) -> tuple:
+        return (request_key(self.server_url, self.username, self.password, name),
+                request_label(self.server_url, self.username, name))
+
+    async def _replay(self, entry: CacheEntry, fileobj) -> bool:
+        if not await asyncio.to_thread(self.cache.read_into, entry, fileobj):
+            return False
+        self.cache.replays += 1
+        return True
+
+    async def _cached(self, name: str, url: str, policy_name: str, params: dict):
+        """Download url into an anonymous temp file through the response cache.
+
+        name identifies the request in the cache. A cached response younger
+        than the cache's TTL is replayed without contacting the provider
+        (unless use_ttl is off), and so is any cached response when the
+        provider is unavailable, or always in offline mode. The caller owns
+        (and must close) the returned file.
+        """
+        fileobj = tempfile.TemporaryFile()
+        try:
+            if self.cache is None:
+                await self._download(url, policy_name, fileobj, params=params)
+                return fileobj
+            key, label = self._cache_key(name)
+            entry = await asyncio.to_thread(self.cache.lookup, key)
+            if entry is not None and (OFFLINE or (self.use_ttl and self.cache.is_fresh(entry))):
+                if await asyncio.to_thread(self.cache.read_into, entry, fileobj):
+                    self.cache.hits += 1
+                    logger.info(f"Using cached {label} from {entry.age / 60:.0f} min ago")
+                    return fileobj
+            if OFFLINE:
+                raise OfflineError(f"Offline and {label} is not in the response cache")
+            try:
+                await self._download(url, policy_name, fileobj, params=params)
+            except httpx.HTTPError as e:
+                if not provider_unavailable(e) or entry is None or not await self._replay(entry, fileobj):
+                    raise
+                logger.warning(f"Request for {label} failed ({e}), replaying the cached response "
+                               f"from {entry.age / 60:.0f} min ago")
+                return fileobj
+            self.cache.misses += 1
+            await asyncio.to_thread(self.cache.store, key, label, fileobj)
+            return fileobj
+        except BaseException:
+            fileobj.close()
+            raise
+
+    async def _get_json(self, policy_name: str, params: dict):
+        with await self._cached(params.get("action", "auth"), self.api_url, policy_name, params) as f:
+            # Decoding a catalog is CPU bound, keep it off the event loop
+            return await asyncio.to_thread(json.load, f)
+
+    async def authenticate(self) -> dict:
+        """Return the player_api user info, raising ValueError on invalid credentials"""
+        user_data = await self._get_json("auth", self.credentials)
+        if not isinstance(user_data, dict) or user_data.get('user_info', {}).get('auth', 0) != 1:
+            raise ValueError("Invalid credentials")
+        return user_data
+
+    async def download_action(self, action: str):
+        """Download a catalog action to an anonymous temp file, without decoding it"""
+        return await self._cached(action, self.api_url, action, {**self.credentials, "action": action})
+
+    async def download_catalogs(self) -> dict:
+        """Download the live, VOD and series catalogs concurrently to temp files.
+
+        The caller owns (and must close) the returned file objects.
+        """
+        results = await asyncio.gather(*(self.download_action(action) for action in CATALOG_ACTIONS), return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            for r in results:
+                if not isinstance(r, BaseException):
+                    r.close()
+            raise errors[0]
+        return dict(zip(CATALOG_ACTIONS, results))
+
+    async def fetch_m3u(self) -> str:
+        """Fetch the provider's own m3u_plus playlist (fallback when player_api fails)"""
+        params = {**self.credentials, "type": "m3u_plus", "output": "ts"}
+        with await self._cached("m3u", f"{self.server_url}/get.php", "m3u", params) as f:
+            return f.read().decode("utf-8", errors="replace")
+
+    async def download_epg(self, xml_path: str) -> bool:
+        """Stream xmltv.php to disk, returning False when the provider reports it unchanged.
+
+        The body is copied chunk by chunk without decoding. A gzip body (from
+        Content-Encoding or a gzipped file) is stored as-is at xml_path + ".gz",
+        anything else at xml_path; the other variant is removed. The download
+        goes to a temp file that is renamed into place once complete, and
+        ETag/Last-Modified are kept in a sidecar for conditional requests.
+
+        With a cache, the guide goes through it like the other responses (see
+        _cached): a fresh or, when the provider is unavailable or offline, any
+        cached guide is written back unless it is already the one on disk.
+        """
+        meta_path = f"{xml_path}.meta.json"
+        meta = {}
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            pass
+        on_disk = bool(meta.get("file")) and os.path.exists(os.path.join(os.path.dirname(xml_path), meta["file"]))
+
+        entry = None
+        if self.cache is not None:
+            key, label = self._cache_key("epg")
+            entry = await asyncio.to_thread(self.cache.lookup, key)
+            if entry is not None and (OFFLINE or (self.use_ttl and self.cache.is_fresh(entry))):
+                changed = await asyncio.to_thread(self._restore_epg, entry, xml_path, meta, on_disk)
+                if changed is not None:
+                    self.cache.hits += 1
+                    logger.info(f"Using cached {label} from {entry.age / 60:.0f} min ago")
+                    return changed
+            if OFFLINE:
+                raise OfflineError(f"Offline and {label} is not in the response cache")
+
+        # Only send validators when the file they describe is still on disk
+        headers = {"Accept-Encoding": "gzip"}
+        if on_disk:
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        async def request(timeout):
+            url = f"{self.server_url}/xmltv.php"
+            async with self._client.stream("GET", url, params=self.credentials, headers=headers, timeout=timeout) as response:
+                if response.status_code == 304:
+                    return None
+                if response.is_error:
+                    await response.aread()
+                response.raise_for_status()
+                out = None
+                size = 0
+                try:
+                    async for chunk in response.aiter_raw(64 * 1024):
+                        if not chunk:
+                            continue
+                        if out is None:
+                            is_gzip = chunk[:2] == b"\x1f\x8b"
+                            out = AtomicFile(f"{xml_path}.gz" if is_gzip else xml_path, "wb")
+                            out.open().write(chunk)
+                        else:
+                            out.file.write(chunk)
+                        size += len(chunk)
+                    if out is None:
+                        raise ValueError("Empty EPG response")
+                    out.commit()
+                    PROVIDER_FETCH_BYTES.inc(size, action="epg")
+                except BaseException:
+                    if out is not None:
+                        out.abort()
+                    raise
+                return out.path, size, response.headers
+
+        try:
+            result = await self._with_retries("epg", request)
+        except httpx.HTTPError as e:
+            if not provider_unavailable(e) or entry is None:
+                raise
+            changed = await asyncio.to_thread(self._restore_epg, entry, xml_path, meta, on_disk)
+            if changed is None:
+                raise
+            self.cache.replays += 1
+            logger.warning(f"Request for {label} failed ({e}), replaying the cached guide "
+                           f"from {entry.age / 60:.0f} min ago")
+            return changed
+
+        if result is None:
+            logger.info(f"EPG not modified since last download ({xml_path})")
+            if self.cache is not None:
+                if entry is not None and entry.digest == meta.get("digest"):
+                    await asyncio.to_thread(self.cache.refresh, key)
+                else:
+                    path = os.path.join(os.path.dirname(xml_path), meta["file"])
+                    meta["digest"] = (await asyncio.to_thread(self._store_file, key, label, path)).digest
+                    with AtomicFile(meta_path, "w") as f:
+                        json.dump(meta, f)
+            return False
+
+        path, size, response_headers = result
+        stale = xml_path if path.endswith(".gz") else f"{xml_path}.gz"
+        try:
+            os.unlink(stale)
+        except FileNotFoundError:
+            pass
+        meta = {
+            "file": os.path.basename(path),
+            "etag": response_headers.get("etag"),
+            "last_modified": response_headers.get("last-modified"),
+        }
+        if self.cache is not None:
+            self.cache.misses += 1
+            meta["digest"] = (await asyncio.to_thread(self._store_file, key, label, path)).digest
+        with AtomicFile(meta_path, "w") as f:
+            json.dump(meta, f)
+        logger.info(f"Downloaded EPG to {path} ({size} bytes)")
+        return True
+
+    def _store_file(self, key: str, label: str, path: str) -> CacheEntry:
+        with open(path, "rb") as f:
+            return self.cache.store(key, label, f)
+
+    def _restore_epg(self, entry: CacheEntry, xml_path: str, meta: dict, on_disk: bool):
+        """Write the cached guide to disk the way download_epg would.
+
+        Returns False when it is already the guide on disk, True when it was
+        written, None when its blob is gone. The validators are dropped, as
+        they may describe a different version.
+        """
+        if on_disk and meta.get("digest") == entry.digest:
+            return False
+        src = self.cache.open(entry)
+        if src is None:
+            return None
+        with src:
+            first = src.read(64 * 1024)
+            out = AtomicFile(f"{xml_path}.gz" if first[:2] == b"\x1f\x8b" else xml_path, "wb")
+            try:
+                out.open().write(first)
+                shutil.copyfileobj(src, out.file, 1024 * 1024)
+                out.commit()
+            except BaseException:
+                out.abort()
+                raise
+        stale = xml_path if out.path.endswith(".gz") else f"{xml_path}.gz"
+        try:
+            os.unlink(stale)
+        except FileNotFoundError:
+            pass
+        with AtomicFile(f"{xml_path}.meta.json", "w") as f:
+            json.dump({"file": os.path.basename(out.path), "etag": None, "last_modified": None,
+                       "digest": entry.digest}, f)
+        logger.info(f"Restored cached EPG to {out.path} ({entry.size} bytes)")
+        return True
+
+    async def aclose(self):
+        await self._client.aclose()
+
+
+def iter_catalog_items(fileobj, fields):
+    """Incrementally decode a catalog JSON array, one entry at a time.
+
+    Only the keys in `fields` are kept, so no entry ever becomes a full dict.
+    """
+    wanted = {f"item.{field}": field for field in fields}
+    entry = None
+    events = ijson.parse(fileobj, use_float=True)
+    try:
+        first = next(events, None)
+        if first is None or first[:2] != ("", "start_array"):
+            raise ValueError("Catalog response is not a JSON array")
+        for prefix, event, value in events:
+            if prefix == "item":
+                if event == "start_map":
+                    entry = {}
+                elif event == "end_map":
+                    yield entry
+                    entry = None
+            elif entry is not None:
+                field = wanted.get(prefix)
+                if field is None or event in ("start_map", "start_array"):
+                    continue
+                entry[field] = value
+    except ijson.JSONError as e:
+        raise ValueError(f"Invalid catalog JSON: {e}") from e
+
+
+# One client (and connection pool) per provider account, one limiter per host
+_clients = {}
+_limiters = {}
+
+
+def get_limiter(server_url: str) -> HostLimiter:
+    host = urllib.parse.urlsplit(server_url).netloc.lower()
+    limiter = _limiters.get(host)
+    if limiter is None:
+        limiter = _limiters[host] = HostLimiter(HOST_CONCURRENCY, HOST_REQUESTS_PER_SECOND)
+    return limiter
+
+
+def get_client(server_url: str, username: str, password: str, use_ttl: bool = True) -> XtreamClient:
+    """The account's shared client; use_ttl=False for user-initiated refreshes, which want fresh provider data"""
+    key = (server_url.rstrip('/'), username, password)
+    client = _clients.get(key)
+    if client is None:
+        client = XtreamClient(server_url, username, password, limiter=get_limiter(server_url), cache=response_cache)
+        _clients[key] = client
+    return client if use_ttl else client.bypassing_ttl()
+
+
+async def close_clients():
+    clients = list(_clients.values())
+    _clients.clear()
+    _limiters.clear()
+    for client in clients:
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.debug(f"Error closing Xtream client: {e}")